@@ -0,0 +1,111 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+import sys
+
+import loguru
+from pandas import DataFrame
+from xlsxwriter import Workbook
+from xlsxwriter.utility import xl_cell_to_rowcol
+
+from FormattedWorkbook import table_rows
+from report_layout import CELL_STYLES, RULE_STYLES, report_layout, report_rules, report_values, xlsxwriter_style
+from stage_timing import timed
+
+# Формат дат такой же, как у openpyxl по умолчанию
+DATE_FORMAT = 'yyyy-mm-dd h:mm:ss'
+# Операторы условного форматирования openpyxl в критерии XlsxWriter
+RULE_CRITERIA = {
+    'lessThan': '<',
+    'greaterThan': '>',
+    'equal': '==',
+    'greaterThanOrEqual': '>=',
+}
+
+
+def _is_empty(value) -> bool:
+    # None, NaN и NaT в ячейки не пишутся
+    return value is None or value != value
+
+
+class ConstantMemoryWorkbook(Workbook):
+    """
+    Рабочая книга XlsxWriter в режиме constant_memory с тем же интерфейсом, что и FormattedWorkbook.
+    Строки каждого листа сбрасываются на диск по мере записи, поэтому память не растет с размером таблиц.
+    Книга сохраняется один раз методом save(), после этого изменять ее нельзя.
+    """
+
+    def __init__(self, report_sheet_name: str, logging_level='ERROR', table_style='TableStyleMedium2', properties_creator=None):
+        super().__init__(None, {'constant_memory': True, 'strings_to_urls': False, 'default_date_format': DATE_FORMAT})
+        self.logging_level = logging_level
+        self.logger = loguru.logger
+        self.table_style = table_style
+        if properties_creator is not None:
+            self.set_properties({'author': properties_creator})
+        # Лист отчетной таблицы должен быть первым, а порядок листов в XlsxWriter задается порядком создания.
+        # Поэтому лист создается сразу и заполняется в excel_report_sheet()
+        self.ws = self.report_ws = self.add_worksheet(report_sheet_name)
+
+    @timed('sheet', sheet='save_sheet_name')
+    def excel_format_table(self, df: DataFrame, save_sheet_name: str, save_table_name: str):
+        """ Метод обеспечивает форматирование листа Excel с таблицей."""
+        self.logger.remove()
+        self.logger.add(sys.stdout, level=self.logging_level)
+        self.logger.info(f'Создаем лист "{save_sheet_name}"')
+        self.ws = self.add_worksheet(save_sheet_name)
+        header = [str(column) for column in df.columns]
+        self.logger.info(f'Форматирует таблицу "{save_table_name}"')
+        # add_table() не работает в режиме constant_memory. Таблица добавляется до записи строк,
+        # пока в памяти нет ни одной строки листа, а ее заголовки затем перезаписываются обычными строками.
+        # Флаг constant_memory листа - внутренний атрибут XlsxWriter, поэтому версия XlsxWriter в requirements.txt
+        # закреплена той, с которой это проверено: при обновлении проверить, что таблица листа открывается в Excel и openpyxl
+        self.ws.constant_memory = False
+        result = self.ws.add_table(0, 0, len(df), len(header) - 1, {
+            'name': save_table_name,
+            'style': self.table_style,
+            'banded_columns': True,
+            'columns': [{'header': column} for column in header],
+        })
+        self.ws.constant_memory = True
+        if result != 0:
+            self.logger.error(f'Не удалось добавить таблицу "{save_table_name}" на лист "{save_sheet_name}"')
+        self.logger.info(f'Заполняем лист "{save_sheet_name}" данными')
+        widths = [len(column) for column in header]
+        self.ws.write_row(0, 0, header)
+        for row_num, row in enumerate(table_rows(df, header=False), start=1):
+            for col_num, value in enumerate(row):
+                widths[col_num] = max(widths[col_num], len(str(value)))
+                if not _is_empty(value):
+                    self.ws.write(row_num, col_num, value)
+        self.logger.info(f'Выравниваем поля по размеру в таблице "{save_table_name}"')
+        for col_num, width in enumerate(widths):
+            self.ws.set_column(col_num, col_num, width + 3)
+
+    @timed('sheet', sheet='save_sheet_name')
+    def excel_report_sheet(self, save_sheet_name: str, metrics: dict, period: str, update_date: [str, None] = None):
+        """
+        Метод заполняет зарезервированный лист отчетной таблицы.
+        Ячейки пишутся построчно, как требует режим constant_memory.
+        """
+        self.logger.info(f'Заполняем лист "{save_sheet_name}"')
+        self.ws = self.report_ws
+        cell_formats = {name: self.add_format(xlsxwriter_style(style)) for name, style in CELL_STYLES.items()}
+        rule_formats = {name: self.add_format(xlsxwriter_style(style)) for name, style in RULE_STYLES.items()}
+        cells = {coordinate: [value, cell_formats[style]] for coordinate, value, style in report_layout(metrics)}
+        for coordinate, value in report_values(metrics, period, update_date).items():
+            cells.setdefault(coordinate, [None, None])[0] = value
+        cells = {xl_cell_to_rowcol(coordinate): cell for coordinate, cell in cells.items()}
+        for (row_num, col_num), (value, cell_format) in sorted(cells.items()):
+            self.ws.write(row_num, col_num, value, cell_format)
+        for coordinate, operator, formula, style in report_rules(metrics):
+            self.ws.conditional_format(coordinate, {'type': 'cell', 'criteria': RULE_CRITERIA[operator], 'value': formula,
+                                                    'format': rule_formats[style], 'stop_if_true': True})
+        # Ширина колонок считается как в adjust_columns_width(): пустые ячейки в пределах листа дают длину 'None'
+        max_row = max(row_num for row_num, _ in cells)
+        for col_num in range(max(col_num for _, col_num in cells) + 1):
+            lengths = [len(str(cells[(row_num, col_num)][0])) if (row_num, col_num) in cells else len(str(None)) for row_num in range(max_row + 1)]
+            self.ws.set_column(col_num, col_num, max(lengths) + 3)
+        return self.ws
+
+    def save(self, filename):
+        """Сохраняет и закрывает книгу"""
+        self.filename = filename
+        self.close()
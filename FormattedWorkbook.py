@@ -1,16 +1,43 @@
+import datetime
+import functools
+import hashlib
+import os
+import re
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+from xml.etree.ElementTree import fromstring
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipFile
+from zlib import crc32
 
 import loguru
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import Cell
+from openpyxl.packaging.custom import CustomPropertyList, StringProperty
 from openpyxl.utils import get_column_letter
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.worksheet._writer import WorksheetWriter
 from openpyxl.worksheet.table import Table, TableStyleInfo
-from pandas import DataFrame
+from pandas import DataFrame, StringDtype
+from pandas.api.types import is_datetime64_any_dtype
+from pandas.util import hash_pandas_object
 
+from report_layout import report_variant, report_values, style_report_sheet
+from stage_timing import timed
 
+# Минимальный размер таблицы в ячейках, начиная с которого строки листа сериализуются в отдельном процессе
+PARALLEL_MIN_CELLS = 50000
+# Префикс имени свойства документа с хэшем содержимого листа: значение "хэш номер_листа"
+SHEET_HASH_PROPERTY = 'sheet_hash '
+
+
+@functools.lru_cache(maxsize=None)
 def fill_cell_names():
     """
-        Заполнение словаря для обращения к ячейкам Excel 1:A, 2:B,... 27:AA, 28:AB и так далее до ZZZ
+        Заполнение словаря для обращения к ячейкам Excel 1:A, 2:B,... 27:AA, 28:AB и так далее до ZZZ.
+        Словарь строится один раз и общий для всех книг, изменять его нельзя
 
         :return Dictionary:
         """
@@ -32,6 +59,7 @@ def fill_cell_names():
     return _cell_names
 
 
+@timed('width')
 def adjust_columns_width(_dataframe):
     # Форматирование ширины полей отчётной таблицы
     for _col in _dataframe.columns:
@@ -51,25 +79,140 @@ def adjust_columns_width(_dataframe):
     return _dataframe
 
 
+def table_rows(df: DataFrame, header: bool = True):
+    """
+    Строки таблицы для записи на лист, как openpyxl.utils.dataframe.dataframe_to_rows(df, index=False).
+    Пустые значения строковых колонок (pd.NA в string[pyarrow]) отдаются как None
+    """
+    if header:
+        yield list(df.columns.values)
+    columns = [series.to_numpy(dtype=object, na_value=None) if isinstance(series.dtype, StringDtype) else series for _, series in df.items()]
+    for row in zip(*columns):
+        yield list(row)
+
+
+def render_table_rows(df: DataFrame, cell_styles, number_formats, start: int = None):
+    """
+    Сериализует строки данных листа с таблицей в XML (элементы <row> без строки заголовка) и считает ширину колонок.
+    Выполняется в отдельном процессе. Стили и форматы чисел берутся из основной книги, чтобы номера стилей в XML совпадали.
+    Для части таблицы (start - номер первой строки части в таблице) строка заголовка не записывается
+    и ширина колонок считается только по строкам части.
+    Возвращает None, если для данных нужен стиль, которого нет в основной книге.
+    """
+    wb = Workbook()
+    wb._cell_styles = cell_styles
+    wb._number_formats = number_formats
+    styles_count, formats_count = len(cell_styles), len(number_formats)
+    ws = wb.active
+    if start is not None:
+        # Строки части нумеруются с места части в таблице (строка 1 - заголовок)
+        ws._current_row = start + 1
+    for row in table_rows(df, header=start is None):
+        ws.append(row)
+    adjust_columns_width(ws)
+    out = BytesIO()
+    writer = WorksheetWriter(ws, out=out)
+    writer.write_rows()
+    writer.close()
+    if len(wb._cell_styles) != styles_count or len(wb._number_formats) != formats_count:
+        return None
+    xml = out.getvalue()
+    # Для части - с первой строки части: openpyxl записывает и пустую строку 1
+    first = xml.index(b'</row>') + len(b'</row>') if start is None else xml.index(f'<row r="{start + 2}"'.encode())
+    rows = xml[first:xml.rindex(b'</sheetData>')]
+    return rows, {column: dimension.width for column, dimension in ws.column_dimensions.items()}
+
+
+def render_shared_rows(path: Path, start: int, stop: int, cell_styles, number_formats, part: bool):
+    """
+    Сериализует строки start:stop таблицы из файла Arrow IPC (shared_frames): таблица не передается процессу через pickle
+
+    :param part: Часть таблицы (render_table_rows со start) или вся таблица
+    """
+    from shared_frames import open_frame
+
+    return render_table_rows(open_frame(path, start, stop), cell_styles, number_formats, start if part else None)
+
+
+def table_hash(df: DataFrame) -> str:
+    """Хэш содержимого таблицы: наименования и типы колонок, значения строк по порядку"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    digest.update(hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def previous_table_rows(source: ZipFile, part: str):
+    """
+    Возвращает строки данных (без строки заголовка) и ширину колонок листа сохраненной ранее книги
+    в том же виде, что и render_table_rows()
+    """
+    xml = source.read(part)
+    rows = xml[xml.index(b'</row>') + len(b'</row>'):xml.rindex(b'</sheetData>')]
+    widths = {}
+    for col in re.finditer(rb'<col ([^>]*)/>', xml):
+        attributes = dict(re.findall(rb'(\w+)="([^"]*)"', col.group(1)))
+        if b'width' in attributes:
+            for index in range(int(attributes[b'min']), int(attributes[b'max']) + 1):
+                widths[get_column_letter(index)] = float(attributes[b'width'])
+    return rows, widths
+
+
 class FormattedWorkbook(Workbook):
-    def __init__(self, logging_level='ERROR', table_style='TableStyleMedium2', properties_creator=None):
+    def __init__(self, logging_level='ERROR', table_style='TableStyleMedium2', properties_creator=None, save_workers=None, incremental=False):
         super().__init__()
+        self._setup(logging_level, table_style, properties_creator, save_workers, incremental)
+
+    def _setup(self, logging_level, table_style, properties_creator, save_workers=None, incremental=False, report_template=None):
         self.logging_level = logging_level
         self.logger = loguru.logger
         self.table_style = table_style
         self.excel_cell_names = fill_cell_names()
         self.ws = self.active
         self.properties.creator = properties_creator
+        self.report_template = report_template
+        # Количество процессов для сериализации листов при сохранении и отложенные листы: лист: таблица данных
+        self.save_workers = save_workers
+        self.deferred_sheets = {}
+        # Таблицы передаются процессам сериализации через файлы Arrow IPC (shared_frames), False - через pickle
+        self.share_frames = True
+        # Обновление отчета, сохраненного ранее в тот же файл: неизмененные листы берутся из него. Хэши листов: лист: хэш
+        self.incremental = incremental
+        self.sheet_hashes = {}
+
+    @classmethod
+    def from_template(cls, template_file, logging_level='ERROR', table_style='TableStyleMedium2', properties_creator=None, save_workers=None,
+                      incremental=False):
+        """
+        Создает рабочую книгу из шаблона отчетной таблицы (см. report_layout.make_report_template).
+        Листы шаблона с подписями, стилями и условным форматированием уже готовы, заполняются только значения.
+        """
+        template = load_workbook(template_file)
+        wb = cls(logging_level, table_style, properties_creator, save_workers, incremental)
+        # Книга принимает листы, стили и свойства документа шаблона, листы переходят в новую книгу
+        wb.__dict__.update(vars(template))
+        for sheet in wb._sheets:
+            sheet._parent = wb
+        wb._setup(logging_level, table_style, properties_creator, save_workers, incremental, report_template=wb.sheetnames)
+        return wb
 
+    @timed('sheet', sheet='save_sheet_name')
     def excel_format_table(self, df: DataFrame, save_sheet_name: str, save_table_name: str):
         """ Метод обеспечивает форматирование листа Excel с таблицей."""
         self.logger.remove()
         self.logger.add(sys.stdout, level=self.logging_level)
         self.logger.info(f'Создаем лист "{save_sheet_name}"')
         self.ws = self.create_sheet(title=f'{save_sheet_name}')
-        self.logger.info(f'Заполняем лист "{save_sheet_name}" данными')
-        for row in dataframe_to_rows(df, index=False, header=True):
-            self.ws.append(row)
+        deferred = self.incremental or (self.save_workers is not None and self.save_workers > 1 and df.size >= PARALLEL_MIN_CELLS)
+        if deferred:
+            # На листе только заголовок таблицы, строки данных сериализуются при сохранении книги
+            self.logger.info(f'Откладываем заполнение листа "{save_sheet_name}" до сохранения книги')
+            self.ws.append(next(table_rows(df)))
+            self.deferred_sheets[self.ws] = df
+        else:
+            self.logger.info(f'Заполняем лист "{save_sheet_name}" данными')
+            for row in table_rows(df):
+                self.ws.append(row)
         self.logger.info(f'Форматирует таблицу "{save_table_name}"')
         self.logger.debug(f'Таблица для форматирования: A1:{self.excel_cell_names[len(df.columns)]}{len(df) + 1}')
         tab = Table(displayName=f'{save_table_name}',
@@ -77,5 +220,211 @@ class FormattedWorkbook(Workbook):
         tab.tableStyleInfo = TableStyleInfo(name=self.table_style, showRowStripes=True, showColumnStripes=True)
         self.logger.info(f'Добавляем таблицу "{save_table_name}" на лист "{save_sheet_name}"')
         self.ws.add_table(tab)
-        self.logger.info(f'Выравниваем поля по размеру в таблице "{save_table_name}"')
+        if not deferred:
+            self.logger.info(f'Выравниваем поля по размеру в таблице "{save_table_name}"')
+            self.ws = adjust_columns_width(self.ws)
+
+    @timed('sheet', sheet='save_sheet_name')
+    def excel_report_sheet(self, save_sheet_name: str, metrics: dict, period: str, update_date: [str, None] = None):
+        """
+        Метод формирует лист отчетной таблицы первым листом книги.
+        Для книги из шаблона выбирается готовый лист с нужным набором секций, иначе лист оформляется заново.
+
+        :param save_sheet_name: Имя листа
+        :param metrics: Словарь секция: метрики секции
+        :param period: Отчетный период для заголовков колонок
+        :param update_date: Дата обновления данных на портале
+        """
+        if self.report_template is not None:
+            variant = report_variant(metrics)
+            self.logger.info(f'Используем лист шаблона "{variant}" для листа "{save_sheet_name}"')
+            for sheet_name in self.report_template:
+                if sheet_name != variant:
+                    self.remove(self[sheet_name])
+            self.ws = self[variant]
+            self.ws.title = save_sheet_name
+            self.move_sheet(self.ws, offset=-self.index(self.ws))
+            self.active = 0
+            self.report_template = None
+        else:
+            self.logger.info(f'Создаем и оформляем лист "{save_sheet_name}"')
+            self.ws = style_report_sheet(self.create_sheet(title=save_sheet_name, index=0), metrics)
+        for coordinate, value in report_values(metrics, period, update_date).items():
+            self.ws[coordinate] = value
         self.ws = adjust_columns_width(self.ws)
+        return self.ws
+
+    @timed('render')
+    def _render_sheets(self, sheets: dict) -> dict:
+        """
+        Сериализует строки отложенных листов: в save_workers процессах или в основном процессе.
+        Листы, для которых нужен новый стиль, заполняются данными в основном процессе и в результат не попадают.
+        """
+        if not sheets:
+            return {}
+        if self.save_workers is not None and self.save_workers > 1 and self.share_frames:
+            rendered = self._render_shared(sheets)
+        elif self.save_workers is not None and self.save_workers > 1:
+            self.logger.info(f'Сериализуем {len(sheets)} лист(ов) в {min(self.save_workers, len(sheets))} процессах')
+            with ProcessPoolExecutor(max_workers=min(self.save_workers, len(sheets))) as executor:
+                futures = {ws: executor.submit(render_table_rows, df, self._cell_styles, self._number_formats) for ws, df in sheets.items()}
+                rendered = {ws: future.result() for ws, future in futures.items()}
+        else:
+            # Копии стилей, чтобы сериализация не добавляла стили в книгу
+            rendered = {ws: render_table_rows(df, deepcopy(self._cell_styles), deepcopy(self._number_formats)) for ws, df in sheets.items()}
+
+        for ws, result in list(rendered.items()):
+            if result is None:
+                self.logger.info(f'Заполняем лист "{ws.title}" данными в основном процессе')
+                rows = table_rows(sheets[ws])
+                next(rows)
+                for row in rows:
+                    ws.append(row)
+                adjust_columns_width(ws)
+                del rendered[ws]
+        return rendered
+
+    def _render_shared(self, sheets: dict) -> dict:
+        """
+        Сериализует строки отложенных листов в save_workers процессах. Таблица листа записывается один раз в файл Arrow IPC,
+        процессы читают свои части таблицы через memory map. Большие листы делятся на части по строкам между процессами,
+        строки частей объединяются по порядку, ширина колонок - наибольшая по частям и заголовку.
+        Таблицы, которые нельзя передать через Arrow без изменения значений, передаются процессам через pickle
+        """
+        # pyarrow загружается только при параллельном сохранении
+        from shared_frames import partitions, publish_frame
+
+        with tempfile.TemporaryDirectory(prefix='sheets_', ignore_cleanup_errors=True) as tmp_dir:
+            tasks = []
+            for number, (ws, df) in enumerate(sheets.items()):
+                path = publish_frame(df, Path(tmp_dir, f'{number}.arrow'))
+                if path is None:
+                    tasks.append((ws, (render_table_rows, df, self._cell_styles, self._number_formats)))
+                    continue
+                # Листы делятся на части, только если листов меньше, чем процессов
+                parts = partitions(len(df), min(max(1, self.save_workers // len(sheets)), max(1, df.size // PARALLEL_MIN_CELLS)))
+                tasks += [(ws, (render_shared_rows, path, start, stop, self._cell_styles, self._number_formats, len(parts) > 1)) for start, stop in parts]
+            workers = min(self.save_workers, len(tasks))
+            self.logger.info(f'Сериализуем {len(sheets)} лист(ов) частями ({len(tasks)}) в {workers} процессах')
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [(ws, executor.submit(*task)) for ws, task in tasks]
+                results = [(ws, future.result()) for ws, future in futures]
+
+        rendered = {}
+        for ws, df in sheets.items():
+            parts = [result for sheet, result in results if sheet is ws]
+            if len(parts) == 1 or any(result is None for result in parts):
+                rendered[ws] = parts[0] if len(parts) == 1 else None
+                continue
+            # Ширина колонок частей посчитана без строки заголовка, как в adjust_columns_width()
+            widths = {get_column_letter(index + 1): len(str(column)) + 3 for index, column in enumerate(df.columns)}
+            for _, part_widths in parts:
+                for column, width in part_widths.items():
+                    widths[column] = max(widths.get(column, 0), width)
+            rendered[ws] = b''.join(rows for rows, _ in parts), widths
+        return rendered
+
+    def _previous_sheets(self, file_name, deferred: dict) -> dict:
+        """
+        Возвращает строки и ширину колонок листов сохраненного ранее отчета, содержимое которых не изменилось.
+        Отчет, пересохраненный не через openpyxl (например, в Excel), не используется.
+        """
+        try:
+            with ZipFile(file_name) as source:
+                if b'Openpyxl' not in source.read('docProps/app.xml') or 'docProps/custom.xml' not in source.namelist():
+                    self.logger.info(f'Файл "{file_name}" сохранен не этой программой, листы будут записаны заново')
+                    return {}
+                properties = CustomPropertyList.from_tree(fromstring(source.read('docProps/custom.xml')))
+                previous = {prop.name[len(SHEET_HASH_PROPERTY):]: prop.value.split() for prop in properties
+                            if prop.name.startswith(SHEET_HASH_PROPERTY)}
+                return {ws: previous_table_rows(source, f'xl/worksheets/sheet{previous[ws.title][1]}.xml') for ws in deferred
+                        if ws.title in previous and previous[ws.title][0] == self.sheet_hashes[ws.title]}
+        except (BadZipFile, KeyError, ValueError) as ex:
+            self.logger.error(f'Не удалось прочитать листы файла "{file_name}": {ex}')
+            return {}
+
+    def save(self, filename):
+        """
+        Сохраняет книгу. Строки отложенных листов сериализуются (параллельно в save_workers процессах)
+        и вставляются в XML листов при сборке zip контейнера.
+        В режиме incremental строки листов, содержимое которых совпадает с сохраненным ранее в тот же файл отчетом,
+        берутся из этого отчета без повторной сериализации в XML: экономится только время процессора. Файл при этом
+        записывается целиком заново (во временный файл ~<имя> с заменой), объем чтения и записи не уменьшается.
+        Если не изменился ни один лист, файл не перезаписывается.
+
+        :return bool: Файл записан
+        """
+        deferred = {ws: df for ws, df in self.deferred_sheets.items() if ws in self.worksheets}
+        previous_file = None
+        if self.incremental:
+            self.sheet_hashes = {ws.title: table_hash(df) for ws, df in deferred.items()}
+            self.custom_doc_props.props = [prop for prop in self.custom_doc_props.props if not prop.name.startswith(SHEET_HASH_PROPERTY)]
+            for ws in deferred:
+                self.custom_doc_props.append(StringProperty(name=f'{SHEET_HASH_PROPERTY}{ws.title}',
+                                                            value=f'{self.sheet_hashes[ws.title]} {self.worksheets.index(ws) + 1}'))
+            if isinstance(filename, (str, Path)) and Path(filename).is_file():
+                previous_file = Path(filename)
+        if not deferred and previous_file is None:
+            super().save(filename)
+            return True
+
+        # Регистрируем стили в том же порядке, в котором их назначает последовательная запись,
+        # чтобы процессы использовали те же номера стилей, а результат совпадал с обычным сохранением
+        for ws in self.worksheets:
+            for _, cell in sorted(ws._cells.items()):
+                if cell.has_style:
+                    _ = cell.style_id
+            if ws in deferred and any(is_datetime64_any_dtype(dtype) for dtype in deferred[ws].dtypes):
+                _ = Cell(ws, value=datetime.datetime(1900, 1, 1)).style_id
+
+        reused = self._previous_sheets(previous_file, deferred) if previous_file is not None else {}
+        if reused:
+            self.logger.info(f'Листы без изменений: {", ".join(ws.title for ws in reused)}')
+        rendered = self._render_sheets({ws: df for ws, df in deferred.items() if ws not in reused})
+        while True:
+            for ws, (_, widths) in {**rendered, **reused}.items():
+                for column, width in widths.items():
+                    ws.column_dimensions[column].width = width
+            buffer = BytesIO()
+            super().save(buffer)
+            if not reused:
+                break
+            # Номера стилей в строках предыдущего отчета верны только при тех же стилях книги
+            with ZipFile(previous_file) as previous, ZipFile(buffer) as source:
+                if previous.read('xl/styles.xml') == source.read('xl/styles.xml'):
+                    break
+            self.logger.info('Стили книги изменились, листы предыдущего отчета сериализуются заново')
+            rendered.update(self._render_sheets({ws: deferred[ws] for ws in reused}))
+            reused = {}
+
+        parts = {ws.path[1:]: (ws, rows) for ws, (rows, _) in {**rendered, **reused}.items()}
+
+        def spliced_parts(source: ZipFile):
+            for item in source.infolist():
+                data = source.read(item.filename)
+                if item.filename in parts:
+                    ws, rows = parts[item.filename]
+                    df = deferred[ws]
+                    dimension = f'A1:{get_column_letter(len(df.columns))}{len(df) + 1}'.encode()
+                    data = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="' + dimension + b'"', data, count=1)
+                    end = data.rindex(b'</sheetData>')
+                    data = data[:end] + rows + data[end:]
+                yield item, data
+
+        with ZipFile(buffer) as source:
+            if previous_file is not None:
+                # Время изменения в docProps/core.xml отличается всегда, остальные части сравниваются по CRC
+                with ZipFile(previous_file) as previous:
+                    checksums = {item.filename: item.CRC for item in previous.infolist() if item.filename != 'docProps/core.xml'}
+                if checksums == {item.filename: crc32(data) for item, data in spliced_parts(source) if item.filename != 'docProps/core.xml'}:
+                    self.logger.info(f'Содержимое отчета "{previous_file}" не изменилось')
+                    return False
+                target_file = previous_file.with_name(f'~{previous_file.name}')
+            else:
+                target_file = filename
+            with ZipFile(target_file, 'w', ZIP_DEFLATED, allowZip64=True) as target:
+                for item, data in spliced_parts(source):
+                    target.writestr(item, data)
+        if previous_file is not None:
+            os.replace(target_file, previous_file)
+        return True
@@ -0,0 +1,71 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Сравнение текстовых колонок object (строки Python) и string[pyarrow] после загрузки представления портала:
+память таблицы и время масок и группировок, которые используются при расчете отчета.
+
+python benchmarks/arrow_strings.py --rows 200000
+"""
+import argparse
+import datetime
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import vols_functions  # noqa: E402
+from report_layout import REPORT_PROCESSES  # noqa: E402
+from synthetic import COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, PROCESS_COLUMNS, portal_frame  # noqa: E402
+
+YEAR = 2024
+MONTH = 6
+DONE_STATUSES = ['Исполнена', 'Не требуется']
+LAST_DAYS_OF_MONTH = {month: pd.Timestamp(vols_functions.last_day_of_month(datetime.datetime(YEAR, month, 1))) for month in range(1, 13)}
+
+OPERATIONS = {
+    'status != "Исполнена"': lambda df: df[PROCESS_COLUMNS['tz_status']] != 'Исполнена',
+    'status.isin()': lambda df: df[PROCESS_COLUMNS['tz_status']].isin(DONE_STATUSES).sum(),
+    'status.str.contains()': lambda df: ~df[PROCESS_COLUMNS['ks2_status']].str.contains('Исполнена|Не требуется', regex=True),
+    'category.isin()': lambda df: df[PROCESS_COLUMNS['program_category']].isin(['Доступ', 'Дискреты_целевые']),
+    'groupby(region).count()': lambda df: df.groupby(PROCESS_COLUMNS['region'])[PROCESS_COLUMNS['plan_date']].count(),
+    'sort_values(region, plan)': lambda df: df.sort_values(by=COLUMNS_FOR_SORT),
+    'report_frames': lambda df: vols_functions.report_frames(df, None, None, PROCESS_COLUMNS, REPORT_PROCESSES, LAST_DAYS_OF_MONTH, MONTH, COLUMNS_FOR_SORT,
+                                                             COLUMNS_FOR_SORT_ACTIVE, ('БП', 'Строительство ВОЛС', 'Реконструкция ВОЛС')),
+}
+
+
+def measure(operation, df: pd.DataFrame, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation(df)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение текстовых колонок object и string[pyarrow]')
+    parser.add_argument('--rows', type=int, default=200000, help='Количество строк синтетической таблицы')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество замеров времени')
+    args = parser.parse_args()
+
+    frames = {'object': portal_frame(args.rows, YEAR)}
+    start = time.perf_counter()
+    frames['string[pyarrow]'] = vols_functions.convert_text(frames['object'])
+    conversion = time.perf_counter() - start
+
+    print(f'Таблица: {args.rows} строк, {len(frames["object"].columns)} колонок, текстовых: '
+          f'{sum(dtype == "string" for dtype in frames["string[pyarrow]"].dtypes)}, конвертация {conversion:.2f} с')
+    print(f'{"":<28}{"object":>14}{"string[pyarrow]":>18}')
+    sizes = {name: df.memory_usage(deep=True).sum() / 2 ** 20 for name, df in frames.items()}
+    print(f'{"память, МБ":<28}{sizes["object"]:>14.1f}{sizes["string[pyarrow]"]:>18.1f}')
+    for name, operation in OPERATIONS.items():
+        times = {dtype: measure(operation, df, args.repeat) for dtype, df in frames.items()}
+        print(f'{name + ", с":<28}{times["object"]:>14.4f}{times["string[pyarrow]"]:>18.4f}')
+
+
+if __name__ == '__main__':
+    main()
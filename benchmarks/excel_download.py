@@ -0,0 +1,149 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Скачивание выгрузок Excel (режим EXCEL): pd.read_excel(url) и кэш выгрузок DownloadCache против локальной заглушки портала,
+которая поддерживает ETag/Last-Modified, сжатие gzip и диапазоны Range.
+
+Замеряются общее время, время скачивания и переданный объем для: первого скачивания, повторного скачивания
+неизменившейся выгрузки (304) и скачивания с обрывом соединения на середине передачи (продолжение запросом Range).
+Прочитанные таблицы должны совпадать.
+
+python benchmarks/excel_download.py --rows 20000
+"""
+import argparse
+import email.utils
+import gzip
+import hashlib
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import download_cache  # noqa: E402
+from download_cache import DownloadCache  # noqa: E402
+from synthetic import dashboard_frame  # noqa: E402
+
+YEAR = 2024
+ROWS = 20000
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    """Заглушка api/legacy/download: условные запросы, gzip, Range с If-Range, обрыв соединения после drop_after байт"""
+
+    def do_GET(self):
+        server = self.server
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = server.gzip_body if gzipped else server.body
+        if self.headers.get('If-None-Match') == server.etag or self.headers.get('If-Modified-Since') == server.last_modified:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+        status, start = 200, 0
+        if self.headers.get('Range') and self.headers.get('If-Range') in (server.etag, server.last_modified):
+            status, start = 206, int(self.headers['Range'].split('=')[1].rstrip('-'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', server.last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if server.drop_after is not None:
+            self.wfile.write(body[start:start + server.drop_after])
+            server.sent += server.drop_after
+            server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+        server.sent += len(body) - start
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExportServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, body: bytes):
+        super().__init__(('127.0.0.1', 0), ExportHandler)
+        self.body = body
+        self.gzip_body = gzip.compress(body, mtime=0)
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.last_modified = email.utils.formatdate(usegmt=True)
+        self.drop_after = None
+        self.sent = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/api/legacy/download?table=vw_{YEAR}_FOCL_Common_Build_City&database=dashboard'
+
+
+def measure(server: ExportServer, read) -> tuple:
+    server.sent = 0
+    start = time.perf_counter()
+    df, download = read()
+    return df, time.perf_counter() - start, download, server.sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Скачивание выгрузок Excel портала')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Количество мероприятий в выгрузке')
+    args = parser.parse_args()
+    # Повтор после обрыва без паузы: замеряется объем и время передачи
+    download_cache.DOWNLOAD_RETRY_DELAY = 0
+
+    output = BytesIO()
+    dashboard_frame(args.rows, YEAR).to_excel(output, index=False)
+    server = ExportServer(output.getvalue())
+    print(f'Выгрузка {args.rows} строк: {len(server.body) / 2 ** 20:.1f} МБ, gzip {len(server.gzip_body) / 2 ** 20:.1f} МБ')
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DownloadCache(directory)
+
+        def cached():
+            start = time.perf_counter()
+            file = cache.fetch(server.url)
+            download = time.perf_counter() - start
+            return pd.read_excel(file, parse_dates=True), download
+
+        def dropped():
+            server.drop_after = len(server.gzip_body) // 2
+            for file in Path(directory).iterdir():
+                file.unlink()
+            return cached()
+
+        variants = {
+            'pd.read_excel(url)': lambda: (pd.read_excel(server.url, parse_dates=True), None),
+            'DownloadCache, первое': cached,
+            'DownloadCache, без изменений': cached,
+            'DownloadCache, обрыв': dropped,
+        }
+        results = []
+        reference = None
+        for name, read in variants.items():
+            df, seconds, download, sent = measure(server, read)
+            if reference is None:
+                reference = df
+            pd.testing.assert_frame_equal(df, reference)
+            results.append((name, seconds, download, sent))
+    print(f'{"вариант":<32}{"время, с":>10}{"скачивание, с":>16}{"передано, МБ":>14}')
+    for name, seconds, download, sent in results:
+        print(f'{name:<32}{seconds:>10.3f}{f"{download:.3f}" if download is not None else "-":>16}{sent / 2 ** 20:>14.2f}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Время запуска gdc_vols: --help и подкоманды без обработки данных, а также модули, загружаемые при импорте gdc_vols.
+
+Проверяется, что импорт gdc_vols не загружает тяжелые библиотеки (pandas, openpyxl, requests, redmail и т.д.):
+они загружаются только этапами обработки. Модули обработки (vols_functions) загружают только pandas (pandas сам загружает pyarrow),
+библиотеки отдельных этапов - при выполнении этапа. Время запуска сравнивается с бюджетом, для собранных PyInstaller/Nuitka exe
+(--exe) отдельный бюджет: распаковка onefile exe занимает больше времени, чем импорт. Время запуска на runner CI зависит от его загрузки,
+поэтому в CI превышение бюджета времени только выводится (--time-warn-only), а загрузка тяжелых библиотек остается ошибкой.
+
+python benchmarks/import_time.py
+python benchmarks/import_time.py --exe build/gdc_vols.exe --fail-on-regression --time-warn-only
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+# Библиотеки, которые не должны загружаться при импорте gdc_vols
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'openpyxl', 'xlsxwriter', 'requests', 'redmail', 'jinja2', 'polars', 'duckdb', 'psutil']
+# Библиотеки этапов, которые не должны загружаться при импорте модулей обработки
+STAGE_MODULES = {
+    'vols_functions': ['openpyxl', 'xlsxwriter', 'requests', 'redmail', 'jinja2', 'polars', 'duckdb', 'psutil', 'orjson', 'FormattedWorkbook'],
+}
+# Команды без обработки данных
+COMMANDS = {
+    'help': ['--help'],
+    'serve --help': ['serve', '--help'],
+}
+# Бюджет времени запуска, с
+BUDGET = 0.3
+EXE_BUDGET = 3.0
+# Количество модулей с наибольшим временем импорта в отчете
+TOP_MODULES = 15
+
+
+def run_time(command: list, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=PACKAGE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def loaded_modules(module: str = 'gdc_vols') -> list:
+    """Модули, загруженные импортом module"""
+    code = f'import json, sys; before = set(sys.modules); import {module}; print(json.dumps(sorted(set(sys.modules) - before)))'
+    output = subprocess.run([sys.executable, '-c', code], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def import_times() -> list:
+    """Модули импорта gdc_vols по общему времени импорта (python -X importtime), мкс"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import gdc_vols'], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line.split('|')
+        modules.append((name.strip(), int(own.split(':')[1]), int(cumulative)))
+        # Модули верхнего уровня (без отступа) выводятся после своих зависимостей: модули запуска интерпретатора (site) отбрасываются
+        if not name[1:].startswith(' ') and name.strip() != 'gdc_vols':
+            modules = []
+    return sorted(modules, key=lambda module: -module[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время запуска gdc_vols и модули, загружаемые при импорте')
+    parser.add_argument('--exe', type=Path, action='append', default=[], help='Собранный exe PyInstaller/Nuitka (можно несколько)')
+    parser.add_argument('--no-source', action='store_true', help='Не замерять запуск gdc_vols.py (только --exe)')
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков каждой команды')
+    parser.add_argument('--budget', type=float, default=BUDGET, help=f'Бюджет времени запуска gdc_vols.py, с (по умолчанию {BUDGET})')
+    parser.add_argument('--exe-budget', type=float, default=EXE_BUDGET, help=f'Бюджет времени запуска exe, с (по умолчанию {EXE_BUDGET})')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Код завершения 1, если превышен бюджет или загружаются тяжелые библиотеки')
+    parser.add_argument('--time-warn-only', action='store_true', help='Превышение бюджета времени только выводится, без кода завершения 1')
+    args = parser.parse_args()
+
+    regressions = []
+    if not args.no_source:
+        modules = loaded_modules()
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        print(f'Импорт gdc_vols загружает модулей: {len(modules)}')
+        if heavy:
+            print(f'  тяжелые библиотеки: {", ".join(heavy)}  РЕГРЕССИЯ')
+            regressions += heavy
+        print(f'{"модуль":<48}{"собств., мс":>14}{"всего, мс":>12}')
+        for name, own, cumulative in import_times()[:TOP_MODULES]:
+            print(f'{name:<48}{own / 1000:>14.1f}{cumulative / 1000:>12.1f}')
+        for module, stage_modules in STAGE_MODULES.items():
+            loaded = loaded_modules(module)
+            heavy = [name for name in stage_modules if name in loaded]
+            print(f'Импорт {module} загружает библиотеки этапов: {", ".join(heavy) + "  РЕГРЕССИЯ" if heavy else "нет"}')
+            regressions += heavy
+        print()
+
+    targets = [] if args.no_source else [('gdc_vols.py', [sys.executable, str(Path(PACKAGE_DIR, 'gdc_vols.py'))], args.budget)]
+    targets += [(str(exe), [str(exe.resolve())], args.exe_budget) for exe in args.exe]
+    print(f'{"программа":<32}{"команда":<16}{"мин, с":>10}{"медиана, с":>12}{"бюджет, с":>12}')
+    for name, command, budget in targets:
+        for title, arguments in COMMANDS.items():
+            result = run_time(command + arguments, args.repeat)
+            line = f'{name:<32}{title:<16}{result["min"]:>10.3f}{result["median"]:>12.3f}{budget:>12.2f}'
+            if result['median'] > budget:
+                line += '  ПРЕВЫШЕН БЮДЖЕТ' if args.time_warn_only else '  РЕГРЕССИЯ'
+                if not args.time_warn_only:
+                    regressions.append((name, title))
+            print(line, flush=True)
+
+    if regressions:
+        print(f'Регрессий: {len(regressions)}')
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Декодирование JSON ответа API портала в DataFrame: прежний путь (json.loads, DataFrame, convert_date с format='mixed'),
+decode_dashboard_json (orjson, сборка по колонкам pa.Table.from_pylist, схема колонок: даты и текст приводятся к типам
+при декодировании), сборка pd.DataFrame по строкам из объектов orjson с той же схемой и pyarrow.json (требует JSON по строкам:
+ответ портала - массив, преобразование входит в замер).
+Таблицы после convert_date и convert_text, как в gdc_vols, должны совпадать.
+
+python benchmarks/json_decode.py --rows 10000 50000 200000 --memory
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import vols_functions  # noqa: E402
+from synthetic import PROCESS_COLUMNS, dashboard_frame  # noqa: E402
+
+YEAR = 2024
+ROWS = [10000, 50000, 200000]
+# Колонки преобразования дат, как в gdc_vols.main
+COLUMNS_DATE = ['Планируемая дата окончания', 'Дата ввода', 'Прогнозная дата окончания', '_дата']
+COLUMN_TYPES = vols_functions.dashboard_column_types(PROCESS_COLUMNS)
+STRING_TYPES = {pa.string(): pd.StringDtype('pyarrow')}
+
+
+def loads(payload: bytes):
+    try:
+        import orjson
+        return orjson.loads(payload)
+    except ImportError:
+        return json.loads(payload)
+
+
+def typed_table(table: pa.Table) -> pd.DataFrame:
+    # Колонки схемы: текст - строки Arrow, даты разбираются по формату портала
+    df = table.to_pandas(types_mapper=STRING_TYPES.get)
+    for column, column_type in COLUMN_TYPES.items():
+        if column_type == 'date' and column in df.columns:
+            dates = vols_functions.parse_portal_dates(df[column])
+            if dates is not None:
+                df[column] = dates
+    return df
+
+
+def from_records(payload: bytes) -> pd.DataFrame:
+    df = pd.DataFrame(loads(payload))
+    for column, column_type in COLUMN_TYPES.items():
+        if column in df.columns and column_type == 'date':
+            dates = vols_functions.parse_portal_dates(df[column])
+            if dates is not None:
+                df[column] = dates
+        elif column in df.columns and pd.api.types.infer_dtype(df[column], skipna=True) == 'string':
+            df[column] = df[column].astype('string[pyarrow]')
+    return df
+
+
+def json_lines(payload: bytes) -> pd.DataFrame:
+    import orjson
+
+    lines = b'\n'.join(map(orjson.dumps, orjson.loads(payload)))
+    return typed_table(pa_json.read_json(pa.py_buffer(lines)))
+
+
+def prepared(df: pd.DataFrame) -> pd.DataFrame:
+    return vols_functions.convert_text(vols_functions.convert_date(df, COLUMNS_DATE))
+
+
+VARIANTS = {
+    'json + DataFrame': lambda payload: prepared(pd.DataFrame(json.loads(payload))),
+    'decode_dashboard_json': lambda payload: prepared(vols_functions.decode_dashboard_json(payload, COLUMN_TYPES)),
+    'orjson + DataFrame': lambda payload: prepared(from_records(payload)),
+    'pyarrow.json по строкам': lambda payload: prepared(json_lines(payload)),
+}
+
+
+def measure(variant, payload: bytes, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        variant(payload)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(variant, payload: bytes) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        variant(payload)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Декодирование JSON ответа портала')
+    parser.add_argument('--rows', type=int, nargs='+', default=ROWS, help='Количество мероприятий в ответе')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество замеров времени')
+    parser.add_argument('--memory', action='store_true', help='Пиковая память декодирования (tracemalloc, отдельный запуск)')
+    args = parser.parse_args()
+
+    try:
+        import orjson
+        print(f'orjson {orjson.__version__}')
+    except ImportError:
+        print('orjson не установлен, decode_dashboard_json декодирует json')
+    print(f'{"вариант":<26}{"строк":>10}{"ответ, МБ":>12}{"время, с":>12}{"ускорение":>12}' + (f'{"память, МБ":>12}' if args.memory else ''))
+    for rows in args.rows:
+        payload = dashboard_frame(rows, YEAR, as_text=True).to_json(orient='records', force_ascii=False).encode('utf-8')
+        results = {name: variant(payload) for name, variant in VARIANTS.items()}
+        reference = next(iter(results.values()))
+        for name, result in results.items():
+            pd.testing.assert_frame_equal(result, reference)
+        del results, reference
+        baseline = None
+        for name, variant in VARIANTS.items():
+            seconds = measure(variant, payload, args.repeat)
+            baseline = baseline or seconds
+            line = f'{name:<26}{rows:>10}{len(payload) / 2 ** 20:>12.1f}{seconds:>12.3f}{baseline / seconds:>12.2f}'
+            if args.memory:
+                line += f'{peak_memory(variant, payload) / 2 ** 20:>12.1f}'
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Микробенчмарки функций обработки (vols_functions) и записи листов (FormattedWorkbook) на синтетических представлениях портала
+от 1 тыс. до 1 млн строк.
+
+Результаты сохраняются в benchmarks/results/<версия>_<дата_время>.json и сравниваются с последним сохраненным результатом
+другой версии (или с файлом --compare): замедление больше --threshold отмечается как регрессия.
+
+python benchmarks/micro.py
+python benchmarks/micro.py --sizes 1000 10000 --bench sum_done_events report_frames
+python benchmarks/micro.py --compare benchmarks/results/0.7.1_20240601_120000.json --fail-on-regression
+"""
+import argparse
+import datetime
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import FormattedWorkbook as formatted_workbook  # noqa: E402
+import vols_functions  # noqa: E402
+from report_layout import REPORT_PROCESSES  # noqa: E402
+from synthetic import COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, PROCESS_COLUMNS, dashboard_frame, portal_frame  # noqa: E402
+
+YEAR = 2024
+MONTH = 6
+SIZES = [1000, 10000, 100000, 1000000]
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+DONE_STATUSES = ['Исполнена', 'Не требуется']
+# Колонки преобразования типов, как в gdc_vols.main
+COLUMNS_DATE = ['Планируемая дата окончания', 'Дата ввода', 'Прогнозная дата окончания', '_дата']
+COLUMNS_DIGIT = ['ID']
+LAST_DAYS_OF_MONTH = {month: pd.Timestamp(vols_functions.last_day_of_month(datetime.datetime(YEAR, month, 1))) for month in range(1, 13)}
+SHEET_NAME = 'Расш. стр. гор.ВОЛС'
+TABLE_NAME = 'Urban_VOLS_Main_Build'
+
+
+class Data:
+    """Синтетические таблицы одного размера, создаются при первом обращении"""
+
+    def __init__(self, rows: int):
+        self.rows = rows
+        self._frames = {}
+
+    def _frame(self, name, build):
+        if name not in self._frames:
+            self._frames[name] = build()
+        return self._frames[name]
+
+    @property
+    def text(self) -> pd.DataFrame:
+        # Как ответ API портала: даты и ID строками
+        return self._frame('text', lambda: dashboard_frame(self.rows, YEAR, as_text=True).astype({'ID': str}))
+
+    @property
+    def portal(self) -> pd.DataFrame:
+        # Как после загрузки в gdc_vols: даты datetime64, текст в строках Arrow
+        return self._frame('portal', lambda: vols_functions.convert_text(portal_frame(self.rows, YEAR)))
+
+    @property
+    def worksheet(self):
+        # Лист с записанной таблицей без оформления
+        def build():
+            wb = formatted_workbook.FormattedWorkbook()
+            for row in formatted_workbook.table_rows(self.portal):
+                wb.active.append(row)
+            return wb.active
+        return self._frame('worksheet', build)
+
+
+def _excel_format_table(df: pd.DataFrame):
+    wb = formatted_workbook.FormattedWorkbook()
+    wb.excel_format_table(df, SHEET_NAME, TABLE_NAME)
+
+
+# Бенчмарк: подготовка аргументов (не замеряется, выполняется перед каждым замером), замеряемый вызов и наибольший размер таблицы
+BENCHMARKS = {
+    'convert_date': (lambda data: data.text.copy(), lambda df: vols_functions.convert_date(df, COLUMNS_DATE), None),
+    'convert_int': (lambda data: data.text.copy(), lambda df: vols_functions.convert_int(df, COLUMNS_DIGIT), None),
+    'convert_text': (lambda data: portal_frame(data.rows, YEAR), vols_functions.convert_text, None),
+    'sum_sort_events': (lambda data: data.portal,
+                        lambda df: vols_functions.sum_sort_events(df, PROCESS_COLUMNS['tz_status'], DONE_STATUSES), None),
+    'sum_done_events': (lambda data: data.portal,
+                        lambda df: vols_functions.sum_done_events(df, PROCESS_COLUMNS['ks2_date'], PROCESS_COLUMNS['commissioning_date'],
+                                                                  PROCESS_COLUMNS['ks2_status'], PROCESS_COLUMNS['commissioning_status'],
+                                                                  DONE_STATUSES, MONTH, LAST_DAYS_OF_MONTH), None),
+    'sum_sort_month_events': (lambda data: data.portal,
+                              lambda df: vols_functions.sum_sort_month_events(df, PROCESS_COLUMNS['plan_date'], MONTH, LAST_DAYS_OF_MONTH), None),
+    'report_frames': (lambda data: data.portal,
+                      lambda df: vols_functions.report_frames(df, None, None, PROCESS_COLUMNS, REPORT_PROCESSES, LAST_DAYS_OF_MONTH, MONTH,
+                                                              COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, ('БП', 'Строительство ВОЛС', 'Реконструкция ВОЛС')),
+                      None),
+    'FormattedWorkbook': (lambda data: None, lambda _: formatted_workbook.FormattedWorkbook(), 1000),
+    # Запись openpyxl держит все ячейки листа в памяти
+    'adjust_columns_width': (lambda data: data.worksheet, formatted_workbook.adjust_columns_width, 100000),
+    'excel_format_table': (lambda data: data.portal, _excel_format_table, 100000),
+}
+
+
+def measure(setup, call, data: Data, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        argument = setup(data)
+        gc.collect()
+        start = time.perf_counter()
+        call(argument)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+def environment() -> dict:
+    import numpy
+    import openpyxl
+    import pyarrow
+
+    return {
+        'version': vols_functions.PROGRAM_VERSION,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.node(),
+        'pandas': pd.__version__,
+        'numpy': numpy.__version__,
+        'openpyxl': openpyxl.__version__,
+        'pyarrow': pyarrow.__version__,
+    }
+
+
+def previous_result(results_dir: Path, version: str):
+    # Последний сохраненный результат другой версии
+    files = sorted(results_dir.glob('*.json'), key=lambda file: file.stat().st_mtime, reverse=True)
+    for file in files:
+        result = json.loads(file.read_text(encoding='utf-8'))
+        if result['environment']['version'] != version:
+            return file, result
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки функций обработки и записи листов')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Количество строк синтетических таблиц')
+    parser.add_argument('--bench', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), help='Выполняемые бенчмарки')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество замеров времени')
+    parser.add_argument('--results-dir', type=Path, default=RESULTS_DIR, help='Папка сохраненных результатов')
+    parser.add_argument('--compare', type=Path, help='Файл результатов для сравнения (по умолчанию последний результат другой версии)')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Отношение времени к сравниваемому результату, начиная с которого это регрессия')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Код завершения 1 при регрессии')
+    parser.add_argument('--no-save', action='store_true', help='Не сохранять результаты')
+    args = parser.parse_args()
+
+    env = environment()
+    if args.compare is not None:
+        compare_file, compare = args.compare, json.loads(args.compare.read_text(encoding='utf-8'))
+    else:
+        compare_file, compare = previous_result(args.results_dir, env['version'])
+    baseline = {(item['bench'], item['rows']): item for item in compare['results']} if compare is not None else {}
+    if compare is not None:
+        print(f'Сравнение с {compare_file} (версия {compare["environment"]["version"]}, {compare["environment"]["date"]})')
+
+    results = []
+    regressions = []
+    print(f'{"бенчмарк":<32}{"строк":>10}{"мин, с":>12}{"медиана, с":>12}{"было, с":>12}{"отношение":>12}')
+    for rows in args.sizes:
+        data = Data(rows)
+        for name in args.bench:
+            setup, call, limit = BENCHMARKS[name]
+            if limit is not None and rows > limit:
+                continue
+            result = {'bench': name, 'rows': rows, **measure(setup, call, data, args.repeat)}
+            results.append(result)
+            line = f'{name:<32}{rows:>10}{result["min"]:>12.4f}{result["median"]:>12.4f}'
+            previous = baseline.get((name, rows))
+            if previous is not None:
+                ratio = result['min'] / previous['min'] if previous['min'] else float('inf')
+                line += f'{previous["min"]:>12.4f}{ratio:>12.2f}'
+                if ratio > args.threshold:
+                    line += '  РЕГРЕССИЯ'
+                    regressions.append(result)
+            print(line, flush=True)
+        del data
+        gc.collect()
+
+    if not args.no_save:
+        args.results_dir.mkdir(parents=True, exist_ok=True)
+        result_file = Path(args.results_dir, f'{env["version"]}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+        result_file.write_text(json.dumps({'environment': env, 'results': results}, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f'Результаты сохранены в {result_file}')
+    if regressions:
+        print(f'Регрессий: {len(regressions)}')
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Сериализация листов в процессах при сохранении отчета (--parallel-save): передача таблиц процессам через pickle
+и через файлы Arrow IPC с memory map (shared_frames), в которых большие листы делятся на части между процессами.
+
+Замеряются время сохранения и пиковая память процесса и процессов сериализации (--memory, отдельный запуск: PSS,
+общие страницы memory map делятся между процессами, RSS учитывает их в каждом процессе). Листы книг должны совпадать.
+
+python benchmarks/parallel_save.py --rows 50000 --workers 2 4 8 --memory
+"""
+import argparse
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from FormattedWorkbook import FormattedWorkbook  # noqa: E402
+from synthetic import dashboard_frame  # noqa: E402
+from vols_functions import convert_text  # noqa: E402
+
+YEAR = 2024
+ROWS = 50000
+WORKERS = [2, 4]
+SHEETS = {'Расш. стр. гор.ВОЛС': 'Urban_VOLS_Main_Build', 'Строительство зон.ВОЛС': 'Zone_VOLS_Build'}
+
+
+class MemorySampler:
+    """Пиковая суммарная память процесса и дочерних процессов"""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def _memory(process) -> int:
+        try:
+            info = process.memory_full_info()
+            return getattr(info, 'pss', info.rss)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return 0
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, sum(self._memory(child) for child in [process] + process.children(recursive=True)))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def save(frames: dict, workers, share_frames: bool, file_name: Path, sampler: MemorySampler = None) -> float:
+    wb = FormattedWorkbook(save_workers=workers)
+    wb.share_frames = share_frames
+    ws_first = wb.active
+    for (sheet, table), df in zip(SHEETS.items(), frames.values()):
+        wb.excel_format_table(df, sheet, table)
+    wb.remove(ws_first)
+    start = time.perf_counter()
+    if sampler is None:
+        wb.save(file_name)
+    else:
+        with sampler:
+            wb.save(file_name)
+    return time.perf_counter() - start
+
+
+def sheets_xml(file_name: Path) -> dict:
+    with ZipFile(file_name) as source:
+        return {name: source.read(name) for name in source.namelist() if name.startswith('xl/worksheets/')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сериализация листов в процессах: pickle и Arrow IPC')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Количество строк каждого листа')
+    parser.add_argument('--workers', type=int, nargs='+', default=WORKERS, help='Количество процессов сериализации')
+    parser.add_argument('--memory', action='store_true', help='Пиковая память процессов (psutil, отдельный запуск)')
+    args = parser.parse_args()
+
+    frames = {sheet: convert_text(dashboard_frame(args.rows, YEAR, seed)) for seed, sheet in enumerate(SHEETS)}
+    pickled = sum(len(pickle.dumps(df)) for df in frames.values())
+    print(f'Листов {len(frames)} по {args.rows} строк, pickle таблиц {pickled / 2 ** 20:.1f} МБ')
+    variants = [('в основном процессе', None, False)]
+    for workers in args.workers:
+        variants += [(f'pickle, {workers} процесса', workers, False), (f'Arrow IPC, {workers} процесса', workers, True)]
+
+    print(f'{"вариант":<28}{"время, с":>10}' + (f'{"память, МБ":>12}' if args.memory else ''))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference = None
+        for name, workers, share_frames in variants:
+            file_name = Path(tmp_dir, 'report.xlsx')
+            seconds = save(frames, workers, share_frames, file_name)
+            xml = sheets_xml(file_name)
+            reference = reference or xml
+            if xml != reference:
+                raise AssertionError(f'Листы книги "{name}" отличаются')
+            line = f'{name:<28}{seconds:>10.2f}'
+            if args.memory:
+                sampler = MemorySampler()
+                save(frames, workers, share_frames, file_name, sampler)
+                line += f'{sampler.peak / 2 ** 20:>12.0f}'
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Проверка совпадения показателей отчета и таблиц листов рассылки, посчитанных на pandas (vols_functions.report_frames)
+и на Polars (polars_pipeline.report_frames), и сравнение времени расчета.
+Проверяются все сочетания режимов --new-algorithm, --active-year и наличия дополнительного строительства и реконструкции.
+
+python benchmarks/polars_parity.py --rows 20000
+"""
+import argparse
+import datetime
+import itertools
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import polars_pipeline  # noqa: E402
+import vols_functions  # noqa: E402
+from report_layout import REPORT_PROCESSES  # noqa: E402
+from synthetic import COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, PROCESS_COLUMNS, portal_frame  # noqa: E402
+
+YEAR = 2024
+MONTH = 6
+BUSINESS_PROCESS = ('БП', 'Строительство ВОЛС', 'Реконструкция ВОЛС')
+
+
+def compute(backend, frames: dict, new_algorithm: bool, active_year: bool) -> tuple:
+    last_days_of_month = {month: pd.Timestamp(vols_functions.last_day_of_month(datetime.datetime(YEAR, month, 1))) for month in range(1, 13)}
+    start = time.perf_counter()
+    result = backend.report_frames(frames['build'], frames['ext'], frames['rec'], PROCESS_COLUMNS, REPORT_PROCESSES, last_days_of_month, MONTH,
+                                   COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, BUSINESS_PROCESS, new_algorithm, active_year)
+    return result, time.perf_counter() - start
+
+
+def _values(df: pd.DataFrame) -> pd.DataFrame:
+    # Пустые значения в pandas NaN или <NA> у строк Arrow, после Polars None: сравниваются значения без учета типов колонок
+    df = df.reset_index(drop=True).astype(object)
+    return df.where(df.notna(), None)
+
+
+def check(expected: dict, actual: dict):
+    assert expected['metrics'] == actual['metrics'], f'{expected["metrics"]} != {actual["metrics"]}'
+    for name in ('current_month', 'tz', 'sending_po', 'received_po'):
+        try:
+            assert_frame_equal(_values(expected[name]), _values(actual[name]))
+        except AssertionError as ex:
+            raise AssertionError(f'{name}: {ex}') from None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение расчета отчета на pandas и Polars')
+    parser.add_argument('--rows', type=int, default=20000, help='Количество строк каждого представления')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество замеров времени')
+    args = parser.parse_args()
+
+    data = {
+        'build': portal_frame(args.rows, YEAR, 1),
+        'ext': portal_frame(args.rows, YEAR, 2),
+        'rec': portal_frame(args.rows, YEAR, 3, reconstruction=True),
+    }
+    # Текстовые колонки в строках Arrow, как после загрузки в gdc_vols
+    data = {name: vols_functions.convert_text(df) for name, df in data.items()}
+    print(f'Представления: {args.rows} строк, {len(data["build"].columns)} колонок')
+    print(f'{"режим":<48}{"pandas, с":>12}{"polars, с":>12}')
+    for new_algorithm, active_year, ext, rec in itertools.product([False, True], repeat=4):
+        frames = {'build': data['build'], 'ext': data['ext'] if ext else None, 'rec': data['rec'] if rec else None}
+        times = {'pandas': [], 'polars': []}
+        for _ in range(args.repeat):
+            expected, elapsed = compute(vols_functions, frames, new_algorithm, active_year)
+            times['pandas'].append(elapsed)
+            actual, elapsed = compute(polars_pipeline, frames, new_algorithm, active_year)
+            times['polars'].append(elapsed)
+        check(expected, actual)
+        mode = ' '.join(name for name, flag in (('new-algorithm', new_algorithm), ('active-year', active_year), ('ext', ext), ('rec', rec)) if flag) or '-'
+        print(f'{mode:<48}{min(times["pandas"]):>12.3f}{min(times["polars"]):>12.3f}')
+    print('Результаты pandas и Polars совпадают')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Кэш результатов расчета отчета (result_cache): повторные запуски по одним и тем же данным портала с разными ключами.
+
+Последовательность запусков как за день работы: первый расчет, повтор с теми же ключами, --active-year, --new-algorithm,
+другой --month и снова первый набор ключей. Замеряется время расчета без кэша и с кэшем (отпечаток данных, чтение и запись частей),
+выводятся части, взятые из кэша. Результаты с кэшем должны совпадать с расчетом без кэша.
+
+python benchmarks/repeated_runs.py --rows 100000
+"""
+import argparse
+import datetime
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import vols_functions  # noqa: E402
+from report_layout import REPORT_PROCESSES  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from synthetic import COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE, PROCESS_COLUMNS, portal_frame  # noqa: E402
+
+YEAR = 2024
+ROWS = 100000
+BUSINESS_PROCESS = ('БП', 'Строительство ВОЛС', 'Реконструкция ВОЛС')
+LAST_DAYS_OF_MONTH = {month: pd.Timestamp(vols_functions.last_day_of_month(datetime.datetime(YEAR, month, 1))) for month in range(1, 13)}
+# Ключи запусков: month, new_algorithm, active_year
+RUNS = {
+    'первый запуск': (6, False, False),
+    'повтор': (6, False, False),
+    '--active-year': (6, False, True),
+    '--new-algorithm': (6, True, False),
+    '--month 3': (3, False, False),
+    'первый запуск, снова': (6, False, False),
+}
+
+
+def compute(backend, sources: tuple, month: int, new_algorithm: bool, active_year: bool, parts=None) -> dict:
+    return backend.report_frames(*sources, PROCESS_COLUMNS, REPORT_PROCESSES, LAST_DAYS_OF_MONTH, month, COLUMNS_FOR_SORT, COLUMNS_FOR_SORT_ACTIVE,
+                                 BUSINESS_PROCESS, new_algorithm, active_year, parts)
+
+
+def check(expected: dict, actual: dict):
+    assert expected['metrics'] == actual['metrics'], f'{expected["metrics"]} != {actual["metrics"]}'
+    for name in ('current_month', 'tz', 'sending_po', 'received_po'):
+        assert_frame_equal(expected[name], actual[name], obj=name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Кэш результатов расчета отчета')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Количество строк каждого представления')
+    parser.add_argument('--backend', choices=['pandas', 'polars'], default='pandas', help='Расчет показателей отчета')
+    args = parser.parse_args()
+    if args.backend == 'polars':
+        import polars_pipeline as backend
+    else:
+        backend = vols_functions
+
+    sources = tuple(vols_functions.convert_text(portal_frame(args.rows, YEAR, seed, reconstruction=name == 'rec'))
+                    for seed, name in enumerate(('build', 'ext', 'rec'), start=1))
+    print(f'Представления: 3 по {args.rows} строк, {len(sources[0].columns)} колонок')
+    print(f'{"запуск":<24}{"без кэша, с":>14}{"с кэшем, с":>14}  части из кэша')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (month, new_algorithm, active_year) in RUNS.items():
+            start = time.perf_counter()
+            expected = compute(backend, sources, month, new_algorithm, active_year)
+            uncached = time.perf_counter() - start
+
+            # Каждый запуск - новый процесс gdc_vols: отпечатки данных считаются заново
+            cache = ResultCache(directory)
+            computed = []
+
+            def compute_parts(parts):
+                computed.extend(parts)
+                return compute(backend, sources, month, new_algorithm, active_year, parts)
+
+            start = time.perf_counter()
+            actual = cache.report_frames(compute_parts, sources, {'branch': 'Филиал', 'year': YEAR, 'backend': args.backend},
+                                         {'month': month, 'new_algorithm': new_algorithm, 'active_year': active_year})
+            cached = time.perf_counter() - start
+            check(expected, actual)
+            hits = [part for part in vols_functions.REPORT_PARTS if part not in computed]
+            print(f'{name:<24}{uncached:>14.3f}{cached:>14.3f}  {", ".join(hits) or "-"}', flush=True)
+    print('Результаты с кэшем совпадают с расчетом без кэша')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Масштабирование полного запуска gdc_vols: время, пиковая память и объем данных по этапам обработки
+в зависимости от размера представлений портала и количества филиалов в них.
+
+Каждая точка - отдельный процесс gdc_vols (режим JSON с рассылкой) против локальных заглушек:
+API портала (представления и дата обновления) на синтетических данных и SMTP сервер, который принимает и отбрасывает письма.
+Адреса заглушек передаются через переменные окружения DASHBOARD_URL, SMTP_HOST, SMTP_PORT, SMTP_STARTTLS.
+Этапы берутся из записи запуска (--run-record), результаты сохраняются в CSV. Для каждого этапа выводится показатель роста
+времени между двумя последними размерами (наклон в логарифмическом масштабе): больше 1 - этап растет быстрее данных.
+
+python benchmarks/scalability.py --sizes 1000 10000 100000 --branches 1 4
+python benchmarks/scalability.py --sizes 1000 5000 --no-mail --plot
+"""
+import argparse
+import base64
+import csv
+import datetime
+import json
+import math
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic import dashboard_frame  # noqa: E402
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+YEAR = 2024
+MONTH = 6
+WORK_BRANCH = 'Кавказский филиал'
+SIZES = [1000, 10000, 100000]
+BRANCHES = [1, 4]
+# Наклон роста времени этапа, начиная с которого этап отмечается как растущий быстрее данных
+SUPERLINEAR = 1.2
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    """Заглушка API портала: /legacy-dash/dashboard/plan/<представление> и /legacy-dash/dashboard/upd/<функция>"""
+
+    def do_GET(self):
+        view = self.path.rstrip('/').split('/')[-1]
+        if '/upd/' in self.path:
+            update = (datetime.datetime.now() - datetime.timedelta(hours=1)).replace(microsecond=0).isoformat()
+            body = json.dumps([{'DATE_LAST_UPDATE': update}]).encode('utf-8')
+        elif '/plan/' in self.path:
+            body = self.server.view(view)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.sent[view] += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PortalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), PortalHandler)
+        self.rows = 0
+        self.branches = 1
+        self.sent = defaultdict(int)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def configure(self, rows: int, branches: int):
+        """Размер представлений: rows мероприятий отчетного филиала и столько же у каждого из остальных филиалов"""
+        with self._lock:
+            self.rows, self.branches = rows, branches
+            self._views.clear()
+            self.sent.clear()
+
+    def view(self, name: str) -> bytes:
+        with self._lock:
+            if name not in self._views:
+                seed = sum(name.encode('utf-8')) % 1000
+                df = dashboard_frame(self.rows * self.branches, YEAR, seed, as_text=True, reconstruction='Rebuild' in name)
+                branches = np.repeat([WORK_BRANCH] + [f'Филиал {number}' for number in range(1, self.branches)], self.rows)
+                df['Филиал'] = np.random.default_rng(seed).permutation(branches)
+                self._views[name] = df.to_json(orient='records', force_ascii=False, date_format='iso').encode('utf-8')
+            return self._views[name]
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """SMTP сервер без шифрования: принимает авторизацию и письма, считает их размер"""
+
+    def _reply(self, text: str):
+        self.wfile.write(f'{text}\r\n'.encode('ascii'))
+
+    def handle(self):
+        self._reply('220 sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self._reply('250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME')
+            elif command == b'AUTH':
+                self._reply('235 authenticated')
+            elif command == b'DATA':
+                self._reply('354 end with .')
+                size = 0
+                for data in iter(self.rfile.readline, b''):
+                    if data == b'.\r\n':
+                        break
+                    size += len(data)
+                self.server.messages.append(size)
+                self._reply('250 queued')
+            elif command == b'QUIT':
+                self._reply('221 bye')
+                break
+            else:
+                self._reply('250 ok')
+
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SmtpHandler)
+        self.messages = []
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, name=server.__class__.__name__, daemon=True).start()
+    return server
+
+
+def run_point(rows: int, branches: int, out_dir: Path, portal: PortalServer, smtp: SmtpServer, mail: bool, timeout) -> list:
+    """Запуск gdc_vols для одного размера данных, возвращает строки результатов по этапам"""
+    portal.configure(rows, branches)
+    smtp.messages.clear()
+    point = f'{rows}x{branches}'
+    report_file = Path(out_dir, f'report_{point}.xlsx')
+    run_record = Path(out_dir, f'run_{point}.json')
+    env = {
+        **os.environ,
+        'DASHBOARD_URL': f'http://127.0.0.1:{portal.server_address[1]}',
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(smtp.server_address[1]),
+        'SMTP_STARTTLS': '0',
+        'EMAIL_ADDRESS': 'benchmark@example.com',
+        'EMAIL_PASSWORD': base64.b85encode(base64.b64encode(b'benchmark')).decode('utf-8'),
+    }
+    command = [sys.executable, str(Path(PACKAGE_DIR, 'gdc_vols.py')), '-r', str(report_file), '-y', str(YEAR), '-m', str(MONTH),
+               '--run-record', str(run_record)] + (['-l'] if mail else [])
+    with open(Path(out_dir, f'run_{point}.log'), 'w', encoding='utf-8') as log:
+        result = subprocess.run(command, cwd=PACKAGE_DIR, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f'gdc_vols завершился с кодом {result.returncode}, см. {log.name}')
+
+    record = json.loads(run_record.read_text(encoding='utf-8'))
+    stages = {}
+    for span in record['spans']:
+        stage = stages.setdefault(span['name'], {'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'count': 0})
+        stage['wall'] += span['wall']
+        stage['cpu'] += span['cpu']
+        stage['peak_rss'] = max(stage['peak_rss'], span['peak_rss'] or 0)
+        stage['count'] += 1
+    # Объем данных этапа: ответы портала, файл отчета, письма
+    output = {'fetch': sum(portal.sent.values()), 'save': report_file.stat().st_size, 'smtp': sum(smtp.messages)}
+    stages['total'] = {'wall': record['duration'], 'cpu': sum(stage['cpu'] for stage in stages.values()),
+                       'peak_rss': max(stage['peak_rss'] for stage in stages.values()), 'count': 1}
+    return [{'rows': rows, 'branches': branches, 'stage': name, **stage, 'bytes': output.get(name)} for name, stage in stages.items()]
+
+
+def slope(points: list):
+    # Наклон log(время)/log(строки) между двумя последними размерами
+    (rows_1, time_1), (rows_2, time_2) = points[-2:]
+    if min(time_1, time_2) <= 0 or rows_1 == rows_2:
+        return None
+    return math.log(time_2 / time_1) / math.log(rows_2 / rows_1)
+
+
+def print_summary(results: list, sizes: list):
+    for branches in sorted({result['branches'] for result in results}):
+        print(f'\nФилиалов: {branches}. Время этапа, с')
+        print(f'{"этап":<10}' + ''.join(f'{rows:>12}' for rows in sizes) + f'{"наклон":>10}{"пик RSS, МБ":>14}')
+        table = defaultdict(dict)
+        for result in results:
+            if result['branches'] == branches:
+                table[result['stage']][result['rows']] = result
+        for stage, by_rows in table.items():
+            points = [(rows, by_rows[rows]['wall']) for rows in sizes if rows in by_rows]
+            growth = slope(points) if len(points) > 1 else None
+            mark = '  !' if growth is not None and growth > SUPERLINEAR else ''
+            print(f'{stage:<10}' + ''.join(f'{by_rows[rows]["wall"]:>12.3f}' if rows in by_rows else f'{"":>12}' for rows in sizes)
+                  + (f'{growth:>10.2f}' if growth is not None else f'{"":>10}')
+                  + f'{by_rows[points[-1][0]]["peak_rss"] / 2 ** 20:>14.0f}{mark}')
+
+
+def plot(results: list, out_dir: Path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError as ex:
+        print(f'Для графиков требуется пакет matplotlib: {ex}')
+        return
+    for branches in sorted({result['branches'] for result in results}):
+        figure, (time_axes, memory_axes) = plt.subplots(1, 2, figsize=(14, 6))
+        for stage in dict.fromkeys(result['stage'] for result in results):
+            points = sorted((result['rows'], result['wall'], result['peak_rss']) for result in results
+                            if result['stage'] == stage and result['branches'] == branches)
+            time_axes.plot([point[0] for point in points], [point[1] for point in points], marker='o', label=stage)
+            memory_axes.plot([point[0] for point in points], [point[2] / 2 ** 20 for point in points], marker='o', label=stage)
+        for axes, label in ((time_axes, 'время, с'), (memory_axes, 'пиковая память, МБ')):
+            axes.set_xscale('log')
+            axes.set_yscale('log')
+            axes.set_xlabel('строк отчетного филиала')
+            axes.set_ylabel(label)
+            axes.grid(True, which='both', alpha=0.3)
+        time_axes.legend()
+        figure.suptitle(f'Филиалов в представлениях: {branches}')
+        figure.savefig(Path(out_dir, f'scalability_{branches}.png'), dpi=100)
+        plt.close(figure)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Масштабирование полного запуска gdc_vols по этапам')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Количество мероприятий отчетного филиала в каждом представлении')
+    parser.add_argument('--branches', type=int, nargs='+', default=BRANCHES, help='Количество филиалов в представлениях')
+    parser.add_argument('--out-dir', type=Path, default=Path('scalability'), help='Папка отчетов, записей запусков и результатов')
+    parser.add_argument('--no-mail', action='store_true', help='Без рассылки писем')
+    parser.add_argument('--timeout', type=float, help='Ограничение времени одного запуска, с')
+    parser.add_argument('--plot', action='store_true', help='Графики scalability_<филиалов>.png (требуется matplotlib)')
+    args = parser.parse_args()
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    portal, smtp = serve(PortalServer()), serve(SmtpServer())
+    sizes = sorted(args.sizes)
+    results = []
+    for branches in args.branches:
+        for rows in sizes:
+            print(f'Запуск: {rows} строк, филиалов {branches}', flush=True)
+            try:
+                results += run_point(rows, branches, args.out_dir, portal, smtp, not args.no_mail, args.timeout)
+            except (RuntimeError, subprocess.TimeoutExpired) as ex:
+                print(f'Ошибка запуска: {ex}')
+                break
+
+    result_file = Path(args.out_dir, 'scalability.csv')
+    with open(result_file, 'w', newline='', encoding='utf-8') as fw:
+        writer = csv.DictWriter(fw, fieldnames=['rows', 'branches', 'stage', 'count', 'wall', 'cpu', 'peak_rss', 'bytes'])
+        writer.writeheader()
+        writer.writerows(results)
+    print_summary(results, sizes)
+    if args.plot:
+        plot(results, args.out_dir)
+    print(f'\nРезультаты сохранены в {result_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Синтетические данные в формате представлений портала vw_{год}_FOCL_Common_Build_City / Build_Zone
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+REGIONS = ['Краснодарский край', 'Ставропольский край', 'Ростовская область', 'Республика Дагестан', 'Республика Адыгея',
+           'Кабардино-Балкарская Республика', 'Карачаево-Черкесская Республика', 'Республика Северная Осетия', 'Чеченская Республика']
+PROGRAM_CATEGORIES = ['Доступ', 'Дискреты_целевые', 'Дискреты', 'B2B', 'Прочее']
+PROGRAMS = ['Base Case', 'Развитие сети доступа', 'B2B подключения', 'Модернизация транспортной сети']
+CONTRACTORS = ['ООО "Связьстрой"', 'ООО "Оптика Юг"', 'АО "Трасса"', 'ООО "КавказТелеком"']
+WORK_TYPES = ['Строительство', 'Реконструкция']
+# Распределение статусов этапов
+STATUSES = ['Исполнена', 'Не требуется', 'В работе', 'Просрочена', None]
+STATUS_WEIGHTS = [0.45, 0.1, 0.25, 0.1, 0.1]
+# Этапы процесса строительства: колонки статуса и даты
+STAGES = ['Разработка ТЗ', 'Передача ТЗ подрядчику', 'ТЗ принято подрядчиком', 'Заказ ПИР,СМР', 'Линейная схема', 'Получение ТУ',
+          'Строительство трассы', 'КС-2 (ПИР, СМР)', 'Приемка в эксплуатацию', 'Запуск трафика']
+# Колонки, используемые при расчете отчета, как в gdc_vols.main
+PROCESS_COLUMNS = {
+    'plan_date': 'Планируемая дата окончания',
+    'ks2_date': 'КС-2 (ПИР, СМР)_дата',
+    'ks2_date2': 'КС-2,3_Дата',
+    'commissioning_date': 'Приемка в эксплуатацию_дата',
+    'commissioning_date2': 'Приемка ВОЛС в эксплуатацию_Дата',
+    'complete_date': 'Дата ввода в эксплуатацию',
+    'complete_date2': 'Дата ввода ВОЛС в эксплуатацию',
+    'tz_status': 'Разработка ТЗ_статус',
+    'tz_status2': 'Разработка ТЗ ВОЛС_Статус',
+    'send_tz_status': 'Передача ТЗ подрядчику_статус',
+    'send_tz_status2': 'Передача ТЗ на ВОЛС подрядчику_Статус',
+    'received_tz_status': 'ТЗ принято подрядчиком_статус',
+    'received_tz_status2': 'ТЗ принято подрядчиком_статус',
+    'pir_smr_status': 'Заказ ПИР,СМР_статус',
+    'pir_smr_status2': 'Подписание договора (дс/заказа) на ПИР/ПИР+СМР_Статус',
+    'line_scheme_status': 'Линейная схема_статус',
+    'line_scheme_status2': 'Линейная схема_Статус',
+    'tu_status': 'Получение ТУ_статус',
+    'tu_status2': 'Получение ТУ_Статус',
+    'build_status': 'Строительство трассы_статус',
+    'build_status2': 'Строительство трассы_Статус',
+    'ks2_status': 'КС-2 (ПИР, СМР)_статус',
+    'ks2_status2': 'КС-2,3_Статус',
+    'commissioning_status': 'Приемка в эксплуатацию_статус',
+    'commissioning_status2': 'Приемка ВОЛС в эксплуатацию_Статус',
+    'id': 'ID',
+    'region': 'Регион/Зона мероприятия',
+    'name': 'Название',
+    'program': 'Программы',
+    'prognoz_date': 'Прогнозная дата окончания',
+    'po': 'Подрядчик по Строительству / Продаже ВОЛС',
+    'program_category': 'Категория программы',
+    'work_type': 'Тип работ',
+}
+COLUMNS_FOR_SORT = ['Регион/Зона мероприятия', 'Планируемая дата окончания']
+COLUMNS_FOR_SORT_ACTIVE = ['Регион/Зона мероприятия', 'Категория программы', 'Планируемая дата окончания']
+# Этапы процесса реконструкции (представление Rebuild): колонки статуса и даты с заглавной буквы, кроме приема ТЗ подрядчиком
+REC_STAGES = ['Разработка ТЗ ВОЛС', 'Передача ТЗ на ВОЛС подрядчику', 'ТЗ принято подрядчиком', 'Подписание договора (дс/заказа) на ПИР/ПИР+СМР',
+              'Линейная схема', 'Получение ТУ', 'Строительство трассы', 'КС-2,3', 'Приемка ВОЛС в эксплуатацию', 'Запуск трафика']
+
+
+def dashboard_frame(rows: int, year: int = None, seed: int = 1, branch: str = "Кавказский филиал", as_text: bool = False,
+                    reconstruction: bool = False) -> pd.DataFrame:
+    """
+    Формирует таблицу мероприятий в формате представления портала
+
+    :param rows: Количество мероприятий
+    :param year: Год плана
+    :param seed: Начальное значение генератора
+    :param branch: Филиал
+    :param as_text: Даты строками ДД.ММ.ГГГГ, как в JSON ответе портала, иначе datetime64
+    :param reconstruction: Колонки этапов представления реконструкции
+    :return DataFrame:
+    """
+    rng = np.random.default_rng(seed)
+    year = datetime.date.today().year if year is None else year
+    start = np.datetime64(f'{year}-01-01')
+
+    def dates(empty_share: float):
+        _dates = pd.Series(start + rng.integers(0, 365, rows).astype('timedelta64[D]')).astype('datetime64[ns]')
+        _dates[rng.random(rows) < empty_share] = pd.NaT
+        return _dates.dt.strftime('%d.%m.%Y').where(_dates.notna(), None) if as_text else _dates
+
+    data = {
+        'ID': np.arange(100000, 100000 + rows),
+        'Филиал': branch,
+        'Регион/Зона мероприятия': rng.choice(REGIONS, rows),
+        'Название': [f'ВОЛС до БС {_i:06d}' for _i in rng.integers(0, 999999, rows)],
+        'Программы': rng.choice(PROGRAMS, rows),
+        'Категория программы': rng.choice(PROGRAM_CATEGORIES, rows),
+        'Тип работ': rng.choice(WORK_TYPES, rows),
+        'Подрядчик по Строительству / Продаже ВОЛС': rng.choice(CONTRACTORS, rows),
+        'Планируемая дата окончания': dates(0.0),
+        'Прогнозная дата окончания': dates(0.4),
+    }
+    for stage in REC_STAGES if reconstruction else STAGES:
+        status, date = ('_Статус', '_Дата') if reconstruction and stage != 'ТЗ принято подрядчиком' else ('_статус', '_дата')
+        data[f'{stage}{status}'] = rng.choice(np.array(STATUSES, dtype=object), rows, p=STATUS_WEIGHTS)
+        data[f'{stage}{date}'] = dates(0.3)
+    data['Дата ввода ВОЛС в эксплуатацию' if reconstruction else 'Дата ввода в эксплуатацию'] = dates(0.6)
+    return pd.DataFrame(data)
+
+
+def portal_frame(rows: int, year: int = None, seed: int = 1, reconstruction: bool = False) -> pd.DataFrame:
+    """
+    Таблица мероприятий в том виде, в каком она приходит в расчет отчета после загрузки: пустые статусы — пустые строки,
+    строки отсортированы по региону и плановой дате
+    """
+    df = dashboard_frame(rows, year, seed, reconstruction=reconstruction)
+    statuses = df.columns[df.columns.str.endswith('_статус') | df.columns.str.endswith('_Статус')]
+    df[statuses] = df[statuses].fillna('')
+    return df.sort_values(by=COLUMNS_FOR_SORT)
@@ -0,0 +1,84 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Сравнение времени и пикового расхода памяти записи листа с таблицей через openpyxl (FormattedWorkbook)
+и XlsxWriter в режиме constant_memory (ConstantMemoryWorkbook).
+
+python benchmarks/writer_backends.py --rows 50000
+python benchmarks/writer_backends.py --source-file build_2024.xlsx
+"""
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from ConstantMemoryWorkbook import ConstantMemoryWorkbook  # noqa: E402
+from FormattedWorkbook import FormattedWorkbook  # noqa: E402
+from synthetic import dashboard_frame  # noqa: E402
+
+SHEET_NAME = 'Расш. стр. гор.ВОЛС'
+TABLE_NAME = 'Urban_VOLS_Main_Build'
+
+
+def write_openpyxl(df: pd.DataFrame, file_name: Path):
+    wb = FormattedWorkbook()
+    ws_first = wb.active
+    wb.excel_format_table(df, SHEET_NAME, TABLE_NAME)
+    wb.remove(ws_first)
+    wb.save(file_name)
+
+
+def write_xlsxwriter(df: pd.DataFrame, file_name: Path):
+    wb = ConstantMemoryWorkbook('Отчетная таблица')
+    wb.excel_format_table(df, SHEET_NAME, TABLE_NAME)
+    wb.save(file_name)
+
+
+BACKENDS = {
+    'openpyxl': write_openpyxl,
+    'xlsxwriter': write_xlsxwriter,
+}
+
+
+def measure(writer, df: pd.DataFrame, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = Path(tmp_dir, 'benchmark.xlsx')
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            writer(df, file_name)
+            times.append(time.perf_counter() - start)
+        # Память измеряется отдельным прогоном: трассировка замедляет выполнение
+        tracemalloc.start()
+        writer(df, file_name)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'time': min(times), 'peak': peak, 'size': file_name.stat().st_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение библиотек записи Excel')
+    parser.add_argument('--rows', type=int, default=20000, help='Количество строк синтетической таблицы')
+    parser.add_argument('--source-file', help='Выгрузка представления портала (xlsx) вместо синтетических данных')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество замеров времени')
+    args = parser.parse_args()
+
+    if args.source_file is not None:
+        df = pd.read_excel(args.source_file, parse_dates=True)
+    else:
+        df = dashboard_frame(args.rows)
+    print(f'Таблица: {len(df)} строк, {len(df.columns)} колонок')
+    print(f'{"backend":<12}{"время, с":>12}{"пик памяти, МБ":>18}{"файл, МБ":>12}')
+    for name, writer in BACKENDS.items():
+        result = measure(writer, df, args.repeat)
+        print(f'{name:<12}{result["time"]:>12.2f}{result["peak"] / 2 ** 20:>18.1f}{result["size"] / 2 ** 20:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Кэш выгрузок Excel портала (режим EXCEL, api/legacy/download?table=...).
+
+Выгрузка скачивается потоком во временный файл, а не в память, со сжатием при передаче (Accept-Encoding: gzip, deflate).
+В папке кэша для каждого адреса хранятся:
+    <sha256 адреса>.xlsx       - последняя полностью скачанная выгрузка
+    <sha256 адреса>.json       - параметры ответа: ETag, Last-Modified, сжатие, размер
+    <sha256 адреса>.part       - недокачанный ответ (в том виде, как передан сервером, сжатый)
+Повторный запрос отправляется с If-None-Match / If-Modified-Since, если сервер вернул ETag / Last-Modified:
+на неизменившуюся выгрузку сервер отвечает 304 и берется файл из кэша.
+Оборванная передача продолжается запросом Range с If-Range, если сервер поддерживает диапазоны (Accept-Ranges: bytes).
+
+    path = DownloadCache(directory).fetch(url)
+    df = pd.read_excel(path)
+"""
+import hashlib
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+
+from loguru import logger
+
+from Colors import Colors as Color
+
+# Количество попыток скачивания при обрыве соединения и пауза перед повтором в секундах (далее удваивается)
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_DELAY = 5
+# Таймаут соединения и чтения, с
+DOWNLOAD_TIMEOUT = (30, 120)
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadCache:
+    """Папка скачанных выгрузок портала"""
+
+    def __init__(self, directory):
+        """
+        :param directory: Папка кэша
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _files(self, url: str) -> tuple:
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return tuple(Path(self.directory, f'{name}{suffix}') for suffix in ('.xlsx', '.json', '.part'))
+
+    @staticmethod
+    def _read_info(info_file: Path) -> dict:
+        try:
+            return json.loads(info_file.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_info(info_file: Path, info: dict):
+        temp_file = info_file.with_name(f'.{info_file.name}.tmp')
+        temp_file.write_text(json.dumps(info, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(temp_file, info_file)
+
+    def fetch(self, url: str, check_ssl: bool = True) -> Path:
+        """
+        Скачивает выгрузку или подтверждает, что выгрузка в кэше актуальна
+
+        :param url: Адрес выгрузки
+        :param check_ssl: Проверка сертификата
+        :return Path: Файл выгрузки
+        """
+        import requests
+        from urllib3.exceptions import InsecureRequestWarning, ProtocolError, ReadTimeoutError
+
+        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        data_file, info_file, part_file = self._files(url)
+        delay = DOWNLOAD_RETRY_DELAY
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                with requests.Session() as session:
+                    return self._download(session, url, check_ssl, data_file, info_file, part_file)
+            # Обрыв при чтении потока (response.raw) - исключения urllib3, неполный ответ - ConnectionError
+            except (requests.ConnectionError, requests.Timeout, ProtocolError, ReadTimeoutError, ConnectionError) as ex:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                logger.warning(f'Обрыв скачивания {url} (попытка {attempt} из {DOWNLOAD_RETRIES}): {ex}. Повтор через {delay} с')
+                time.sleep(delay)
+                delay *= 2
+
+    def _download(self, session, url: str, check_ssl: bool, data_file: Path, info_file: Path, part_file: Path) -> Path:
+        info = self._read_info(info_file)
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        # Недокачанный ответ продолжается, только если он относится к той же версии выгрузки (If-Range)
+        partial = info.get('partial') or {}
+        offset = part_file.stat().st_size if part_file.is_file() and partial.get('validator') else 0
+        if offset:
+            headers.update({'Range': f'bytes={offset}-', 'If-Range': partial['validator']})
+            headers['Accept-Encoding'] = partial.get('encoding') or 'identity'
+        elif data_file.is_file():
+            if info.get('etag'):
+                headers['If-None-Match'] = info['etag']
+            if info.get('last_modified'):
+                headers['If-Modified-Since'] = info['last_modified']
+
+        with session.get(url, headers=headers, stream=True, verify=check_ssl, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304:
+                print(f'Выгрузка не изменилась, используется файл кэша {Color.GREEN}"{data_file}"{Color.END}')
+                return data_file
+            if response.status_code == 416:
+                # Недокачанный ответ не соответствует выгрузке на сервере: скачивается заново
+                part_file.unlink()
+                self._write_info(info_file, {key: value for key, value in info.items() if key != 'partial'})
+                return self._download(session, url, check_ssl, data_file, info_file, part_file)
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            encoding = response.headers.get('Content-Encoding', '').strip().lower()
+            if offset == 0:
+                # Сильный ETag или Last-Modified - признак версии выгрузки для продолжения скачивания
+                validator = etag if etag and not etag.startswith('W/') else last_modified
+                resumable = response.headers.get('Accept-Ranges', '').lower() == 'bytes' and validator is not None
+                partial = {'validator': validator if resumable else None, 'encoding': encoding}
+                self._write_info(info_file, {**info, 'partial': partial})
+            else:
+                print(f'Продолжаем скачивание с {offset / 2 ** 20:.1f} МБ')
+            # Ответ записывается как передан сервером: диапазон Range относится к сжатому содержимому
+            with open(part_file, 'ab' if offset else 'wb') as file:
+                for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                    file.write(chunk)
+            received = part_file.stat().st_size
+            expected = response.headers.get('Content-Length')
+            if expected is not None and received != offset + int(expected):
+                raise ConnectionError(f'получено {received} байт из {offset + int(expected)}')
+
+        decode_file(part_file, data_file, partial.get('encoding', ''))
+        part_file.unlink()
+        self._write_info(info_file, {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': partial.get('encoding', ''),
+            'received': received,
+            'size': data_file.stat().st_size,
+            'downloaded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        print(f'Выгрузка скачана: {received / 2 ** 20:.1f} МБ передано, {data_file.stat().st_size / 2 ** 20:.1f} МБ файл')
+        return data_file
+
+
+def decode_file(source: Path, target: Path, encoding: str):
+    """
+    Распаковывает ответ, сжатый при передаче (Content-Encoding), в файл. Файл заменяется только после полной распаковки
+
+    :param source: Ответ сервера
+    :param target: Файл выгрузки
+    :param encoding: gzip, deflate или пустая строка
+    """
+    temp_file = target.with_name(f'.{target.name}.tmp')
+    if encoding in ('gzip', 'x-gzip'):
+        # 16 + MAX_WBITS - заголовок gzip
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        # deflate по стандарту - поток zlib, некоторые серверы передают поток без заголовка
+        with open(source, 'rb') as file:
+            header = file.read(2)
+        zlib_header = len(header) == 2 and header[0] & 0x0F == 8 and int.from_bytes(header, 'big') % 31 == 0
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS)
+    elif encoding in ('', 'identity'):
+        decompressor = None
+    else:
+        raise ValueError(f'Неизвестное сжатие ответа {encoding}')
+    with open(source, 'rb') as input_file, open(temp_file, 'wb') as output_file:
+        while chunk := input_file.read(CHUNK_SIZE):
+            output_file.write(decompressor.decompress(chunk) if decompressor is not None else chunk)
+        if decompressor is not None:
+            output_file.write(decompressor.flush())
+    os.replace(temp_file, target)
@@ -1,24 +1,143 @@
 #  Copyright (c) 2022. Tikhon Ostapenko
 import argparse
 import base64
+import datetime
+import functools
 import locale
+import multiprocessing
 import os
 import ssl
+import sys
+import tempfile
 import threading
+from pathlib import Path
 
-import openpyxl.styles.borders as borders_style
 from dotenv import load_dotenv
-from openpyxl.formatting.rule import CellIsRule
-from openpyxl.styles import Font, Side, PatternFill, Alignment, Border
-
-from vols_functions import *
+from loguru import logger
 
+from Colors import Colors as Color
+from report_layout import REPORT_PROCESSES, REPORT_TEMPLATE
+from stage_graph import STAGE_WORKERS, Stage, required_stages, run_stages
+from stage_timing import set_status, span, start_run
 # program and version
-PROGRAM_NAME: str = "gdc_vols"
-PROGRAM_VERSION: str = "0.7.2"
+from version import PROGRAM_NAME, PROGRAM_VERSION
+
+# pandas, openpyxl и модули обработки загружаются в main() после разбора аргументов: --help и подкоманды query, serve, farm запускаются без них
+WORK_BRANCH: str = "Кавказский филиал"
+# Листы отчета для выбора ключом --sheets
+SHEET_OUTPUTS = {
+    'data': 'листы исходных данных',
+    'report': 'Отчетная таблица',
+    'current_month': 'Активные мероприятия',
+    'tz': 'Нет ТЗ',
+    'sending_po': 'Нет передачи ТЗ в ПО',
+    'received_po': 'ПО не приняли ТЗ в ЕСУП',
+    'soc': 'листы Соц. соревнования (с --soc-report)',
+    'changes': 'Изменения (с --snapshot-dir)',
+}
+
+
+def build_parser(work_branch: str = WORK_BRANCH) -> argparse.ArgumentParser:
+    """Аргументы командной строки формирования отчета"""
+    parser = argparse.ArgumentParser(description=f'{PROGRAM_NAME} v.{PROGRAM_VERSION}')
+    parser.add_argument("-v", "--verbose", type=int, help="Уровень отладки: 0 - CRITICAL, 1 - ERROR, 2 - INFO, 3 - DEBUG")
+    parser.add_argument("-s", "--source-type", help="Тип источника данных (JSON, EXCEL или FILE)", default="JSON")
+    parser.add_argument("-y", "--year", type=int, help="year for processing")
+    parser.add_argument("-m", "--month", type=int, help="month for processing")
+    parser.add_argument("-r", "--report-file", help="report file name, must have .xlsx extension")
+    parser.add_argument("-b", "--report-branch", help="Branch name", default=work_branch)
+    parser.add_argument("-l", "--send-email", action='store_true', help="Режим рассылки email")
+    parser.add_argument("--no-debug", action='store_true', help="Запустить рассылку писем в \"боевом\" режиме")
+    parser.add_argument("--new-algorithm", action='store_true', help="Использовать алгоритм подсчета по принятию в эксплуатацию, вместо факта КС-2 и вводу в эксплуатацию")
+    parser.add_argument("--active-year", action='store_true', help="Формировать список активных мероприятий до конца года")
+    parser.add_argument("--soc-report", action='store_true', help="Добавить в отчет страницы Соц. соревнования")
+    parser.add_argument("--ignore-cert", action='store_true', help="Игнорировать проверку SSL сертификатов при получении данных")
+    parser.add_argument("--no-update-date", action='store_true', help="Не запрашивать дату обновления с портала")
+    parser.add_argument("--writer", choices=['openpyxl', 'xlsxwriter'], default='openpyxl',
+                        help="Библиотека записи Excel: openpyxl или xlsxwriter (режим constant_memory для больших таблиц)")
+    parser.add_argument("--parallel-save", nargs='?', type=int, const=os.cpu_count(), metavar='N',
+                        help=f"Сериализовать большие листы при сохранении в N процессах (по умолчанию {os.cpu_count()})")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Не сериализовать заново листы, не изменившиеся в сохраненном ранее файле отчета (файл записывается целиком, "
+                             "если не изменился ни один лист - не перезаписывается)")
+    parser.add_argument("--snapshot-dir", nargs='?', const='', metavar='DIR',
+                        help="Сохранять загруженные данные портала в хранилище снимков Parquet (по умолчанию папка snapshots) и формировать лист изменений")
+    parser.add_argument("--changes-only", action='store_true', help="Рассылать только мероприятия, изменившиеся с предыдущего снимка (требует --snapshot-dir)")
+    parser.add_argument("--staging-dir", help="Локальная папка, в которую сохраняется отчет перед фоновым копированием в папку отчета "
+                                              "(для сетевой папки по умолчанию используется временная папка)")
+    parser.add_argument("--report-template", nargs='?', const=REPORT_TEMPLATE, help=f"Заполнять готовый шаблон отчетной таблицы вместо оформления листа (по умолчанию {REPORT_TEMPLATE})")
+    parser.add_argument("--backend", choices=['pandas', 'polars'], default='pandas',
+                        help="Библиотека расчета показателей отчета и листов рассылки: pandas или polars (ленивые запросы)")
+    parser.add_argument("--memory-report", action='store_true', help="Выводить память процесса и размер таблиц после каждого этапа обработки")
+    parser.add_argument("--run-record", metavar='FILE', help="Сохранить замеры этапов обработки (время, процессорное время, пиковая память) в файл JSON")
+    parser.add_argument("--prometheus-textfile", metavar='FILE',
+                        help="Сохранить замеры этапов в текстовый файл метрик Prometheus (textfile collector node exporter), расширение .prom")
+    parser.add_argument("--profile", nargs='?', const='', metavar='DIR',
+                        help="Профилировать запуск: flame graph и выделение памяти по этапам в папку DIR (по умолчанию profile_<дата_время>)")
+    parser.add_argument("--stale-data", choices=['ask', 'run', 'skip'], default='ask',
+                        help="Данные портала обновлялись более 48 часов назад: ask - спросить, run - формировать отчет, skip - завершить с кодом 12")
+    parser.add_argument("--sheets", nargs='+', choices=list(SHEET_OUTPUTS), metavar='SHEET',
+                        help="Формировать только выбранные листы (и рассылку выбранных листов воронки), загружаются только нужные им данные: "
+                             + ', '.join(f'{name} - {title}' for name, title in SHEET_OUTPUTS.items()))
+    parser.add_argument("--jobs", type=int, default=STAGE_WORKERS, metavar='N',
+                        help=f"Количество потоков выполнения этапов обработки (по умолчанию {STAGE_WORKERS}, 1 - этапы по очереди в основном потоке, "
+                             "с --profile всегда 1)")
+    parser.add_argument("--download-cache", metavar='DIR',
+                        help="Папка кэша выгрузок EXCEL: неизменившиеся выгрузки не скачиваются повторно, оборванное скачивание продолжается "
+                             "(по умолчанию временная папка)")
+    parser.add_argument("--no-download-cache", action='store_true', help="Читать выгрузки EXCEL в память без кэша")
+    parser.add_argument("--result-cache", metavar='DIR',
+                        help="Папка кэша результатов расчета: показатели и листы отчета по тем же данным портала не пересчитываются, при смене ключей "
+                             "пересчитываются только зависящие от них части (по умолчанию папка кэша пользователя: %%LOCALAPPDATA%%\\gdc_vols\\results "
+                             "или ~/.cache/gdc_vols/results)")
+    parser.add_argument("--result-cache-size", type=int, default=256, metavar='MB',
+                        help="Размер папки кэша результатов, давно не использованные результаты удаляются (по умолчанию 256 МБ)")
+    parser.add_argument("--no-result-cache", action='store_true', help="Считать показатели отчета без кэша результатов")
+    responses_group = parser.add_mutually_exclusive_group()
+    responses_group.add_argument("--record", metavar='DIR', help="Сохранять исходные ответы портала и даты обновления в папку DIR (сжатые, по хэшу содержимого)")
+    responses_group.add_argument("--replay", metavar='DIR', help="Брать ответы портала и дату обновления из папки DIR, записанной ключом --record, без обращения к сети")
+    return parser
+
+
+def portal_urls(process_year: int) -> tuple:
+    """
+    Адреса данных портала за год. Адреса серверов переопределяются переменными окружения DASHBOARD_URL, DOWNLOAD_URL (тестовый стенд)
+
+    :param process_year: Год отчета
+    :return tuple: api_urls, excel_urls, file_urls, last_update_url
+    """
+    DASHBOARD_URL = os.getenv('DASHBOARD_URL', 'https://vlg-adi-web01.megafon.ru')
+    DOWNLOAD_URL = os.getenv('DOWNLOAD_URL', 'https://old.gdc-tr-tools.megafon.ru')
+
+    api_urls = {
+        # f'Расш. стр. гор.ВОЛС {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_City_211_dev',
+        f'Расш. стр. гор.ВОЛС {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_City',
+        # f'Cтр. гор.ВОЛС (РАП) {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year + 1}_FOCL_Common_Build_City',
+        # f'Реконструкция гор.ВОЛС {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Rebuild_City',
+        f'Строительство зон.ВОЛС {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_Zone',
+        # f'Реконструкция зон.ВОЛС {process_year}': f'{DASHBOARD_URL}/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Rebuild_Zone',
+    }
+
+    excel_urls = {
+        f'Расш. стр. гор.ВОЛС {process_year}': f'{DOWNLOAD_URL}/api/legacy/download?table=vw_{process_year}_FOCL_Common_Build_City&database=dashboard',
+        # f'Cтр. гор.ВОЛС (РАП) {process_year}': f'{DOWNLOAD_URL}/api/legacy/download?table=vw_{process_year + 1}_FOCL_Common_Build_City&database=dashboard',
+        # f'Реконструкция гор.ВОЛС {process_year}': f'{DOWNLOAD_URL}/api/legacy/download?table=vw_{process_year}_FOCL_Common_Rebuild_City&database=dashboard',
+        f'Строительство зон.ВОЛС {process_year}': f'{DOWNLOAD_URL}/api/legacy/download?table=vw_{process_year}_FOCL_Common_Build_Zone&database=dashboard',
+        # f'Реконструкция зон.ВОЛС {process_year}': f'{DOWNLOAD_URL}/api/legacy/download?table=vw_{process_year}_FOCL_Common_Rebuild_Zone&database=dashboard',
+    }
+
+    file_urls = {
+        f'Расш. стр. гор.ВОЛС {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'build_{process_year}.xlsx'),
+        f'Cтр. гор.ВОЛС (РАП) {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'rap_{process_year}.xlsx'),
+        f'Реконструкция гор.ВОЛС {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'rec_{process_year}.xlsx'),
+
+    }
 
+    last_update_url = f"{DASHBOARD_URL}/legacy-dash/dashboard/upd/fn_{process_year}_FOCL_Plan_Build_City()"
+    return api_urls, excel_urls, file_urls, last_update_url
 
-def main():
+
+def main(argv=None):
     # Константы
     BP = 'БП'
     BP_BUILD: str = 'Строительство ВОЛС'
@@ -44,54 +163,33 @@ def main():
     # Наименование колонки для сортировки по возрастанию
     columns_for_sort = ['Регион/Зона мероприятия', 'Планируемая дата окончания']
     columns_for_sort_active = ['Регион/Зона мероприятия', 'Категория программы', 'Планируемая дата окончания']
-    work_branch = "Кавказский филиал"
+    work_branch = WORK_BRANCH
     today_date = datetime.date.today().strftime("%Y%m%d")  # YYYYMMDD format today date
     last_days_of_month = {}
-    ext_build_df = None
-    rec_df_ = None
 
     # Set local localization
     locale.setlocale(locale.LC_ALL, '')
 
-    # Excel styles
-    fn_bold = Font(bold=True)
-    fn_red_bold = Font(color="FF0000", bold=True)
-    fn_blue_bold = Font(color="0000FF", bold=True)
-    fn_red = Font(color="B22222")
-    fn_green = Font(color="006400")
-    fn_green_bold = Font(color="006400", bold=True)
-    fn_mag = Font(color="6633FF")
-    # bd = Side(style='thick', color="000000")
-    fill_red = PatternFill(start_color='FFCCCC', end_color='FFCCCC', fill_type='solid')
-    fill_yellow = PatternFill(start_color='FFFFCC', end_color='FFFFCC', fill_type='solid')
-    fill_green = PatternFill(start_color='CCFFCC', end_color='CCFFCC', fill_type='solid')
-    align_center = Alignment(horizontal="center")
-    border_medium = Border(left=Side(style=borders_style.BORDER_MEDIUM), right=Side(style=borders_style.BORDER_MEDIUM),
-                           top=Side(style=borders_style.BORDER_MEDIUM), bottom=Side(style=borders_style.BORDER_MEDIUM))
-    border_thin = Border(left=Side(style=borders_style.BORDER_THIN), right=Side(style=borders_style.BORDER_THIN),
-                         top=Side(style=borders_style.BORDER_THIN), bottom=Side(style=borders_style.BORDER_THIN))
-
     # Parse command line arguments
-    parser = argparse.ArgumentParser(description=f'{PROGRAM_NAME} v.{PROGRAM_VERSION}')
-    parser.add_argument("-v", "--verbose", type=int, help="Уровень отладки: 0 - CRITICAL, 1 - ERROR, 2 - INFO, 3 - DEBUG")
-    parser.add_argument("-s", "--source-type", help="Тип источника данных (JSON, EXCEL или FILE)", default="JSON")
-    parser.add_argument("-y", "--year", type=int, help="year for processing")
-    parser.add_argument("-m", "--month", type=int, help="month for processing")
-    parser.add_argument("-r", "--report-file", help="report file name, must have .xlsx extension")
-    parser.add_argument("-b", "--report-branch", help="Branch name", default=work_branch)
-    parser.add_argument("-l", "--send-email", action='store_true', help="Режим рассылки email")
-    parser.add_argument("--no-debug", action='store_true', help="Запустить рассылку писем в \"боевом\" режиме")
-    parser.add_argument("--new-algorithm", action='store_true', help="Использовать алгоритм подсчета по принятию в эксплуатацию, вместо факта КС-2 и вводу в эксплуатацию")
-    parser.add_argument("--active-year", action='store_true', help="Формировать список активных мероприятий до конца года")
-    parser.add_argument("--soc-report", action='store_true', help="Добавить в отчет страницы Соц. соревнования")
-    parser.add_argument("--ignore-cert", action='store_true', help="Игнорировать проверку SSL сертификатов при получении данных")
-    parser.add_argument("--no-update-date", action='store_true', help="Не запрашивать дату обновления с портала")
-    args = parser.parse_args()
+    parser = build_parser(work_branch)
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+    from FormattedWorkbook import FormattedWorkbook
+    from vols_functions import (call_send_email, changed_events, convert_date, convert_int, convert_text, dashboard_column_types, get_update_date,
+                                last_day_of_month, publish_report, read_from_dashboard, report_frames, report_marker, report_memory, report_published,
+                                snapshot_changes)
+
+    # Copy-on-write: выборки и переименования не копируют данные, пока их не изменяют
+    pd.set_option('mode.copy_on_write', True)
 
     # Добавление суффикса к имени сохраняемого файла при задании режимов работы
     file_suffix = ''
     if any([args.new_algorithm, args.soc_report, args.active_year]):
         file_suffix = f'{" (new-algorithm)" if args.new_algorithm else ""}{" (soc-report)" if args.soc_report else ""}{" (active-year])" if args.active_year else ""}'
+    # Отчет из части листов не заменяет полный отчет
+    if args.sheets is not None:
+        file_suffix += f' ({", ".join(args.sheets)})'
 
     # Уровень отладочных сообщений
     if args.verbose is None or args.verbose == 1:
@@ -105,6 +203,28 @@ def main():
     logger.remove()
     logger.add(sys.stdout, level=logger_level)
 
+    # Замеры этапов обработки, запись сохраняется при завершении программы
+    if args.profile is not None:
+        profile_dir = Path(args.profile or f'profile_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}')
+        # Память этапов tracemalloc замеряет только в основном потоке: этапы выполняются по очереди
+        if args.jobs != 1:
+            logger.info(f'С ключом --profile этапы выполняются по очереди в основном потоке (--jobs 1 вместо {args.jobs})')
+            args.jobs = 1
+        if args.run_record is None:
+            args.run_record = str(Path(profile_dir, 'run.json'))
+    if args.run_record is not None or args.prometheus_textfile is not None:
+        try:
+            import psutil
+        except ImportError as ex:
+            logger.error(f'Для замеров этапов требуется пакет psutil: {ex}')
+            sys.exit(108)
+        start_run(PROGRAM_NAME, PROGRAM_VERSION, args.run_record, args.prometheus_textfile, psutil.Process())
+    # Профилирование всего запуска: стеки и память по этапам
+    if args.profile is not None:
+        import profiler
+        profiler.start_profile(profile_dir)
+        print(f'Профилирование запуска, результаты будут сохранены в папку {Color.GREEN}"{profile_dir}"{Color.END}')
+
     # Год анализа.
     if args.year is None:
         process_year = datetime.date.today().year
@@ -133,36 +253,25 @@ def main():
             logger.error(f'Директория для файла отчета {Path(args.report_file).parent} не существует')
             sys.exit(100)
 
+    # Отчет для сетевой папки сохраняется на локальный диск и копируется в сетевую папку в фоне.
+    # Локальная копия остается до следующего запуска и используется для сравнения в режиме --incremental
+    if args.staging_dir is not None or str(file_name).startswith(('//', '\\\\')):
+        staging_dir = Path(args.staging_dir) if args.staging_dir is not None else Path(tempfile.gettempdir(), PROGRAM_NAME)
+        try:
+            staging_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as ex:
+            logger.error(f'Не удалось создать локальную папку для отчета {staging_dir}: {ex}')
+            sys.exit(100)
+        save_file = Path(staging_dir, file_name.name)
+    else:
+        save_file = file_name
+
     if args.ignore_cert:
         check_cert = False
     else:
         check_cert = True
 
-    api_urls = {
-        # f'Расш. стр. гор.ВОЛС {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_City_211_dev',
-        f'Расш. стр. гор.ВОЛС {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_City',
-        # f'Cтр. гор.ВОЛС (РАП) {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year + 1}_FOCL_Common_Build_City',
-        # f'Реконструкция гор.ВОЛС {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Rebuild_City',
-        f'Строительство зон.ВОЛС {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Build_Zone',
-        # f'Реконструкция зон.ВОЛС {process_year}': f'https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/plan/vw_{process_year}_FOCL_Common_Rebuild_Zone',
-    }
-
-    excel_urls = {
-        f'Расш. стр. гор.ВОЛС {process_year}': f'https://old.gdc-tr-tools.megafon.ru/api/legacy/download?table=vw_{process_year}_FOCL_Common_Build_City&database=dashboard',
-        # f'Cтр. гор.ВОЛС (РАП) {process_year}': f'https://old.gdc-tr-tools.megafon.ru/api/legacy/download?table=vw_{process_year + 1}_FOCL_Common_Build_City&database=dashboard',
-        # f'Реконструкция гор.ВОЛС {process_year}': f'https://old.gdc-tr-tools.megafon.ru/api/legacy/download?table=vw_{process_year}_FOCL_Common_Rebuild_City&database=dashboard',
-        f'Строительство зон.ВОЛС {process_year}': f'https://old.gdc-tr-tools.megafon.ru/api/legacy/download?table=vw_{process_year}_FOCL_Common_Build_Zone&database=dashboard',
-        # f'Реконструкция зон.ВОЛС {process_year}': f'https://old.gdc-tr-tools.megafon.ru/api/legacy/download?table=vw_{process_year}_FOCL_Common_Rebuild_Zone&database=dashboard',
-    }
-
-    file_urls = {
-        f'Расш. стр. гор.ВОЛС {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'build_{process_year}.xlsx'),
-        f'Cтр. гор.ВОЛС (РАП) {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'rap_{process_year}.xlsx'),
-        f'Реконструкция гор.ВОЛС {process_year}': Path('//megafon.ru/KVK/KRN/Files/TelegrafFiles/ОПРС/!Проекты РЦРП/Блок №3/ВОЛС', str(process_year), 'from dashboard', f'rec_{process_year}.xlsx'),
-
-    }
-
-    last_update_url = f"https://vlg-adi-web01.megafon.ru/legacy-dash/dashboard/upd/fn_{process_year}_FOCL_Plan_Build_City()"
+    api_urls, excel_urls, file_urls, last_update_url = portal_urls(process_year)
 
     data_sheets = {
         'city_main_build': f'Осн. стр. гор.ВОЛС {process_year}',
@@ -180,6 +289,7 @@ def main():
         'received_po': 'ПО не приняли ТЗ в ЕСУП',
         'soc_build': 'Соц.соревнование. Стр.',
         'soc_rec': 'Соц. соревнование. Рек.',
+        'changes': 'Изменения',
     }
 
     reports_data = {
@@ -201,6 +311,7 @@ def main():
         report_sheets['received_po']: "received_po_not_done",
         report_sheets['soc_build']: "soc_build",
         report_sheets['soc_rec']: "soc_rec",
+        report_sheets['changes']: "changes",
     }
 
     # excel_cell_names = fill_cell_names()
@@ -287,8 +398,27 @@ def main():
 
     print(f'{Color.DARKCYAN}{datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")}:{Color.END} {PROGRAM_NAME}: {PROGRAM_VERSION}')
 
-    wb = FormattedWorkbook(logging_level=logger_level, properties_creator=EMAIL_ADDRESS)
-    ws_first = wb.active
+    if args.writer == 'xlsxwriter':
+        if args.report_template is not None or args.parallel_save is not None or args.incremental:
+            logger.error('Шаблон отчетной таблицы, параллельное и инкрементальное сохранение поддерживаются только при записи через openpyxl')
+            sys.exit(101)
+        try:
+            from ConstantMemoryWorkbook import ConstantMemoryWorkbook
+        except ImportError as ex:
+            logger.error(f'Для записи через xlsxwriter требуется пакет XlsxWriter: {ex}')
+            sys.exit(102)
+        wb = ConstantMemoryWorkbook(report_sheets['report'], logging_level=logger_level, properties_creator=EMAIL_ADDRESS)
+        ws_first = None
+    elif args.report_template is not None:
+        if not Path(args.report_template).is_file():
+            logger.error(f'Файл шаблона отчетной таблицы {args.report_template} не существует')
+            sys.exit(101)
+        wb = FormattedWorkbook.from_template(args.report_template, logging_level=logger_level, properties_creator=EMAIL_ADDRESS, save_workers=args.parallel_save,
+                                            incremental=args.incremental)
+        ws_first = None
+    else:
+        wb = FormattedWorkbook(logging_level=logger_level, properties_creator=EMAIL_ADDRESS, save_workers=args.parallel_save, incremental=args.incremental)
+        ws_first = wb.active
 
     # Получение исходных данных и запись форматированных данных
 
@@ -296,16 +426,31 @@ def main():
     ssl._create_default_https_context = ssl._create_unverified_context
     # Временно выключаем проверку сертификатов
 
+    # Запись или воспроизведение ответов портала
+    response_store = None
+    if args.record is not None or args.replay is not None:
+        from response_store import ResponseStore
+        try:
+            response_store = ResponseStore(args.replay, replay=True) if args.replay is not None else ResponseStore(args.record)
+        except (OSError, ValueError) as ex:
+            logger.error(f'Ошибка открытия папки ответов портала: {ex}')
+            sys.exit(109)
+        print(f'{"Воспроизведение" if response_store.replay else "Запись"} ответов портала: {Color.GREEN}"{response_store.directory}"{Color.END}')
+
     # Получаем дату обновления данных на портале
     date_last_update = None
     # date_last_update = datetime.datetime.now().isoformat()
     if not args.no_update_date:
-        date_last_update = get_update_date(last_update_url, check_ssl=check_cert)
-        if date_last_update is not None:
+        date_last_update = get_update_date(last_update_url, check_ssl=check_cert, store=response_store)
+        # Записанные ответы намеренно старые, возраст данных при воспроизведении не проверяется
+        if date_last_update is not None and args.replay is None:
             data_update_age = (datetime.datetime.now() - datetime.datetime.fromisoformat(date_last_update))
             if data_update_age > datetime.timedelta(hours=48):
-                if input(
-                        f'{Color.RED}Данные на портале обновлялись {data_update_age.days * 24 + data_update_age.seconds / 3600:.2f} час. назад! Хотите продолжить обработку данных (y/N)?{Color.END}').lower() != 'y':
+                stale_message = f'Данные на портале обновлялись {data_update_age.days * 24 + data_update_age.seconds / 3600:.2f} час. назад!'
+                if args.stale_data == 'skip':
+                    print(f'{Color.RED}{stale_message} Отчет не формируется{Color.END}')
+                    sys.exit(12)
+                if args.stale_data == 'ask' and input(f'{Color.RED}{stale_message} Хотите продолжить обработку данных (y/N)?{Color.END}').lower() != 'y':
                     sys.exit(12)
 
     # Получаем данные с портала
@@ -319,10 +464,89 @@ def main():
         urls = api_urls  # Скачиваем по API JSON
         input_data_type = "JSON"
 
-    for sheet, url in urls.items():
-        data_frame = read_from_dashboard(url, data_type=input_data_type, check_ssl=check_cert)  # Читаем данные из сети. Для API запросов data_type должен быть "JSON", для скачиваемых файлов "EXCEL", для локальных файлов "FILE"
+    # Кэш выгрузок EXCEL
+    download_cache = None
+    if input_data_type == "EXCEL" and response_store is None and not args.no_download_cache:
+        from download_cache import DownloadCache
+        download_dir = Path(args.download_cache) if args.download_cache is not None else Path(tempfile.gettempdir(), PROGRAM_NAME, 'downloads')
+        try:
+            download_cache = DownloadCache(download_dir)
+        except OSError as ex:
+            logger.error(f'Не удалось создать папку кэша выгрузок {download_dir}: {ex}')
+            sys.exit(112)
+
+    # Кэш результатов расчета показателей и листов отчета
+    result_cache = None
+    if not args.no_result_cache:
+        from result_cache import ResultCache, default_directory
+        result_dir = Path(args.result_cache) if args.result_cache is not None else default_directory()
+        try:
+            result_cache = ResultCache(result_dir, args.result_cache_size)
+        except OSError as ex:
+            logger.error(f'Папка кэша результатов {result_dir} не может использоваться: {ex}. Укажите другую папку --result-cache или --no-result-cache')
+            sys.exit(114)
+        result_context = {'branch': work_branch, 'year': process_year, 'backend': args.backend}
+
+    # Учет памяти по этапам обработки
+    memory_process = None
+    if args.memory_report:
+        try:
+            import psutil
+        except ImportError as ex:
+            logger.error(f'Для учета памяти требуется пакет psutil: {ex}')
+            sys.exit(107)
+        memory_process = psutil.Process()
+
+    # Расчет показателей отчета
+    compute_report_frames = report_frames
+    if args.backend == 'polars':
+        try:
+            import polars_pipeline
+        except ImportError as ex:
+            logger.error(f'Для расчета на Polars требуется пакет polars: {ex}')
+            sys.exit(106)
+        compute_report_frames = polars_pipeline.report_frames
+
+    # Хранилище снимков: каждый загруженный набор дописывается в папку с именем листа
+    # и сравнивается с предыдущим снимком этого набора
+    snapshot_dir = None
+    if args.changes_only and args.snapshot_dir is None:
+        logger.error('Рассылка только изменений требует хранилища снимков (--snapshot-dir)')
+        sys.exit(104)
+    if args.snapshot_dir is not None:
+        # pyarrow - обязательная зависимость (строки Arrow в convert_text), отдельной проверки не требуется
+        import snapshot_store
+        snapshot_dir = Path(args.snapshot_dir or snapshot_store.SNAPSHOT_DIR)
+        snapshot_time = datetime.datetime.now()
+
+    if args.sheets is not None and ('soc' in args.sheets and not args.soc_report or 'changes' in args.sheets and snapshot_dir is None):
+        logger.error('Листы Соц. соревнования формируются только с --soc-report, лист изменений - только с --snapshot-dir')
+        sys.exit(111)
+
+    # Этапы формирования отчета. Источники данных, роль которых в расчете отчета и имя листа исходных данных
+    source_roles = {
+        f'Расш. стр. гор.ВОЛС {process_year}': 'build',
+        f'Cтр. гор.ВОЛС (РАП) {process_year}': 'ext',
+        f'Реконструкция гор.ВОЛС {process_year}': 'rec',
+    }
+    source_sheets = {
+        f'Расш. стр. гор.ВОЛС {process_year}': data_sheets['city_main_build'],
+        f'Cтр. гор.ВОЛС (РАП) {process_year}': data_sheets['city_ext_build'],
+    }
+
+    # Схема колонок ответа API портала: даты и текст приводятся к типам при декодировании
+    column_types = dashboard_column_types(process_columns)
+
+    def fetch(url):
+        # Читаем данные из сети. Для API запросов data_type должен быть "JSON", для скачиваемых файлов "EXCEL", для локальных файлов "FILE"
+        return read_from_dashboard(url, data_type=input_data_type, check_ssl=check_cert, store=response_store, column_types=column_types,
+                                   downloads=download_cache)
+
+    def prepare(sheet, data_frame):
         if process_columns['branch'] in data_frame.columns:
-            data_frame = data_frame[data_frame[process_columns['branch']] == work_branch]  # Оставляем только отчётный филиал
+            with span('filter', sheet=sheet):
+                # Оставляем только отчётный филиал. Текст ответа API уже в строках Arrow: пустой филиал дает в маске <NA>
+                data_frame = data_frame[(data_frame[process_columns['branch']] == work_branch).fillna(False)]
         else:
             print(f'{Color.RED}Не корректный формат входящих данных. Проверьте корректность данных для {sheet}!{Color.END}')
             sys.exit(2)
@@ -337,679 +561,92 @@ def main():
             elif sheet == f'Реконструкция гор.ВОЛС {process_year}':
                 data_frame.rename(columns=file_rename_columns_rec, inplace=True)
 
-        data_frame = data_frame.reset_index(drop=True)
-        data_frame = convert_date(data_frame, columns_date)  # Переводим дату в формат datetime
-        data_frame = convert_int(data_frame, columns_digit)  # Переводим ESUP_ID в числовой формат
-        data_frame = data_frame.sort_values(by=columns_for_sort)  # Сортируем по заданному столбцу
-        if sheet == f'Расш. стр. гор.ВОЛС {process_year}':
-            extended_build_df = data_frame.copy(deep=True)  # keep extended data for analyses
-            # Формируем таблицу основного строительства
-            # main_build_df = data_frame[data_frame['KPI ПТР текущего года, км'].notna() & (data_frame['KPI ПТР текущего года, км'] > 0)]
-            main_build_df = data_frame
-            if not main_build_df.empty:
-                print(f'Создаем лист: {Color.GREEN}"{data_sheets["city_main_build"]}"{Color.END}')
-                wb.excel_format_table(
-                    main_build_df,
-                    data_sheets['city_main_build'],
-                    excel_tables_names[data_sheets['city_main_build']],
-                )
-            # Формируем таблицу дополнительного строительства
-            # ext_build_df = data_frame[~data_frame['KPI ПТР текущего года, км'].notna() | (data_frame['KPI ПТР текущего года, км'] == 0)]
-        elif sheet == f'Cтр. гор.ВОЛС (РАП) {process_year}':
-            ext_build_df = data_frame
-            if not ext_build_df.empty:
-                print(f'Создаем лист: {Color.GREEN}"{data_sheets["city_ext_build"]}"{Color.END}')
-                wb.excel_format_table(
-                    ext_build_df,
-                    data_sheets['city_ext_build'],
-                    excel_tables_names[data_sheets['city_ext_build']],
-                )
-        else:
-            if sheet == f'Реконструкция гор.ВОЛС {process_year}':
-                rec_df_ = data_frame
-            if not data_frame.empty:
-                print(f'Создаем лист: {Color.GREEN}"{sheet}"{Color.END}')
-                wb.excel_format_table(
-                    data_frame,
-                    sheet,
-                    excel_tables_names[sheet],
-                )
-
-    # Создание отчёта
-    print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["report"]}"{Color.END}')
-    for i in range(1, 13):
-        last_days_of_month[i] = pd.Timestamp(last_day_of_month(datetime.datetime(process_year, i, 1)))
-    try:
-        ws = wb[report_sheets['report']]
-    except KeyError:
-        logger.info(f"Лист \"{report_sheets['report']}\" не существует. Создаем... ")
-        ws = wb.create_sheet(title=report_sheets['report'], index=0)
-
-    # Формирование статических полей отчёта
-    if date_last_update is not None:
-        ws['K1'] = "Дата обновления данных"
-        ws['L1'] = datetime.datetime.fromisoformat(date_last_update).strftime("%d.%m.%Y %H:%M:%S")
-        ws['L1'].font = fn_green_bold
-        ws['L1'].alignment = align_center
-    ws['A1'] = "Основное строительство ВОЛС"
-    ws['A1'].font = fn_blue_bold
-    ws['A1'].border = border_thin
-    ws['A2'] = 'Всего мероприятий'
-    ws['A2'].border = border_medium
-    ws['A4'] = 'Исполнение KPI ВОЛС КФ (накопительный итог)'
-    ws['A4'].font = fn_blue_bold
-    ws['A4'].border = border_thin
-    ws['A6'] = 'Учтенных ВОЛС в KPI'
-    ws['A6'].border = border_medium
-    ws['A8'] = 'Исполнение мероприятий в ЕСУП'
-    ws['A8'].font = fn_blue_bold
-    ws['A8'].border = border_thin
-    ws['A9'] = 'Наименование мероприятия'
-    ws['A9'].font = fn_bold
-    ws['A9'].border = border_medium
-    ws['A10'] = 'Выпущены ТЗ'
-    ws['A10'].border = border_medium
-    ws['A11'] = 'Переданы ТЗ в ПО'
-    ws['A11'].border = border_medium
-    ws['A12'] = 'Приняты ТЗ ПО'
-    ws['A12'].border = border_medium
-    ws['A13'] = 'Подписание договора на ПИР/ПИР+СМР'
-    ws['A13'].border = border_medium
-    ws['A14'] = 'Линейная схема'
-    ws['A14'].border = border_medium
-    ws['A15'] = 'Получено ТУ'
-    ws['A15'].border = border_medium
-    ws['A16'] = 'Строительство трассы'
-    ws['A16'].border = border_medium
-    ws['A17'] = 'Подготовка актов КС-2,3'
-    ws['A17'].border = border_medium
-    ws['A18'] = 'Приёмка ВОЛС в эксплуатацию'
-    ws['A18'].border = border_medium
-    ws['B9'] = 'Выполнено'
-    ws['B9'].font = fn_bold
-    ws['B9'].alignment = align_center
-    ws['B9'].border = border_medium
-    ws['C9'] = DELTA_CHAR
-    ws['C9'].font = fn_bold
-    ws['C9'].alignment = align_center
-    ws['C9'].border = border_medium
-
-    if ext_build_df is not None:
-        ws['A21'] = "Дополнительное строительство ВОЛС"
-        ws['A21'].font = fn_blue_bold
-        ws['A21'].border = border_thin
-        ws['A22'] = 'Всего мероприятий'
-        ws['A22'].border = border_medium
-        ws['A24'] = 'Исполнение KPI ВОЛС КФ (накопительный итог)'
-        ws['A24'].font = fn_blue_bold
-        ws['A24'].border = border_thin
-        ws['A26'] = 'Учтенных ВОЛС в KPI'
-        ws['A26'].border = border_medium
-        ws['A28'] = 'Исполнение мероприятий в ЕСУП'
-        ws['A28'].font = fn_blue_bold
-        ws['A28'].border = border_thin
-        ws['A29'] = 'Наименование мероприятия'
-        ws['A29'].font = fn_bold
-        ws['A29'].border = border_medium
-        ws['A30'] = 'Выпущены ТЗ'
-        ws['A30'].border = border_medium
-        ws['A31'] = 'Переданы ТЗ в ПО'
-        ws['A31'].border = border_medium
-        ws['A32'] = 'Приняты ТЗ ПО'
-        ws['A32'].border = border_medium
-        ws['A33'] = 'Подписание договора на ПИР/ПИР+СМР'
-        ws['A33'].border = border_medium
-        ws['A34'] = 'Линейная схема'
-        ws['A34'].border = border_medium
-        ws['A35'] = 'Получено ТУ'
-        ws['A35'].border = border_medium
-        ws['A36'] = 'Строительство трассы'
-        ws['A36'].border = border_medium
-        ws['A37'] = 'Подготовка актов КС-2,3'
-        ws['A37'].border = border_medium
-        ws['A38'] = 'Приёмка ВОЛС в эксплуатацию'
-        ws['A38'].border = border_medium
-        ws['B29'] = 'Выполнено'
-        ws['B29'].font = fn_bold
-        ws['B29'].alignment = align_center
-        ws['B29'].border = border_medium
-        ws['C29'] = DELTA_CHAR
-        ws['C29'].font = fn_bold
-        ws['C29'].alignment = align_center
-        ws['C29'].border = border_medium
-
-    if rec_df_ is not None:
-        ws['F1'] = "Реконструкция ВОЛС"
-        ws['F1'].font = fn_blue_bold
-        ws['F1'].border = border_thin
-        ws['F2'] = 'Всего мероприятий'
-        ws['F2'].border = border_medium
-        ws['F2'].border = border_medium
-        ws['F4'] = 'Исполнение KPI ВОЛС КФ (накопительный итог)'
-        ws['F4'].font = fn_blue_bold
-        ws['F4'].border = border_thin
-        ws['F6'] = 'Учтенных ВОЛС в KPI'
-        ws['F6'].border = border_medium
-        ws['F8'] = 'Исполнение мероприятий в ЕСУП'
-        ws['F8'].font = fn_blue_bold
-        ws['F8'].border = border_thin
-        ws['F9'] = 'Наименование мероприятия'
-        ws['F9'].font = fn_bold
-        ws['F9'].border = border_medium
-        ws['F10'] = 'Выпущены ТЗ'
-        ws['F10'].border = border_medium
-        ws['F11'] = 'Переданы ТЗ в ПО'
-        ws['F11'].border = border_medium
-        ws['F12'] = 'Приняты ТЗ ПО'
-        ws['F12'].border = border_medium
-        ws['F13'] = 'Подписание договора на ПИР/ПИР+СМР'
-        ws['F13'].border = border_medium
-        ws['F14'] = 'Линейная схема'
-        ws['F14'].border = border_medium
-        ws['F15'] = 'Получено ТУ'
-        ws['F15'].border = border_medium
-        ws['F16'] = 'Строительство трассы'
-        ws['F16'].border = border_medium
-        ws['F17'] = 'Подготовка актов КС-2,3'
-        ws['F17'].border = border_medium
-        ws['F18'] = 'Приёмка ВОЛС в эксплуатацию'
-        ws['F18'].border = border_medium
-        ws['G9'] = 'Выполнено'
-        ws['G9'].font = fn_bold
-        ws['G9'].alignment = align_center
-        ws['G9'].border = border_medium
-        ws['H9'] = DELTA_CHAR
-        ws['H9'].font = fn_bold
-        ws['H9'].alignment = align_center
-        ws['H9'].border = border_medium
-
-    # Поля для целевых мероприятий по Base Case
-    ws['A41'] = "Целевые мероприятия Base Case ВОЛС"
-    ws['A41'].font = fn_blue_bold
-    ws['A41'].border = border_thin
-    ws['A42'] = 'Всего мероприятий'
-    ws['A42'].border = border_medium
-    ws['A44'] = 'Исполнение KPI Base Case (накопительный итог)'
-    ws['A44'].font = fn_blue_bold
-    ws['A44'].border = border_thin
-    ws['A46'] = 'Учтенных ВОЛС в KPI'
-    ws['A46'].border = border_medium
-    ws['A48'] = 'Исполнение мероприятий в ЕСУП'
-    ws['A48'].font = fn_blue_bold
-    ws['A48'].border = border_thin
-    ws['A49'] = 'Наименование мероприятия'
-    ws['A49'].font = fn_bold
-    ws['A49'].border = border_medium
-    ws['A50'] = 'Выпущены ТЗ'
-    ws['A50'].border = border_medium
-    ws['A51'] = 'Переданы ТЗ в ПО'
-    ws['A51'].border = border_medium
-    ws['A52'] = 'Приняты ТЗ ПО'
-    ws['A52'].border = border_medium
-    ws['A53'] = 'Подписание договора на ПИР/ПИР+СМР'
-    ws['A53'].border = border_medium
-    ws['A54'] = 'Линейная схема'
-    ws['A54'].border = border_medium
-    ws['A55'] = 'Получено ТУ'
-    ws['A55'].border = border_medium
-    ws['A56'] = 'Строительство трассы'
-    ws['A56'].border = border_medium
-    ws['A57'] = 'Подготовка актов КС-2,3'
-    ws['A57'].border = border_medium
-    ws['A58'] = 'Приёмка ВОЛС в эксплуатацию'
-    ws['A58'].border = border_medium
-    ws['B49'] = 'Выполнено'
-    ws['B49'].font = fn_bold
-    ws['B49'].alignment = align_center
-    ws['B49'].border = border_medium
-    ws['C49'] = DELTA_CHAR
-    ws['C49'].font = fn_bold
-    ws['C49'].alignment = align_center
-    ws['C49'].border = border_medium
-
-    # Формирование динамических полей отчёта
-    ws['B5'] = f'План, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['B5'].font = fn_bold
-    ws['B5'].alignment = align_center
-    ws['B5'].border = border_medium
-    ws['C5'] = f'Факт, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['C5'].font = fn_bold
-    ws['C5'].alignment = align_center
-    ws['C5'].border = border_medium
-    ws['D5'] = f'{chr(0x0394)}, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['D5'].font = fn_bold
-    ws['D5'].alignment = align_center
-    ws['D5'].border = border_medium
-
-    if ext_build_df is not None:
-        ws['B25'] = f'План, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['B25'].font = fn_bold
-        ws['B25'].alignment = align_center
-        ws['B25'].border = border_medium
-        ws['C25'] = f'Факт, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['C25'].font = fn_bold
-        ws['C25'].alignment = align_center
-        ws['C25'].border = border_medium
-        ws['D25'] = f'{chr(0x0394)}, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['D25'].font = fn_bold
-        ws['D25'].alignment = align_center
-        ws['D25'].border = border_medium
-
-    if rec_df_ is not None:
-        ws['G5'] = f'План, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['G5'].font = fn_bold
-        ws['G5'].alignment = align_center
-        ws['G5'].border = border_medium
-        ws['H5'] = f'Факт, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['H5'].font = fn_bold
-        ws['H5'].alignment = align_center
-        ws['H5'].border = border_medium
-        ws['I5'] = f'{chr(0x0394)}, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-        ws['I5'].font = fn_bold
-        ws['I5'].alignment = align_center
-        ws['I5'].border = border_medium
-
-    ws['B45'] = f'План, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['B45'].font = fn_bold
-    ws['B45'].alignment = align_center
-    ws['B45'].border = border_medium
-    ws['C45'] = f'Факт, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['C45'].font = fn_bold
-    ws['C45'].alignment = align_center
-    ws['C45'].border = border_medium
-    ws['D45'] = f'{chr(0x0394)}, {datetime.date(process_year, process_month, 1).strftime("%b %Y")}'
-    ws['D45'].font = fn_bold
-    ws['D45'].alignment = align_center
-    ws['D45'].border = border_medium
-
-    # Анализ строительства ВОЛС
-    # TODO: Необходимо переделать генерацию отчетной страницы на процедуры или классы
-    df = extended_build_df.copy(deep=True)
-
-    # main_build_df = df[df['KPI ПТР текущего года, км'].notnull() & (df['KPI ПТР текущего года, км'] > 0)]
-    # main_build_df = df
-    # ext_build_df = df
-
-    if ext_build_df is not None:
-        df = pd.concat([main_build_df, ext_build_df], ignore_index=True).reset_index(drop=True)
-
-    # kpi_build_df = main_build_df[main_build_df[process_columns['program']].str.match(r'.*Base Case.*')]
-    kpi_build_df = main_build_df[(main_build_df[process_columns['program_category']] == 'Доступ') | (main_build_df[process_columns['program_category']] == 'Дискреты_целевые')]
-
-    build_dashboard_data = df.copy(deep=True)
-    tz_build_dataframe = df[df[process_columns['tz_status']] != 'Исполнена']
-    sending_po_build_dataframe = df[df[process_columns['send_tz_status']] != 'Исполнена']
-    received_po_build_dataframe = df[df[process_columns['received_tz_status']] != 'Исполнена']
-
-    ws['B2'] = main_build_df[process_columns['plan_date']].count()
-    ws['B2'].font = fn_bold
-    ws['B2'].alignment = align_center
-    ws['B2'].border = border_medium
-    # ws['B6'] = sum_sort_month_events(main_build_df, process_columns['plan_date'], process_month, last_days_of_month)
-    ws['B6'] = main_build_df[(main_build_df[process_columns['plan_date']] != '') & (
-            main_build_df[process_columns['plan_date']] <= last_days_of_month[process_month])][process_columns['plan_date']].count()
-    ws['B6'].alignment = align_center
-    ws['B6'].border = border_medium
-
-    if not args.new_algorithm:
-        ws['C6'] = main_build_df[(main_build_df[process_columns['commissioning_date']] != '') & (
-                main_build_df[process_columns['commissioning_date']] <= last_days_of_month[process_month]) & (main_build_df[process_columns['ks2_date']] != '') & (
-                                         main_build_df[process_columns['ks2_date']] <= last_days_of_month[process_month])][process_columns['commissioning_date']].count()
-    else:
-        ws['C6'] = main_build_df[(main_build_df[process_columns['complete_date']] != '') & (
-                main_build_df[process_columns['complete_date']] <= last_days_of_month[process_month])][process_columns['complete_date']].count()
-    ws['C6'].alignment = align_center
-    ws['C6'].border = border_medium
-    ws['D6'] = ws['C6'].value - ws['B6'].value
-    ws['D6'].alignment = align_center
-    ws['D6'].border = border_medium
-    ws.conditional_formatting.add('D6', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-    ws.conditional_formatting.add('D6', CellIsRule(operator='greaterThan', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-    ws.conditional_formatting.add('D6', CellIsRule(operator='equal', formula=['0'], stopIfTrue=True, font=fn_mag, fill=fill_yellow))
-
-    if ext_build_df is not None:
-        ws['B22'] = ext_build_df[process_columns['plan_date']].count()
-        ws['B22'].font = fn_bold
-        ws['B22'].alignment = align_center
-        ws['B22'].border = border_medium
-        # ws['B26'] = sum_sort_month_events(ext_build_df, process_columns['plan_date'], process_month, last_days_of_month)
-        ws['B26'] = ext_build_df[(ext_build_df[process_columns['plan_date']] != '') & (
-                ext_build_df[process_columns['plan_date']] <= last_days_of_month[process_month])][process_columns['plan_date']].count()
-        ws['B26'].alignment = align_center
-        ws['B26'].border = border_medium
-        if not args.new_algorithm:
-            ws['C26'] = ext_build_df[
-                (ext_build_df[process_columns['commissioning_date']] != '') & (ext_build_df[process_columns['commissioning_date']] <= last_days_of_month[process_month]) & (
-                        ext_build_df[process_columns['ks2_date']] != '') & (ext_build_df[process_columns['ks2_date']] <= last_days_of_month[process_month])][
-                process_columns['commissioning_date']].count()
-        else:
-            ws['C26'] = ext_build_df[(ext_build_df[process_columns['complete_date']] != '') & (
-                    ext_build_df[process_columns['complete_date']] <= last_days_of_month[process_month])][process_columns['complete_date']].count()
-        ws['C26'].alignment = align_center
-        ws['C26'].border = border_medium
-        ws['D26'] = ws['C26'].value - ws['B26'].value
-        ws['D26'].alignment = align_center
-        ws['D26'].border = border_medium
-        ws.conditional_formatting.add('D26', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-        ws.conditional_formatting.add('D26', CellIsRule(operator='greaterThan', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-        ws.conditional_formatting.add('D26', CellIsRule(operator='equal', formula=['0'], stopIfTrue=True, font=fn_mag, fill=fill_yellow))
-
-    ws['B42'] = kpi_build_df[process_columns['plan_date']].count()
-    ws['B42'].font = fn_bold
-    ws['B42'].alignment = align_center
-    ws['B42'].border = border_medium
-    # ws['B46'] = sum_sort_month_events(kpi_build_df, process_columns['plan_date'], process_month, last_days_of_month)
-    ws['B46'] = kpi_build_df[(kpi_build_df[process_columns['plan_date']] != '') & (
-            kpi_build_df[process_columns['plan_date']] <= last_days_of_month[process_month])][process_columns['plan_date']].count()
-    ws['B46'].alignment = align_center
-    ws['B46'].border = border_medium
-    if not args.new_algorithm:
-        ws['C46'] = kpi_build_df[
-            (kpi_build_df[process_columns['commissioning_date']] != '') & (kpi_build_df[process_columns['commissioning_date']] <= last_days_of_month[process_month]) & (
-                    kpi_build_df[process_columns['ks2_date']] != '') & (kpi_build_df[process_columns['ks2_date']] <= last_days_of_month[process_month])][
-            process_columns['commissioning_date']].count()
-    else:
-        ws['C46'] = kpi_build_df[(kpi_build_df[process_columns['complete_date']] != '') & (
-                kpi_build_df[process_columns['complete_date']] <= last_days_of_month[process_month])][process_columns['complete_date']].count()
-    ws['C46'].alignment = align_center
-    ws['C46'].border = border_medium
-    ws['D46'] = ws['C46'].value - ws['B46'].value
-    ws['D46'].alignment = align_center
-    ws['D46'].border = border_medium
-    ws.conditional_formatting.add('D46', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-    ws.conditional_formatting.add('D46', CellIsRule(operator='greaterThan', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-    ws.conditional_formatting.add('D46', CellIsRule(operator='equal', formula=['0'], stopIfTrue=True, font=fn_mag, fill=fill_yellow))
-
-    for i, process in zip(range(10, 19), ['tz_status',
-                                          'send_tz_status',
-                                          'received_tz_status',
-                                          'pir_smr_status',
-                                          'line_scheme_status',
-                                          'tu_status',
-                                          'build_status',
-                                          'ks2_status',
-                                          'commissioning_status',
-                                          ]):
-        ws[f'B{i}'] = sum_sort_events(main_build_df, process_columns[process], ['Исполнена', 'Не требуется'])
-        ws[f'B{i}'].alignment = align_center
-        ws[f'B{i}'].border = border_medium
-    for i in range(10, 19):
-        ws[f'C{i}'] = ws[f'B{i}'].value - ws['B2'].value
-        ws[f'C{i}'].alignment = align_center
-        ws[f'C{i}'].border = border_medium
-        ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='greaterThanOrEqual', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-        ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-
-        if ext_build_df is not None:
-            for i, process in zip(range(30, 39), ['tz_status',
-                                                  'send_tz_status',
-                                                  'received_tz_status',
-                                                  'pir_smr_status',
-                                                  'line_scheme_status',
-                                                  'tu_status',
-                                                  'build_status',
-                                                  'ks2_status',
-                                                  'commissioning_status',
-                                                  ]):
-                ws[f'B{i}'] = sum_sort_events(ext_build_df, process_columns[process], ['Исполнена', 'Не требуется'])
-                ws[f'B{i}'].alignment = align_center
-                ws[f'B{i}'].border = border_medium
-            for i in range(30, 39):
-                ws[f'C{i}'] = ws[f'B{i}'].value - ws['B22'].value
-                ws[f'C{i}'].alignment = align_center
-                ws[f'C{i}'].border = border_medium
-                ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='greaterThanOrEqual', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-                ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-
-    for i, process in zip(range(50, 59), ['tz_status',
-                                          'send_tz_status',
-                                          'received_tz_status',
-                                          'pir_smr_status',
-                                          'line_scheme_status',
-                                          'tu_status',
-                                          'build_status',
-                                          'ks2_status',
-                                          'commissioning_status',
-                                          ]):
-        ws[f'B{i}'] = sum_sort_events(kpi_build_df, process_columns[process], ['Исполнена', 'Не требуется'])
-        ws[f'B{i}'].alignment = align_center
-        ws[f'B{i}'].border = border_medium
-    for i in range(50, 59):
-        ws[f'C{i}'] = ws[f'B{i}'].value - ws['B42'].value
-        ws[f'C{i}'].alignment = align_center
-        ws[f'C{i}'].border = border_medium
-        ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='greaterThanOrEqual', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-        ws.conditional_formatting.add(f'C{i}', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-
-    # Анализ реконструкции ВОЛС
-    if rec_df_ is not None:
-        df = rec_df_
-        rec_df = df
-        tz_rec_df = df[df[process_columns['tz_status2']] != 'Исполнена']
-        sending_po_rec_df = df[df[process_columns['send_tz_status2']] != 'Исполнена']
-        received_po_rec_df = df[df[process_columns['received_tz_status2']] != 'Исполнена']
-
-        ws['G2'] = df[process_columns['plan_date']].count()
-        ws['G2'].font = fn_bold
-        ws['G2'].alignment = align_center
-        ws['G2'].border = border_medium
-        # ws['G6'] = sum_sort_month_events(df, process_columns['plan_date'], process_month, last_days_of_month)
-        ws['G6'] = rec_df[(rec_df[process_columns['plan_date']] != '') & (rec_df[process_columns['plan_date']] <= last_days_of_month[process_month])][
-            process_columns['plan_date']].count()
-        ws['G6'].alignment = align_center
-        ws['G6'].border = border_medium
-        if not args.new_algorithm:
-            ws['H6'] = rec_df[(rec_df[process_columns['commissioning_date2']] != '') & (
-                    rec_df[process_columns['commissioning_date2']] <= last_days_of_month[process_month]) & (rec_df[process_columns['ks2_date2']] != '') & (
-                                      rec_df[process_columns['ks2_date2']] <= last_days_of_month[process_month])][process_columns['commissioning_date2']].count()
-        else:
-            ws['H6'] = rec_df[(rec_df[process_columns['complete_date2']] != '') & (rec_df[process_columns['complete_date2']] <= last_days_of_month[process_month])][
-                process_columns['complete_date2']].count()
-        ws['H6'].alignment = align_center
-        ws['H6'].border = border_medium
-
-        ws['I6'] = ws['H6'].value - ws['G6'].value
-        ws['I6'].alignment = align_center
-        ws['I6'].border = border_medium
-        ws.conditional_formatting.add('I6', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-        ws.conditional_formatting.add('I6', CellIsRule(operator='greaterThan', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-        ws.conditional_formatting.add('I6', CellIsRule(operator='equal', formula=['0'], stopIfTrue=True, font=fn_mag, fill=fill_yellow))
-
-        for i, process in zip(range(10, 19), ['tz_status2',
-                                              'send_tz_status2',
-                                              'received_tz_status2',
-                                              'pir_smr_status2',
-                                              'line_scheme_status2',
-                                              'tu_status2',
-                                              'build_status2',
-                                              'ks2_status2',
-                                              'commissioning_status2']):
-            ws[f'G{i}'] = sum_sort_events(df, process_columns[process], ['Исполнена', 'Не требуется'])
-            ws[f'G{i}'].alignment = align_center
-            ws[f'G{i}'].border = border_medium
-            ws[f'G{i}'].border = border_medium
-        for i in range(10, 19):
-            ws[f'H{i}'] = ws[f'G{i}'].value - ws['G2'].value
-            # ws[f'H{i}'] = f'=G{i}-G2'
-            ws[f'H{i}'].alignment = align_center
-            ws[f'H{i}'].border = border_medium
-            ws.conditional_formatting.add(f'H{i}', CellIsRule(operator='greaterThanOrEqual', formula=['0'], stopIfTrue=True, font=fn_green, fill=fill_green))
-            ws.conditional_formatting.add(f'H{i}', CellIsRule(operator='lessThan', formula=['0'], stopIfTrue=True, font=fn_red, fill=fill_red))
-    ws = adjust_columns_width(ws)
-
-    # Создание листов для рассылки
-
-    # Создание листа Активные мероприятия строительства месяца отчёта
-    # маска для текущего месяца
-    if not args.active_year:
-        curr_month_bool_mask = (build_dashboard_data[process_columns['plan_date']] <= last_days_of_month[process_month].strftime('%Y-%m-%d'))
-    else:
-        curr_month_bool_mask = (build_dashboard_data[process_columns['plan_date']] <= last_days_of_month[12].strftime('%Y-%m-%d'))
-    # маска для не "Исполнена" или не "Не требуется"
-    if not args.new_algorithm:
-        curr_status_bool_mask = (~build_dashboard_data[process_columns['commissioning_status']].str.contains('Исполнена|Не требуется', regex=True)) | (
-            ~build_dashboard_data[process_columns['ks2_status']].str.contains('Исполнена|Не требуется', regex=True))
-    else:
-        curr_status_bool_mask = (
-                    (build_dashboard_data[process_columns['complete_date']].isna()) & (build_dashboard_data[process_columns['plan_date']] <= last_days_of_month[process_month]))
-
-    # Выборка объектов строительства по маскам
-    current_month_build_dataframe = build_dashboard_data[curr_month_bool_mask & curr_status_bool_mask]
-    current_month_build_dataframe = current_month_build_dataframe[[process_columns['id'],
-                                                                   process_columns['program_category'],
-                                                                   process_columns['work_type'],
-                                                                   process_columns['region'],
-                                                                   process_columns['name'],
-                                                                   process_columns['plan_date'],
-                                                                   process_columns['prognoz_date'],
-                                                                   process_columns['program'],
-                                                                   process_columns['po'],
-                                                                   ]]
-    current_month_build_dataframe[BP] = BP_BUILD
-
-    # маска для текущего месяца
-    if rec_df_ is not None:
-        if not args.active_year:
-            curr_month_bool_mask = (rec_df[process_columns['plan_date']] <= last_days_of_month[process_month].strftime('%Y-%m-%d'))
-        else:
-            curr_month_bool_mask = (rec_df[process_columns['plan_date']] <= last_days_of_month[12].strftime('%Y-%m-%d'))
-        # маска для не "Исполнена" или не "Не требуется"
-        if not args.new_algorithm:
-            curr_status_bool_mask = (~rec_df[process_columns['commissioning_status2']].str.contains('Исполнена|Не требуется', regex=True)) | (
-                ~rec_df[process_columns['ks2_status2']].str.contains('Исполнена|Не требуется', regex=True))
+        with span('convert', sheet=sheet):
+            data_frame = data_frame.reset_index(drop=True)
+            data_frame = convert_date(data_frame, columns_date)  # Переводим дату в формат datetime
+            data_frame = convert_int(data_frame, columns_digit)  # Переводим ESUP_ID в числовой формат
+            data_frame = convert_text(data_frame)  # Переводим текстовые поля в строки Arrow
+            data_frame = data_frame.sort_values(by=columns_for_sort)  # Сортируем по заданному столбцу
+        report_memory(memory_process, f'Загрузка {sheet}', {sheet: data_frame})
+        return data_frame
+
+    def snapshot(sheet, data_frame):
+        try:
+            with span('snapshot', sheet=sheet):
+                added, removed = snapshot_store.append_snapshot(data_frame, snapshot_dir, sheet, snapshot_time)
+                print(f'Снимок {Color.GREEN}"{sheet}"{Color.END} сохранен в хранилище: новых версий строк {added}, удаленных {removed}')
+                previous_snapshot = snapshot_store.snapshot_at(snapshot_dir, sheet, snapshot_time, before=True)
+                if previous_snapshot.empty:
+                    print(f'Предыдущего снимка {Color.GREEN}"{sheet}"{Color.END} нет, изменения не считаются')
+                elif added or removed:
+                    changes = snapshot_changes(previous_snapshot,
+                                               snapshot_store.snapshot_at(snapshot_dir, sheet, snapshot_time),
+                                               [column for key, column in process_columns.items() if 'status' in key],
+                                               [process_columns['plan_date'], process_columns['prognoz_date']],
+                                               [process_columns['region'], process_columns['name']],
+                                               process_columns['id'])
+                    changes.insert(0, 'Источник', sheet)
+                    return changes
+        except Exception as ex:
+            logger.error(f'Ошибка записи снимка "{sheet}" в хранилище {snapshot_dir}: {ex}')
+        return None
+
+    def collect_changes(*changes_dataframes):
+        # Изменения с предыдущего снимка
+        changes_dataframes = [changes for changes in changes_dataframes if changes is not None]
+        if changes_dataframes:
+            changes_dataframe = pd.concat(changes_dataframes, ignore_index=True)
         else:
-            curr_status_bool_mask = (rec_df[process_columns['complete_date2']].isna()) & (rec_df[process_columns['plan_date']] <= last_days_of_month[process_month])
-
-        # Выборка объектов реконструкции по маскам
-        current_month_reconstruction_dataframe = rec_df[curr_month_bool_mask & curr_status_bool_mask]
-        current_month_reconstruction_dataframe = current_month_reconstruction_dataframe[[process_columns['id'],
-                                                                                         process_columns['program_category'],
-                                                                                         process_columns['work_type'],
-                                                                                         process_columns['region'],
-                                                                                         process_columns['name'],
-                                                                                         process_columns['plan_date'],
-                                                                                         process_columns['prognoz_date'],
-                                                                                         process_columns['program'],
-                                                                                         process_columns['po'],
-                                                                                         ]]
-        current_month_reconstruction_dataframe[BP] = BP_RECON  # Добавляем столбец с названием бизнес-процесса
-
-    # Объединяем стройку и реконструкцию
-    if rec_df_ is not None:
-        current_month_dataframe = pd.concat([current_month_build_dataframe, current_month_reconstruction_dataframe], ignore_index=True).reset_index(drop=True).sort_values(
-            by=columns_for_sort_active)
-    else:
-        current_month_dataframe = current_month_build_dataframe
-
-    if not current_month_dataframe.empty:
-        print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["current_month"]}"{Color.END}')
-        wb.excel_format_table(current_month_dataframe, report_sheets['current_month'], excel_tables_names[report_sheets['current_month']])
-
-    # Создание листа Нет ТЗ
-    # формируем таблицы ТЗ для стройки и реконструкции
-    #
-    tz_build_dataframe = tz_build_dataframe[[process_columns['id'],
-                                             process_columns['region'],
-                                             process_columns['name'],
-                                             process_columns['plan_date'],
-                                             process_columns['program'],
-                                             ]]
-    tz_build_dataframe[BP] = BP_BUILD
-    if rec_df_ is not None:
-        tz_rec_df = tz_rec_df[[process_columns['id'],
-                               process_columns['region'],
-                               process_columns['name'],
-                               process_columns['plan_date'],
-                               process_columns['program'],
-                               ]]
-        tz_rec_df[BP] = BP_RECON
-        # Объединяем ТЗ стройки и реконструкции
-        tz_dataframe = pd.concat([tz_build_dataframe, tz_rec_df], ignore_index=True).reset_index(drop=True).sort_values(by=columns_for_sort)
-    else:
-        tz_dataframe = tz_build_dataframe
-
-    # write_report_table_to_file(tz_dataframe, file_name, report_sheets['tz'], excel_tables_names, excel_cell_names,
-    #                            table_style)
-    if not tz_dataframe.empty:
-        if args.send_email:
-            threading.Thread(target=call_send_email, args=(tz_dataframe, reports_data['tz'], args.no_debug, EMAIL_ADDRESS, EMAIL_PASSWORD, date_last_update)).start()
-        print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["tz"]}"{Color.END}')
-        wb.excel_format_table(tz_dataframe, report_sheets['tz'], excel_tables_names[report_sheets['tz']])
-
-    # Создание листа Не переданы ТЗ в ПО
-    # формируем таблицы передачи в ПО для стройки и реконструкции
-    #
-    sending_po_build_dataframe = sending_po_build_dataframe[[process_columns['id'],
-                                                             process_columns['region'],
-                                                             process_columns['name'],
-                                                             process_columns['plan_date'],
-                                                             process_columns['program'],
-                                                             process_columns['po'],
-                                                             ]]
-    sending_po_build_dataframe[BP] = BP_BUILD
-    if rec_df_ is not None:
-        sending_po_rec_df = sending_po_rec_df[[process_columns['id'],
-                                               process_columns['region'],
-                                               process_columns['name'],
-                                               process_columns['plan_date'],
-                                               process_columns['program'],
-                                               process_columns['po'],
-                                               ]]
-        sending_po_rec_df[BP] = BP_RECON
-        # Объединяем передачу ТЗ в ПО стройки и реконструкции
-        sending_po_dataframe = pd.concat([sending_po_build_dataframe, sending_po_rec_df], ignore_index=True).reset_index(drop=True)
-    else:
-        sending_po_dataframe = sending_po_build_dataframe
-        # Убираем мероприятия с не выданными ТЗ
-    sending_po_dataframe = pd.concat([sending_po_dataframe, tz_dataframe], ignore_index=True).drop_duplicates(keep=False).reset_index(drop=True).sort_values(by=columns_for_sort)
-    # write_report_table_to_file(sending_po_dataframe, file_name, report_sheets['sending_po'], excel_tables_names,
-    #                            excel_cell_names, table_style)
-    if not sending_po_dataframe.empty:
-        if args.send_email:
-            threading.Thread(target=call_send_email,
-                             args=(sending_po_dataframe, reports_data['sending_po'], args.no_debug, EMAIL_ADDRESS, EMAIL_PASSWORD, date_last_update)).start()
-        print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["sending_po"]}"{Color.END}')
-        wb.excel_format_table(sending_po_dataframe, report_sheets['sending_po'], excel_tables_names[report_sheets['sending_po']])
-
-    # Создание листа ТЗ не принято ПО
-    #
-    # формируем таблицы не принято ПО для стройки и реконструкции
-    #
-    received_po_build_dataframe = received_po_build_dataframe[[process_columns['id'],
-                                                               process_columns['region'],
-                                                               process_columns['name'],
-                                                               process_columns['plan_date'],
-                                                               process_columns['program'],
-                                                               process_columns['po'],
-                                                               ]]
-    received_po_build_dataframe[BP] = BP_BUILD
-
-    if rec_df_ is not None:
-        received_po_rec_df = received_po_rec_df[[process_columns['id'],
-                                                 process_columns['region'],
-                                                 process_columns['name'],
-                                                 process_columns['plan_date'],
-                                                 process_columns['program'],
-                                                 process_columns['po'],
-                                                 ]]
-        received_po_rec_df[BP] = BP_RECON
-        # Объединяем не принято в ПО стройки и реконструкции
-        received_po_dataframe = pd.concat([received_po_build_dataframe, received_po_rec_df], ignore_index=True).reset_index(drop=True)
-    else:
-        received_po_dataframe = received_po_build_dataframe
-    # Убираем мероприятия с не выданными ТЗ и не переданные в ПО
-    received_po_dataframe = pd.concat([received_po_dataframe, sending_po_dataframe, tz_dataframe],
-                                      ignore_index=True).drop_duplicates(keep=False).reset_index(drop=True).sort_values(by=columns_for_sort)
-    # write_report_table_to_file(received_po_dataframe, file_name, report_sheets['received_po'], excel_tables_names,
-    #                            excel_cell_names, table_style)
-    if not received_po_dataframe.empty:
-        if args.send_email:
-            threading.Thread(target=call_send_email,
-                             args=(received_po_dataframe, reports_data['received_po'], args.no_debug, EMAIL_ADDRESS, EMAIL_PASSWORD, date_last_update)).start()
-        print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["received_po"]}"{Color.END}')
-        wb.excel_format_table(received_po_dataframe, report_sheets['received_po'], excel_tables_names[report_sheets['received_po']])
+            changes_dataframe = pd.DataFrame(columns=['Источник', process_columns['id']])
+        if snapshot_dir is not None:
+            print(f'Изменений с предыдущего снимка: {Color.GREEN}{len(changes_dataframe)}{Color.END}')
+        return changes_dataframe
+
+    def write_data_sheet(sheet, data_frame):
+        if not data_frame.empty:
+            print(f'Создаем лист: {Color.GREEN}"{source_sheets.get(sheet, sheet)}"{Color.END}')
+            wb.excel_format_table(data_frame, source_sheets.get(sheet, sheet), excel_tables_names[source_sheets.get(sheet, sheet)])
+
+    def compute_frames(main_build_df, ext_build_df, rec_df_):
+        # Показатели отчетной таблицы и таблицы листов рассылки
+        def compute(parts=None):
+            return compute_report_frames(main_build_df, ext_build_df, rec_df_, process_columns, REPORT_PROCESSES, last_days_of_month, process_month, columns_for_sort,
+                                         columns_for_sort_active, (BP, BP_BUILD, BP_RECON), args.new_algorithm, args.active_year, parts)
+
+        with span('report', backend=args.backend):
+            if result_cache is not None:
+                frames = result_cache.report_frames(compute, (main_build_df, ext_build_df, rec_df_), result_context,
+                                                    {'month': process_month, 'new_algorithm': args.new_algorithm, 'active_year': args.active_year})
+            else:
+                frames = compute()
+        report_memory(memory_process, 'Расчет отчета', {report_sheets[name]: frames[name] for name in ('current_month', 'tz', 'sending_po', 'received_po')})
+        return frames
+
+    def write_report(frames):
+        print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["report"]}"{Color.END}')
+        wb.excel_report_sheet(
+            report_sheets['report'],
+            frames['metrics'],
+            datetime.date(process_year, process_month, 1).strftime("%b %Y"),
+            datetime.datetime.fromisoformat(date_last_update).strftime("%d.%m.%Y %H:%M:%S") if date_last_update is not None else None,
+        )
+
+    def write_list(name, frames):
+        # Листы Активные мероприятия, Нет ТЗ, Не переданы ТЗ в ПО, ТЗ не принято ПО
+        if not frames[name].empty:
+            print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets[name]}"{Color.END}')
+            wb.excel_format_table(frames[name], report_sheets[name], excel_tables_names[report_sheets[name]])
+
+    def send_list(name, frames, changes_dataframe=None):
+        # Ошибка рассылки (нет gdc_vols.ini, недоступен SMTP сервер) не останавливает запись и сохранение отчета
+        try:
+            mail_dataframe = changed_events(frames[name], changes_dataframe, process_columns['id']) if args.changes_only else frames[name]
+            if not mail_dataframe.empty:
+                call_send_email(mail_dataframe, reports_data[name], args.no_debug, EMAIL_ADDRESS, EMAIL_PASSWORD, date_last_update)
+        except Exception as ex:
+            logger.error(f'Ошибка рассылки "{report_sheets[name]}": {ex}')
 
-    if args.soc_report:
+    def soc_frames(extended_build_df, rec_df_):
         # TODO необходимо сделать подсчет соцсоревнования в соответствии с 2-мя режимами счета на КС-2 и принятию ВОЛС и только по завершению ВОЛС
         #
         # Формируем листы соцсоревнования
@@ -1017,13 +654,13 @@ def main():
         soc_df_build = extended_build_df[[process_columns['region'],
                                           process_columns['plan_date'],
                                           process_columns['complete_date']
-                                          ]].copy()
+                                          ]]
         soc_df_build[BP] = BP_BUILD
 
         soc_df_rec = rec_df_[[process_columns['region'],
                               process_columns['plan_date'],
                               process_columns['complete_date2']
-                              ]].copy().rename(columns=rename_columns)
+                              ]].rename(columns=rename_columns)
         soc_df_rec[BP] = BP_RECON
 
         #
@@ -1054,14 +691,9 @@ def main():
         ).reset_index()
         soc_report_build = pd.merge(soc_report_plan_build, soc_report_done_build, how='outer', sort=True).fillna(value=0).rename(columns=soc_rename_columns)
         soc_report_build[DELTA_CHAR] = soc_report_build['Факт'] - soc_report_build['План']
-        soc_report_build.loc["total"] = soc_report_build.sum(numeric_only=True)
-        soc_report_build.at["total", 'Регион/Зона мероприятия'] = "ИТОГО:"
+        soc_report_build.loc["total"] = pd.Series({'Регион/Зона мероприятия': "ИТОГО:", **soc_report_build.sum(numeric_only=True)})
         logger.debug(f'{soc_report_build = }')
 
-        if not soc_report_build.empty:
-            print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["soc_build"]}"{Color.END}')
-            wb.excel_format_table(soc_report_build, report_sheets['soc_build'], excel_tables_names[report_sheets['soc_build']])
-
         # Считаем мероприятия плана Реконструкции ВОЛС
         soc_report_plan_rec = soc_df_plan_rec.groupby([process_columns['region']]).agg(
             {
@@ -1076,34 +708,160 @@ def main():
         ).reset_index()
         soc_report_rec = pd.merge(soc_report_plan_rec, soc_report_done_rec, how='outer', sort=True).fillna(value=0).rename(columns=soc_rename_columns)
         soc_report_rec[DELTA_CHAR] = soc_report_rec['Факт'] - soc_report_rec['План']
-        soc_report_rec.loc["total"] = soc_report_rec.sum(numeric_only=True)
-        soc_report_rec.at['total', 'Регион/Зона мероприятия'] = 'ИТОГО:'
+        soc_report_rec.loc["total"] = pd.Series({'Регион/Зона мероприятия': 'ИТОГО:', **soc_report_rec.sum(numeric_only=True)})
         logger.debug(f'{soc_report_rec = }')
+        return {'soc_build': soc_report_build, 'soc_rec': soc_report_rec}
+
+    def compute_soc(extended_build_df, rec_df_):
+        # Листы Соц. соревнования зависят только от исходных данных и отчетного месяца
+        if result_cache is None:
+            return soc_frames(extended_build_df, rec_df_)
+        return result_cache.cached('soc', [result_cache.fingerprint(extended_build_df), result_cache.fingerprint(rec_df_), result_context,
+                                           {'month': process_month}], functools.partial(soc_frames, extended_build_df, rec_df_))
+
+    def write_soc(soc):
+        soc_report_build, soc_report_rec = soc['soc_build'], soc['soc_rec']
+        if not soc_report_build.empty:
+            print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["soc_build"]}"{Color.END}')
+            wb.excel_format_table(soc_report_build, report_sheets['soc_build'], excel_tables_names[report_sheets['soc_build']])
 
         if not soc_report_rec.empty:
             print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["soc_rec"]}"{Color.END}')
             wb.excel_format_table(soc_report_rec, report_sheets['soc_rec'], excel_tables_names[report_sheets['soc_rec']])
-            logger.debug(f'{wb.ws["B2"].value = }')
-    #
-    # Записываем сформированный файл отчета
-    #
-    logger.info(f'Удаляем лист {ws_first}')
-    wb.remove(ws_first)
-    if Path(file_name).is_file():
+
+    def write_changes(changes_dataframe):
+        if not changes_dataframe.empty:
+            print(f'Создаем лист отчета: {Color.GREEN}"{report_sheets["changes"]}"{Color.END}')
+            wb.excel_format_table(changes_dataframe, report_sheets['changes'], excel_tables_names[report_sheets['changes']])
+
+    def save():
+        report_memory(memory_process, 'Формирование листов')
+        #
+        # Записываем сформированный файл отчета
+        #
+        if ws_first is not None:
+            # Выбранные ключом --sheets листы могут оказаться пустыми
+            if wb.worksheets == [ws_first]:
+                print(f'{Color.RED}Нет данных для выбранных листов, файл отчета не сохраняется{Color.END}')
+                return None
+            logger.info(f'Удаляем лист {ws_first}')
+            wb.remove(ws_first)
+        if Path(save_file).is_file() and not args.incremental:
+            try:
+                print(f'Удаляем существующий файл отчета {Color.GREEN}"{save_file}"{Color.END}')
+                os.remove(save_file)
+            except Exception as ex:
+                logger.error(f'Ошибка удаления файла: {ex}')
+                sys.exit(1)
+
         try:
-            print(f'Удаляем существующий файл отчета {Color.GREEN}"{file_name}"{Color.END}')
-            os.remove(file_name)
+            print(f'Сохраняем отформатированные данные в файл {Color.GREEN}"{save_file}"{Color.END}')
+            with span('save', writer=args.writer):
+                saved = wb.save(save_file) is not False
+            if not saved:
+                print(f'Данные не изменились, файл отчета {Color.GREEN}"{save_file}"{Color.END} не перезаписан')
         except Exception as ex:
-            logger.error(f'Ошибка удаления файла: {ex}')
-            sys.exit(1)
+            logger.error(f'Ошибка сохранения файла файла: {ex}')
+            sys.exit(2)
+        report_memory(memory_process, 'Сохранение отчета')
+        publish(saved)
+        return saved
+
+    def publish(saved):
+        if save_file != file_name:
+            if not saved and report_published(save_file):
+                print(f'Отчет в {Color.GREEN}"{file_name}"{Color.END} актуален')
+            else:
+                # Маркер прежней публикации больше не соответствует локальному файлу
+                report_marker(save_file).unlink(missing_ok=True)
+                print(f'Копируем отчет в {Color.GREEN}"{file_name}"{Color.END}')
+                # Копирование с повторными попытками идет в фоне, запуск (и следующий опрос serve) его не ждет
+                threading.Thread(target=publish_report, args=(save_file, file_name)).start()
 
-    try:
-        print(f'Сохраняем отформатированные данные в файл {Color.GREEN}"{file_name}"{Color.END}')
-        wb.save(file_name)
-    except Exception as ex:
-        logger.error(f'Ошибка сохранения файла файла: {ex}')
-        sys.exit(2)
+    for i in range(1, 13):
+        last_days_of_month[i] = pd.Timestamp(last_day_of_month(datetime.datetime(process_year, i, 1)))
+
+    # Граф этапов: загрузка и подготовка каждого источника, расчет отчета, запись листов в порядке отчета, рассылка, сохранение.
+    # Листы записываются по одному (after), остальные этапы выполняются, как только готовы их входные данные
+    stages = []
+    sheet_stages = {}
+    for sheet, url in urls.items():
+        stages += [
+            Stage(f'fetch:{sheet}', functools.partial(fetch, url)),
+            Stage(f'prepare:{sheet}', functools.partial(prepare, sheet), inputs=[f'fetch:{sheet}']),
+        ]
+        if snapshot_dir is not None:
+            stages.append(Stage(f'snapshot:{sheet}', functools.partial(snapshot, sheet), inputs=[f'prepare:{sheet}']))
+        sheet_stages.setdefault('data', []).append(Stage(f'sheet:{sheet}', functools.partial(write_data_sheet, sheet), inputs=[f'prepare:{sheet}']))
+    sources = {role: next((f'prepare:{sheet}' for sheet in urls if source_roles.get(sheet) == role), None) for role in ('build', 'ext', 'rec')}
+    stages += [Stage(f'source:{role}', lambda data_frame=None: data_frame, inputs=[stage] if stage is not None else []) for role, stage in sources.items()]
+    stages += [
+        Stage('changes', collect_changes, inputs=[stage.name for stage in stages if stage.name.startswith('snapshot:')]),
+        Stage('frames', compute_frames, inputs=['source:build', 'source:ext', 'source:rec']),
+    ]
+    sheet_stages['report'] = [Stage('sheet:report', write_report, inputs=['frames'])]
+    for name in ('current_month', 'tz', 'sending_po', 'received_po'):
+        sheet_stages[name] = [Stage(f'sheet:{name}', functools.partial(write_list, name), inputs=['frames'])]
+    if args.soc_report:
+        stages.append(Stage('soc', compute_soc, inputs=['source:build', 'source:rec']))
+        sheet_stages['soc'] = [Stage('sheet:soc', write_soc, inputs=['soc'])]
+    if snapshot_dir is not None:
+        sheet_stages['changes'] = [Stage('sheet:changes', write_changes, inputs=['changes'])]
+    written = []
+    for output_stages in sheet_stages.values():
+        for stage in output_stages:
+            stage.after = tuple(written)
+            written.append(stage.name)
+            stages.append(stage)
+    for name in reports_data:
+        stages.append(Stage(f'mail:{name}', functools.partial(send_list, name), inputs=['frames', 'changes'] if args.changes_only else ['frames']))
+    stages.append(Stage('save', save, after=written))
+
+    # Цели: выбранные листы, рассылка выбранных листов воронки, сохранение отчета. Загруженные источники сохраняются в хранилище снимков
+    outputs = args.sheets if args.sheets is not None else list(sheet_stages)
+    targets = [stage.name for output in outputs for stage in sheet_stages[output]]
+    if args.send_email:
+        targets += [f'mail:{name}' for name in reports_data if name in outputs]
+    targets.append('save')
+    if snapshot_dir is not None:
+        required = required_stages({stage.name: stage for stage in stages}, targets)
+        targets += [f'snapshot:{sheet}' for sheet in urls if f'prepare:{sheet}' in required]
+    results = run_stages(stages, targets, args.jobs)
+
+    # Данные отчета для резидентного режима (gdc_vols serve --http): исходные таблицы и пересчет показателей по выборке мероприятий
+    return {
+        'update_date': date_last_update,
+        'period': datetime.date(process_year, process_month, 1).strftime('%m.%Y'),
+        'sources': {role: results.get(f'source:{role}') for role in ('build', 'ext', 'rec')},
+        'frames': results.get('frames'),
+        'report_frames': lambda build, ext, rec: compute_report_frames(build, ext, rec, process_columns, REPORT_PROCESSES, last_days_of_month, process_month,
+                                                                       columns_for_sort, columns_for_sort_active, (BP, BP_BUILD, BP_RECON),
+                                                                       args.new_algorithm, args.active_year),
+    }
 
 
 if __name__ == '__main__':
-    main()
+    # Необходимо для процессов сериализации листов в собранных PyInstaller/Nuitka exe
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        try:
+            from vols_query import query_main
+        except ImportError as ex:
+            logger.error(f'Для подкоманды query требуются пакеты duckdb и pyarrow: {ex}')
+            sys.exit(105)
+        sys.exit(query_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from vols_serve import serve_main
+        sys.exit(serve_main(sys.argv[2:], main, build_parser, portal_urls))
+    if len(sys.argv) > 1 and sys.argv[1] == 'farm':
+        from vols_farm import farm_main
+        sys.exit(farm_main(sys.argv[2:], main, build_parser, portal_urls))
+    try:
+        main()
+    except SystemExit as ex:
+        set_status(ex.code)
+        raise
+    except BaseException:
+        set_status(1)
+        raise
+    set_status(0)
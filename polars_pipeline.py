@@ -0,0 +1,171 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Расчет показателей отчетной таблицы и таблиц листов рассылки на Polars.
+
+Повторяет vols_functions.report_frames: те же аргументы и тот же результат (показатели и таблицы pandas).
+Все выборки строятся как ленивые запросы над загруженными таблицами и выполняются одним вызовом collect_all,
+общие части запросов (объединение стройки и реконструкции, таблица "Нет ТЗ") считаются один раз.
+Загрузка данных портала и запись листов остаются на pandas.
+
+gdc_vols --backend polars
+"""
+import datetime
+
+import pandas as pd
+import polars as pl
+
+DONE_STATUSES = ['Исполнена', 'Не требуется']
+DONE_PATTERN = 'Исполнена|Не требуется'
+KPI_CATEGORIES = ['Доступ', 'Дискреты_целевые']
+
+
+def _text(column: str) -> pl.Expr:
+    # Колонка без значений загружается из pandas с типом Null
+    return pl.col(column).cast(pl.String)
+
+
+def _datetime(value) -> datetime.datetime:
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def _lazy(df: pd.DataFrame, columns: set) -> pl.LazyFrame:
+    # В Polars передаются только колонки, используемые в расчете
+    return pl.from_pandas(df[[column for column in df.columns if column in columns]]).lazy()
+
+
+def _concat(frames: list) -> pl.LazyFrame:
+    # Как pd.concat: объединение по именам колонок, отсутствующие колонки заполняются пустыми значениями
+    return pl.concat(frames, how='diagonal_relaxed')
+
+
+def _sort(lf: pl.LazyFrame, columns: list) -> pl.LazyFrame:
+    # Как sort_values по нескольким колонкам: устойчивая сортировка, пустые значения в конце
+    return lf.sort(columns, nulls_last=True, maintain_order=True)
+
+
+def _unique_rows(lf: pl.LazyFrame, columns: list) -> pl.LazyFrame:
+    # Как drop_duplicates(keep=False): убираются все строки, у которых есть полный дубль
+    return lf.filter(pl.len().over(columns) == 1)
+
+
+def section_metrics(lf: pl.LazyFrame, process_columns: dict, processes, last_day, new_algorithm: bool = False, suffix: str = '') -> pl.LazyFrame:
+    """
+    Запрос показателей секции отчетной таблицы, см. vols_functions.report_section_metrics
+
+    :param lf: Мероприятия секции
+    :param process_columns: Словарь наименований колонок
+    :param processes: Ключи колонок статусов процессов в порядке строк отчета
+    :param last_day: Последний день отчетного месяца
+    :param new_algorithm: Считать факт по дате ввода в эксплуатацию
+    :param suffix: Суффикс ключей колонок
+    :return LazyFrame: Одна строка: total, plan, fact и done_<номер процесса>
+    """
+    last_day = _datetime(last_day)
+    plan = pl.col(process_columns['plan_date'])
+    if not new_algorithm:
+        fact = (pl.col(process_columns[f'commissioning_date{suffix}']) <= last_day) & (pl.col(process_columns[f'ks2_date{suffix}']) <= last_day)
+    else:
+        fact = pl.col(process_columns[f'complete_date{suffix}']) <= last_day
+    return lf.select(
+        plan.count().alias('total'),
+        (plan <= last_day).sum().alias('plan'),
+        fact.sum().alias('fact'),
+        *[_text(process_columns[f'{process}{suffix}']).is_in(DONE_STATUSES).sum().alias(f'done_{number}') for number, process in enumerate(processes)],
+    )
+
+
+def _metrics(row: dict, processes) -> dict:
+    metrics = {
+        'total': row['total'],
+        'plan': row['plan'],
+        'fact': row['fact'],
+        'delta': row['fact'] - row['plan'],
+        'done': [row[f'done_{number}'] for number in range(len(processes))],
+    }
+    metrics['done_delta'] = [done - metrics['total'] for done in metrics['done']]
+    return metrics
+
+
+def _current_month(lf: pl.LazyFrame, process_columns: dict, month_limit: datetime.datetime, last_day: datetime.datetime, new_algorithm: bool,
+                   suffix: str) -> pl.LazyFrame:
+    plan = pl.col(process_columns['plan_date'])
+    if not new_algorithm:
+        status = ~_text(process_columns[f'commissioning_status{suffix}']).str.contains(DONE_PATTERN) | \
+                 ~_text(process_columns[f'ks2_status{suffix}']).str.contains(DONE_PATTERN)
+    else:
+        status = pl.col(process_columns[f'complete_date{suffix}']).is_null() & (plan <= last_day)
+    return lf.filter((plan <= month_limit) & status)
+
+
+def report_frames(main_build_df, ext_build_df, rec_df, process_columns, processes, last_days_of_month, month, columns_for_sort, columns_for_sort_active,
+                  business_process, new_algorithm=False, active_year=False, parts=None) -> dict:
+    """
+    Считает показатели отчетной таблицы и таблицы листов рассылки по загруженным данным
+
+    :param main_build_df: Основное строительство
+    :param ext_build_df: Дополнительное строительство или None
+    :param rec_df: Реконструкция или None
+    :param process_columns: Словарь наименований колонок
+    :param processes: Ключи колонок статусов процессов в порядке строк отчета
+    :param last_days_of_month: Словарь месяц: последний день месяца
+    :param month: Отчетный месяц
+    :param columns_for_sort: Колонки сортировки листов рассылки
+    :param columns_for_sort_active: Колонки сортировки листа активных мероприятий
+    :param business_process: Наименования колонки бизнес-процесса, строительства и реконструкции
+    :param new_algorithm: Считать факт по дате ввода в эксплуатацию
+    :param active_year: Активные мероприятия до конца года
+    :param parts: Считаемые части результата (metrics, current_month, funnel), None - все
+    :return dict: metrics, current_month, tz, sending_po, received_po (только таблицы выбранных частей)
+    """
+    parts = ('metrics', 'current_month', 'funnel') if parts is None else parts
+    bp, bp_build, bp_recon = business_process
+    last_day = _datetime(last_days_of_month[month])
+    # Сравнение с датой без времени, как строка ГГГГ-ММ-ДД в pandas
+    month_limit = datetime.datetime.combine(_datetime(last_days_of_month[12 if active_year else month]).date(), datetime.time())
+
+    used_columns = set(process_columns.values())
+    build = _lazy(main_build_df, used_columns)
+    ext = _lazy(ext_build_df, used_columns) if ext_build_df is not None else None
+    rec = _lazy(rec_df, used_columns) if rec_df is not None else None
+    df = _concat([build, ext]) if ext is not None else build
+    kpi = build.filter(_text(process_columns['program_category']).is_in(KPI_CATEGORIES))
+
+    sections = {section: query for section, query in (('build', (build, '')), ('ext', (ext, '')), ('rec', (rec, '2')), ('kpi', (kpi, '')))
+                if query[0] is not None and 'metrics' in parts}
+    queries = [section_metrics(section_lf, process_columns, processes, last_day, new_algorithm, suffix) for section_lf, suffix in sections.values()]
+
+    def mailing(lf: pl.LazyFrame, status: str, columns: list, bp_name: str) -> pl.LazyFrame:
+        return lf.filter(_text(process_columns[status]).ne_missing('Исполнена')).select(columns).with_columns(pl.lit(bp_name).alias(bp))
+
+    mail_columns = [process_columns[column] for column in ('id', 'region', 'name', 'plan_date', 'program')]
+    active_columns = [process_columns[column] for column in ('id', 'program_category', 'work_type', 'region', 'name', 'plan_date', 'prognoz_date', 'program', 'po')]
+
+    lists = {}
+    if 'current_month' in parts:
+        # Активные мероприятия строительства месяца отчёта
+        current_month = _current_month(df, process_columns, month_limit, last_day, new_algorithm, '').select(active_columns).with_columns(pl.lit(bp_build).alias(bp))
+        if rec is not None:
+            current_month = _sort(_concat([current_month, _current_month(rec, process_columns, month_limit, last_day, new_algorithm, '2')
+                                          .select(active_columns).with_columns(pl.lit(bp_recon).alias(bp))]), columns_for_sort_active)
+        lists['current_month'] = current_month
+    if 'funnel' in parts:
+        # Нет ТЗ, не переданы ТЗ в ПО, ТЗ не принято ПО
+        tz = mailing(df, 'tz_status', mail_columns, bp_build)
+        sending_po = mailing(df, 'send_tz_status', mail_columns + [process_columns['po']], bp_build)
+        received_po = mailing(df, 'received_tz_status', mail_columns + [process_columns['po']], bp_build)
+        if rec is not None:
+            tz = _sort(_concat([tz, mailing(rec, 'tz_status2', mail_columns, bp_recon)]), columns_for_sort)
+            sending_po = _concat([sending_po, mailing(rec, 'send_tz_status2', mail_columns + [process_columns['po']], bp_recon)])
+            received_po = _concat([received_po, mailing(rec, 'received_tz_status2', mail_columns + [process_columns['po']], bp_recon)])
+        # Убираем мероприятия с не выданными ТЗ и не переданные в ПО
+        sending_columns = mail_columns + [process_columns['po'], bp]
+        sending_po = _sort(_unique_rows(_concat([sending_po, tz]), sending_columns), columns_for_sort)
+        received_po = _sort(_unique_rows(_concat([received_po, sending_po, tz]), sending_columns), columns_for_sort)
+        lists.update({'tz': tz, 'sending_po': sending_po, 'received_po': received_po})
+
+    results = pl.collect_all(queries + list(lists.values()))
+    frames = {}
+    if 'metrics' in parts:
+        frames['metrics'] = {section: _metrics(result.row(0, named=True), processes) for section, result in zip(sections, results)}
+    frames.update({name: result.to_pandas() for name, result in zip(lists, results[len(queries):])})
+    return frames
@@ -0,0 +1,267 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Профилирование запуска: выборочный профилировщик стеков и распределение памяти по этапам обработки.
+
+Фоновый поток с заданным периодом снимает стеки всех потоков процесса (sys._current_frames), стеки группируются
+по потоку и текущему этапу stage_timing. По этапам верхнего уровня основного потока tracemalloc считает пиковую память
+и строки кода, на которых память выделена. Внешние программы и пакеты не нужны, поэтому профилирование
+работает и в собранных PyInstaller/Nuitka exe.
+
+В папку запуска сохраняются:
+    flamegraph.html - интерактивный flame graph (щелчок по блоку - увеличение, поиск по имени функции)
+    profile.folded - стеки в формате folded (flamegraph.pl, speedscope)
+    functions.txt - функции по собственному и полному количеству выборок
+    allocations.txt - пиковая память и строки кода с наибольшим выделением памяти по этапам
+
+gdc_vols --profile [DIR]
+"""
+import atexit
+import html
+import json
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+import stage_timing
+
+# Период снятия стеков, с
+SAMPLE_INTERVAL = 0.01
+# Количество строк кода с наибольшим выделением памяти в отчете по этапу
+TOP_ALLOCATIONS = 15
+# Глубина стека tracemalloc для каждого выделения памяти
+TRACEMALLOC_FRAMES = 1
+# Потоки замеров не профилируются
+IGNORED_THREADS = {'profiler', 'stage_timing'}
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+
+
+def _stage_name(record: dict) -> str:
+    # ';' разделяет кадры стека в формате folded
+    return ' '.join([f'[{record["name"]}', *record['labels'].values()]).replace(';', ',') + ']'
+
+
+class Profiler:
+    """Выборочный профилировщик стеков и замер памяти этапов"""
+
+    def __init__(self, run_dir, interval: float = SAMPLE_INTERVAL, top: int = TOP_ALLOCATIONS):
+        """
+        :param run_dir: Папка результатов профилирования
+        :param interval: Период снятия стеков, с
+        :param top: Количество строк кода с наибольшим выделением памяти по этапу
+        """
+        self.run_dir = Path(run_dir)
+        self.interval = interval
+        self.top = top
+        self.samples = Counter()
+        self.allocations = []
+        self._stages = {}
+        # Потоки, в которых выполняются снимки памяти: их стеки не снимаются
+        self._paused = set()
+        self._stopped = threading.Event()
+        self._thread = None
+        # Выделения памяти самими замерами не показываются. Снимки не фильтруются filter_traces: фильтр перебирает все блоки памяти
+        self._ignored_files = {tracemalloc.__file__, __file__, stage_timing.__file__, '<frozen importlib._bootstrap>',
+                               '<frozen importlib._bootstrap_external>', '<unknown>'}
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == own or ident in self._paused or name in IGNORED_THREADS:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stage = self._stages.get(ident)
+                self.samples[(name, *((stage,) if stage is not None else ()), *reversed(stack))] += 1
+
+    @contextmanager
+    def stage(self, record: dict):
+        """
+        Обработчик этапа stage_timing: имя этапа для стеков потока, для этапов основного потока - замер памяти tracemalloc.
+        Замер памяти общий для всех потоков, поэтому этапы фоновых потоков (рассылка, копирование) только отмечаются в стеках
+
+        :param record: Запись этапа stage_timing
+        """
+        if record['parent'] is not None:
+            yield
+            return
+        ident = threading.get_ident()
+        self._stages[ident] = _stage_name(record)
+        trace = threading.current_thread() is threading.main_thread() and tracemalloc.is_tracing()
+        if trace:
+            self._paused.add(ident)
+            before = tracemalloc.take_snapshot()
+            traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self._paused.discard(ident)
+        try:
+            yield
+        finally:
+            self._stages.pop(ident, None)
+            if trace and tracemalloc.is_tracing():
+                self._paused.add(ident)
+                current, peak = tracemalloc.get_traced_memory()
+                record['traced_peak'] = peak - traced
+                record['traced_diff'] = current - traced
+                statistics = [statistic for statistic in tracemalloc.take_snapshot().compare_to(before, 'lineno')
+                              if statistic.traceback[0].filename not in self._ignored_files]
+                self.allocations.append((_stage_name(record), peak - traced, current - traced, statistics[:self.top]))
+                self._paused.discard(ident)
+
+    def tree(self) -> list:
+        """Дерево стеков: [имя, количество выборок, [дочерние узлы]]"""
+        root = ['все', 0, {}]
+        for stack, count in self.samples.items():
+            node = root
+            node[1] += count
+            for name in stack:
+                node = node[2].setdefault(name, [name, 0, {}])
+                node[1] += count
+
+        def convert(node):
+            return [node[0], node[1], [convert(child) for child in sorted(node[2].values(), key=lambda child: -child[1])]]
+        return convert(root)
+
+    def functions(self) -> str:
+        own, total = Counter(), Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        samples = sum(self.samples.values()) or 1
+        lines = [f'Выборок: {samples}, период {self.interval * 1000:.0f} мс', '', f'{"собств.":>9}{"%":>7}{"всего":>9}{"%":>7}  функция']
+        for name, count in sorted(total.items(), key=lambda item: (-own[item[0]], -item[1])):
+            lines.append(f'{own[name]:>9}{own[name] / samples * 100:>7.1f}{count:>9}{count / samples * 100:>7.1f}  {name}')
+        return '\n'.join(lines) + '\n'
+
+    def allocations_report(self) -> str:
+        lines = []
+        for stage, peak, diff, statistics in self.allocations:
+            lines += [f'{stage}: пиковая память {peak / 2 ** 20:.1f} МБ, остаток {diff / 2 ** 20:+.1f} МБ']
+            lines += [f'    {statistic.size_diff / 2 ** 10:>+12.1f} КБ {statistic.count_diff:>+9} блоков  '
+                      f'{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}' for statistic in statistics]
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write(self):
+        """Останавливает профилирование и сохраняет результаты в папку запуска"""
+        self.stop()
+        files = {
+            'flamegraph.html': lambda: FLAMEGRAPH_HTML.replace('{title}', html.escape(' '.join(sys.argv)))
+                                                      .replace('{data}', json.dumps(self.tree(), ensure_ascii=False).replace('</', '<\\/')),
+            'profile.folded': lambda: ''.join(f'{";".join(stack)} {count}\n' for stack, count in self.samples.items()),
+            'functions.txt': self.functions,
+            'allocations.txt': self.allocations_report,
+        }
+        try:
+            self.run_dir.mkdir(parents=True, exist_ok=True)
+            for file_name, text in files.items():
+                Path(self.run_dir, file_name).write_text(text(), encoding='utf-8')
+            print(f'Результаты профилирования сохранены в папку "{self.run_dir}"')
+        except OSError as ex:
+            print(f'Ошибка записи результатов профилирования в папку "{self.run_dir}": {ex}', file=sys.stderr)
+
+
+FLAMEGRAPH_HTML = '''<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Flame graph</title>
+<style>
+body { font: 12px sans-serif; margin: 8px; }
+#chart { position: relative; width: 100%; }
+.frame { position: absolute; height: 17px; line-height: 17px; overflow: hidden; white-space: nowrap; box-sizing: border-box;
+         border: 1px solid #fff; padding-left: 3px; cursor: pointer; }
+.frame.match { background: #e070e0 !important; }
+#info { height: 18px; margin: 6px 0; font-family: monospace; }
+</style>
+</head>
+<body>
+<div><b>{title}</b></div>
+<div><button id="reset">Сброс</button> <input id="search" placeholder="Поиск функции" size="40"></div>
+<div id="info"></div>
+<div id="chart"></div>
+<script>
+const data = {data};
+const chart = document.getElementById('chart'), info = document.getElementById('info'), search = document.getElementById('search');
+
+function color(name) {
+    let hash = 0;
+    for (const symbol of name) hash = (hash * 31 + symbol.charCodeAt(0)) | 0;
+    return `hsl(${20 + Math.abs(hash) % 40}, 90%, ${55 + Math.abs(hash >> 8) % 20}%)`;
+}
+
+function render(root) {
+    chart.innerHTML = '';
+    let depth = 0;
+    const pattern = search.value.toLowerCase();
+    function place(node, level, left, width) {
+        if (width < 0.05) return;
+        depth = Math.max(depth, level + 1);
+        const frame = document.createElement('div');
+        frame.className = 'frame' + (pattern && node[0].toLowerCase().includes(pattern) ? ' match' : '');
+        frame.style.cssText = `left:${left}%;width:${width}%;top:${level * 17}px;background:${color(node[0])}`;
+        frame.textContent = node[0];
+        const text = `${node[0]}: ${node[1]} выб., ${(node[1] / data[1] * 100).toFixed(2)}%`;
+        frame.title = text;
+        frame.onmouseover = () => info.textContent = text;
+        frame.onclick = () => render(node);
+        chart.appendChild(frame);
+        let offset = left;
+        for (const child of node[2]) {
+            const childWidth = child[1] / node[1] * width;
+            place(child, level + 1, offset, childWidth);
+            offset += childWidth;
+        }
+    }
+    place(root, 0, 0, 100);
+    chart.style.height = `${depth * 17}px`;
+    current = root;
+}
+
+let current = data;
+document.getElementById('reset').onclick = () => render(data);
+search.oninput = () => render(current);
+render(data);
+</script>
+</body>
+</html>
+'''
+
+
+def start_profile(run_dir) -> Profiler:
+    """
+    Начинает профилирование. Результаты сохраняются при завершении процесса.
+    Замер памяти по этапам выполняется для этапов stage_timing, поэтому запись запуска (start_run) должна быть начата
+
+    :param run_dir: Папка результатов профилирования
+    :return Profiler:
+    """
+    profiler = Profiler(run_dir)
+    stage_timing.add_hook(profiler.stage)
+    profiler.start()
+    atexit.register(profiler.write)
+    return profiler
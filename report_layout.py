@@ -0,0 +1,248 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Разметка листа "Отчетная таблица": подписи, стили ячеек и правила условного форматирования.
+
+Лист состоит из секций с одинаковой структурой, смещенных друг относительно друга.
+Значения секций считаются в gdc_vols, здесь описано только куда и как их выводить.
+openpyxl загружается только при оформлении листа: наименования процессов и секций нужны и без записи Excel.
+"""
+import sys
+from pathlib import Path
+
+DELTA_CHAR = f'{chr(0x0394)}'
+
+# Шаблон отчетной таблицы с готовыми подписями, стилями и условным форматированием
+REPORT_TEMPLATE = Path('templates', 'xlsx', 'report.xlsx')
+
+# Наименования процессов в порядке строк секции
+REPORT_PROCESSES = {
+    'tz_status': 'Выпущены ТЗ',
+    'send_tz_status': 'Переданы ТЗ в ПО',
+    'received_tz_status': 'Приняты ТЗ ПО',
+    'pir_smr_status': 'Подписание договора на ПИР/ПИР+СМР',
+    'line_scheme_status': 'Линейная схема',
+    'tu_status': 'Получено ТУ',
+    'build_status': 'Строительство трассы',
+    'ks2_status': 'Подготовка актов КС-2,3',
+    'commissioning_status': 'Приёмка ВОЛС в эксплуатацию',
+}
+
+# Секции отчета: смещение строки, смещение колонки, заголовок секции, заголовок KPI.
+# Порядок секций определяет имя варианта листа в шаблоне
+REPORT_SECTIONS = {
+    'build': (0, 0, 'Основное строительство ВОЛС', 'Исполнение KPI ВОЛС КФ (накопительный итог)'),
+    'ext': (20, 0, 'Дополнительное строительство ВОЛС', 'Исполнение KPI ВОЛС КФ (накопительный итог)'),
+    'rec': (0, 5, 'Реконструкция ВОЛС', 'Исполнение KPI ВОЛС КФ (накопительный итог)'),
+    'kpi': (40, 0, 'Целевые мероприятия Base Case ВОЛС', 'Исполнение KPI Base Case (накопительный итог)'),
+}
+
+# Стили ячеек. Описаны словарями, чтобы не зависеть от библиотеки записи Excel
+CELL_STYLES = {
+    'title': {'font_color': '0000FF', 'bold': True, 'border': 'thin'},
+    'label': {'border': 'medium'},
+    'label_bold': {'bold': True, 'border': 'medium'},
+    'header': {'bold': True, 'align': 'center', 'border': 'medium'},
+    'total': {'bold': True, 'align': 'center', 'border': 'medium'},
+    'value': {'align': 'center', 'border': 'medium'},
+    'update_date': {'font_color': '006400', 'bold': True, 'align': 'center'},
+}
+
+# Стили условного форматирования
+RULE_STYLES = {
+    'negative': {'font_color': 'B22222', 'fill': 'FFCCCC'},
+    'positive': {'font_color': '006400', 'fill': 'CCFFCC'},
+    'zero': {'font_color': '6633FF', 'fill': 'FFFFCC'},
+}
+
+# Правила условного форматирования: оператор, формула, стиль
+DELTA_RULES = [('lessThan', '0', 'negative'), ('greaterThan', '0', 'positive'), ('equal', '0', 'zero')]
+DONE_DELTA_RULES = [('greaterThanOrEqual', '0', 'positive'), ('lessThan', '0', 'negative')]
+
+UPDATE_DATE_LABEL = ('K1', 'L1')
+
+
+def _cell(row: int, col: int) -> str:
+    from openpyxl.utils import get_column_letter
+
+    return f'{get_column_letter(col)}{row}'
+
+
+def section_cells(section: str) -> dict:
+    """
+    Возвращает адреса ячеек значений секции отчета
+
+    :param section: Ключ секции из REPORT_SECTIONS
+    :return dict:
+    """
+    row, col = REPORT_SECTIONS[section][:2]
+    return {
+        'total': _cell(row + 2, col + 2),
+        'period': [_cell(row + 5, col + 2), _cell(row + 5, col + 3), _cell(row + 5, col + 4)],
+        'plan': _cell(row + 6, col + 2),
+        'fact': _cell(row + 6, col + 3),
+        'delta': _cell(row + 6, col + 4),
+        'done': [_cell(row + 10 + _i, col + 2) for _i in range(len(REPORT_PROCESSES))],
+        'done_delta': [_cell(row + 10 + _i, col + 3) for _i in range(len(REPORT_PROCESSES))],
+    }
+
+
+def report_variant(sections) -> str:
+    """Имя варианта листа шаблона для набора секций"""
+    return '+'.join(_section for _section in REPORT_SECTIONS if _section in sections)
+
+
+def report_layout(sections) -> list:
+    """
+    Возвращает статическую разметку листа: список (ячейка, значение, стиль).
+    Для ячеек с вычисляемыми значениями значение None.
+
+    :param sections: Ключи выводимых секций
+    :return list:
+    """
+    _layout = [(UPDATE_DATE_LABEL[1], None, 'update_date')]
+    for _section in REPORT_SECTIONS:
+        if _section not in sections:
+            continue
+        row, col = REPORT_SECTIONS[_section][:2]
+        title, kpi_title = REPORT_SECTIONS[_section][2:]
+        _cells = section_cells(_section)
+        _layout += [
+            (_cell(row + 1, col + 1), title, 'title'),
+            (_cell(row + 2, col + 1), 'Всего мероприятий', 'label'),
+            (_cells['total'], None, 'total'),
+            (_cell(row + 4, col + 1), kpi_title, 'title'),
+            (_cell(row + 6, col + 1), 'Учтенных ВОЛС в KPI', 'label'),
+            (_cell(row + 8, col + 1), 'Исполнение мероприятий в ЕСУП', 'title'),
+            (_cell(row + 9, col + 1), 'Наименование мероприятия', 'label_bold'),
+            (_cell(row + 9, col + 2), 'Выполнено', 'header'),
+            (_cell(row + 9, col + 3), DELTA_CHAR, 'header'),
+        ]
+        _layout += [(_coordinate, None, 'header') for _coordinate in _cells['period']]
+        _layout += [(_cells[_name], None, 'value') for _name in ('plan', 'fact', 'delta')]
+        for _i, _label in enumerate(REPORT_PROCESSES.values()):
+            _layout += [
+                (_cell(row + 10 + _i, col + 1), _label, 'label'),
+                (_cells['done'][_i], None, 'value'),
+                (_cells['done_delta'][_i], None, 'value'),
+            ]
+    return _layout
+
+
+def report_rules(sections) -> list:
+    """
+    Возвращает правила условного форматирования листа: список (ячейка, оператор, формула, стиль)
+
+    :param sections: Ключи выводимых секций
+    :return list:
+    """
+    _rules = []
+    for _section in REPORT_SECTIONS:
+        if _section not in sections:
+            continue
+        _cells = section_cells(_section)
+        _rules += [(_cells['delta'], *_rule) for _rule in DELTA_RULES]
+        for _coordinate in _cells['done_delta']:
+            _rules += [(_coordinate, *_rule) for _rule in DONE_DELTA_RULES]
+    return _rules
+
+
+def report_values(metrics: dict, period: str, update_date: [str, None] = None) -> dict:
+    """
+    Раскладывает посчитанные метрики секций по ячейкам листа
+
+    :param metrics: Словарь секция: метрики (см. vols_functions.report_section_metrics)
+    :param period: Отчетный период для заголовков колонок ("июн 2024")
+    :param update_date: Дата обновления данных на портале в формате ДД.ММ.ГГГГ ЧЧ:ММ:СС
+    :return dict: ячейка: значение
+    """
+    _values = {}
+    if update_date is not None:
+        _values[UPDATE_DATE_LABEL[0]] = "Дата обновления данных"
+        _values[UPDATE_DATE_LABEL[1]] = update_date
+    for _section, _metrics in metrics.items():
+        _cells = section_cells(_section)
+        for _coordinate, _prefix in zip(_cells['period'], ['План', 'Факт', DELTA_CHAR]):
+            _values[_coordinate] = f'{_prefix}, {period}'
+        for _name in ('total', 'plan', 'fact', 'delta'):
+            _values[_cells[_name]] = _metrics[_name]
+        for _name in ('done', 'done_delta'):
+            _values.update(zip(_cells[_name], _metrics[_name]))
+    return _values
+
+
+def openpyxl_style(style: dict) -> dict:
+    """Преобразует описание стиля в атрибуты ячейки openpyxl"""
+    import openpyxl.styles.borders as borders_style
+    from openpyxl.styles import Font, Side, PatternFill, Alignment, Border
+
+    _attributes = {}
+    if 'font_color' in style or 'bold' in style:
+        _attributes['font'] = Font(color=style.get('font_color'), bold=style.get('bold', False))
+    if 'align' in style:
+        _attributes['alignment'] = Alignment(horizontal=style['align'])
+    if 'border' in style:
+        _side = Side(style=borders_style.BORDER_MEDIUM if style['border'] == 'medium' else borders_style.BORDER_THIN)
+        _attributes['border'] = Border(left=_side, right=_side, top=_side, bottom=_side)
+    if 'fill' in style:
+        _attributes['fill'] = PatternFill(start_color=style['fill'], end_color=style['fill'], fill_type='solid')
+    return _attributes
+
+
+def xlsxwriter_style(style: dict) -> dict:
+    """Преобразует описание стиля в свойства формата XlsxWriter"""
+    _properties = {}
+    if 'font_color' in style:
+        _properties['font_color'] = f'#{style["font_color"]}'
+    if style.get('bold'):
+        _properties['bold'] = True
+    if 'align' in style:
+        _properties['align'] = style['align']
+    if 'border' in style:
+        _properties['border'] = 2 if style['border'] == 'medium' else 1
+    if 'fill' in style:
+        _properties['bg_color'] = f'#{style["fill"]}'
+    return _properties
+
+
+def style_report_sheet(ws, sections):
+    """
+    Заполняет лист подписями, стилями и условным форматированием отчетной таблицы
+
+    :param ws: Лист openpyxl
+    :param sections: Ключи выводимых секций
+    """
+    from openpyxl.formatting.rule import CellIsRule
+
+    _cell_styles = {_name: openpyxl_style(_style) for _name, _style in CELL_STYLES.items()}
+    _rule_styles = {_name: openpyxl_style(_style) for _name, _style in RULE_STYLES.items()}
+    for _coordinate, _value, _style in report_layout(sections):
+        if _value is not None:
+            ws[_coordinate] = _value
+        for _attribute, _style_value in _cell_styles[_style].items():
+            setattr(ws[_coordinate], _attribute, _style_value)
+    for _coordinate, _operator, _formula, _style in report_rules(sections):
+        ws.conditional_formatting.add(_coordinate, CellIsRule(operator=_operator, formula=[_formula], stopIfTrue=True, **_rule_styles[_style]))
+    return ws
+
+
+def make_report_template(file_name: [str, Path] = REPORT_TEMPLATE):
+    """
+    Создает шаблон отчетной таблицы. Для каждого набора секций в шаблоне отдельный лист
+
+    :param file_name: Имя файла шаблона
+    """
+    from openpyxl import Workbook
+
+    _optional = [_section for _section in REPORT_SECTIONS if _section not in ('build', 'kpi')]
+    wb = Workbook()
+    wb.remove(wb.active)
+    for _mask in range(2 ** len(_optional)):
+        _sections = ['build', 'kpi'] + [_section for _i, _section in enumerate(_optional) if _mask & (1 << _i)]
+        style_report_sheet(wb.create_sheet(title=report_variant(_sections)), _sections)
+    Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    wb.save(file_name)
+    print(f'Шаблон отчетной таблицы сохранен в "{file_name}"')
+
+
+if __name__ == "__main__":
+    make_report_template(sys.argv[1] if len(sys.argv) > 1 else REPORT_TEMPLATE)
@@ -0,0 +1,99 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Запись и воспроизведение ответов портала.
+
+В режиме записи (gdc_vols --record DIR) исходные ответы read_from_dashboard() и get_update_date() сохраняются в папку:
+    <папка>/objects/<2 первых символа хэша>/<sha256 содержимого>.gz - содержимое ответа, сжатое gzip
+    <папка>/responses.json - ключ запроса (тип данных и адрес без сервера): хэш, размер, время и параметры ответа
+Одинаковые ответы хранятся один раз. Повторная запись в ту же папку заменяет сведения об ответах на те же запросы.
+
+В режиме воспроизведения (gdc_vols --replay DIR) ответы читаются из папки без обращения к сети,
+содержимое проверяется по хэшу.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+
+RESPONSES_FILE = 'responses.json'
+OBJECTS_DIR = 'objects'
+
+
+class ResponseStore:
+    """Папка записанных ответов портала"""
+
+    def __init__(self, directory, replay: bool = False):
+        """
+        :param directory: Папка записанных ответов
+        :param replay: Воспроизведение (True) или запись (False)
+        """
+        self.directory = Path(directory)
+        self.replay = replay
+        self._lock = threading.Lock()
+        responses_file = Path(self.directory, RESPONSES_FILE)
+        if replay and not responses_file.is_file():
+            raise FileNotFoundError(f'Нет записанных ответов {responses_file}')
+        self.responses = json.loads(responses_file.read_text(encoding='utf-8')) if responses_file.is_file() else {}
+
+    @staticmethod
+    def key(kind: str, url) -> str:
+        # Адрес без схемы и сервера: записанные ответы воспроизводятся и при другом адресе портала (DASHBOARD_URL, DOWNLOAD_URL)
+        parts = urlsplit(str(url))
+        if parts.scheme in ('http', 'https'):
+            url = parts.path + (f'?{parts.query}' if parts.query else '')
+        return f'{kind.upper()} {url}'
+
+    def _object(self, digest: str) -> Path:
+        return Path(self.directory, OBJECTS_DIR, digest[:2], f'{digest}.gz')
+
+    def save(self, kind: str, url, content: bytes, **metadata):
+        """
+        Сохраняет ответ
+
+        :param kind: Тип данных запроса: JSON, EXCEL, FILE или UPDATE (дата обновления)
+        :param url: Адрес или путь к файлу
+        :param content: Содержимое ответа
+        :param metadata: Параметры ответа: код, тип содержимого, время получения
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        object_file = self._object(digest)
+        if not object_file.is_file():
+            object_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = object_file.with_name(f'.{object_file.name}.tmp')
+            # mtime=0: одинаковое содержимое дает одинаковый файл
+            temp_file.write_bytes(gzip.compress(content, mtime=0))
+            os.replace(temp_file, object_file)
+        with self._lock:
+            self.responses[self.key(kind, url)] = {
+                'kind': kind.upper(),
+                'url': str(url),
+                'sha256': digest,
+                'size': len(content),
+                'stored_size': object_file.stat().st_size,
+                'recorded': datetime.datetime.now().isoformat(timespec='seconds'),
+                **metadata,
+            }
+            responses_file = Path(self.directory, RESPONSES_FILE)
+            temp_file = responses_file.with_name(f'.{responses_file.name}.tmp')
+            temp_file.write_text(json.dumps(self.responses, ensure_ascii=False, indent=2), encoding='utf-8')
+            os.replace(temp_file, responses_file)
+
+    def load(self, kind: str, url) -> bytes:
+        """
+        Возвращает записанный ответ
+
+        :param kind: Тип данных запроса: JSON, EXCEL, FILE или UPDATE (дата обновления)
+        :param url: Адрес или путь к файлу
+        :return bytes:
+        """
+        response = self.responses.get(self.key(kind, url))
+        if response is None:
+            raise KeyError(f'Нет записанного ответа {kind.upper()} {url} в {self.directory}')
+        content = gzip.decompress(self._object(response['sha256']).read_bytes())
+        if hashlib.sha256(content).hexdigest() != response['sha256']:
+            raise ValueError(f'Записанный ответ {kind.upper()} {url} поврежден: хэш не совпадает')
+        return content
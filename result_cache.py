@@ -0,0 +1,358 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Кэш результатов расчета отчета: показатели отчетной таблицы, таблицы листов рассылки, листы Соц. соревнования.
+
+Один и тот же набор данных портала за день обрабатывается несколько раз с разными ключами (--new-algorithm, --active-year,
+--soc-report, --month). Результат делится на части (REPORT_PARTS), ключ части - отпечаток исходных таблиц, филиал, год,
+версия программы и только те ключи запуска, от которых часть зависит: при смене --active-year пересчитывается лишь лист
+активных мероприятий, показатели и воронка ТЗ берутся из кэша. В ключ входит и отпечаток кода расчета (CODE_MODULES):
+результаты прежней сборки программы после обновления не используются.
+
+Часть хранится в папке кэша без pickle: таблицы - файлами Arrow IPC <ключ>.<имя>.arrow, остальные значения и индексы таблиц,
+которые Arrow не записывает, - в описании части <ключ>.json. Время изменения описания обновляется при каждом чтении,
+при превышении размера папки удаляются давно не использованные части (LRU). Папка по умолчанию - папка кэша пользователя,
+папка, которую могут изменять другие пользователи, не используется.
+
+    cache = ResultCache(directory)
+    frames = cache.report_frames(compute, (build_df, ext_df, rec_df), {'branch': branch, ...}, {'month': 6, ...})
+"""
+import functools
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+from pandas.util import hash_pandas_object
+
+from Colors import Colors as Color
+from shared_frames import shareable
+from version import PROGRAM_NAME, PROGRAM_VERSION
+from vols_functions import REPORT_PARTS
+
+# Размер папки кэша по умолчанию, МБ
+RESULT_CACHE_SIZE = 256
+# Модули, код которых считает части отчета: изменение любого из них сбрасывает кэш
+CODE_MODULES = ('vols_functions', 'polars_pipeline', 'report_layout', 'gdc_vols')
+# Колонки string[pyarrow] записываются в Arrow как large_string, колонки object со строками - как string
+FRAME_TYPES = {pa.large_string(): pd.StringDtype('pyarrow')}
+
+
+def default_directory() -> Path:
+    """
+    Папка кэша результатов пользователя: %LOCALAPPDATA%\\gdc_vols\\results в Windows, $XDG_CACHE_HOME/gdc_vols/results
+    или ~/.cache/gdc_vols/results
+
+    :return Path:
+    """
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local'
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base, PROGRAM_NAME, 'results')
+
+
+def check_directory(directory: Path):
+    """
+    Проверяет, что папку кэша может изменять только текущий пользователь: владелец папки - пользователь программы,
+    запись группе и остальным запрещена. В Windows папка пользователя (LOCALAPPDATA) закрыта для других пользователей
+
+    :param directory: Папка кэша
+    """
+    if os.name == 'nt':
+        return
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise PermissionError(f'владелец папки {directory} - другой пользователь')
+    if stat.st_mode & 0o022:
+        raise PermissionError(f'папка {directory} доступна на запись группе или остальным пользователям')
+
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint() -> str:
+    """
+    Отпечаток кода расчета: исходные файлы модулей CODE_MODULES. В собранном exe исходных файлов нет, используется
+    байт-код модуля, если загрузчик его отдает (PyInstaller), иначе результаты разделяет только версия программы
+
+    :return str:
+    """
+    digest = hashlib.sha256()
+    for name in CODE_MODULES:
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            continue
+        try:
+            digest.update(Path(spec.origin).read_bytes())
+        except (TypeError, OSError):
+            try:
+                digest.update(marshal.dumps(spec.loader.get_code(name)))
+            except Exception as ex:
+                logger.debug(f'Нет кода модуля {name} для отпечатка кэша результатов: {ex}')
+    return digest.hexdigest()
+
+
+def _json_value(value):
+    # Числа numpy в показателях отчетной таблицы
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} не записывается в JSON')
+
+
+def _update(digest, values):
+    # Буферы колонок хэшируются без преобразования значений: строки Arrow, даты и числа numpy
+    if hasattr(values, '__arrow_array__'):
+        import pyarrow as pa
+
+        array = pa.array(values)
+        for chunk in array.chunks if isinstance(array, pa.ChunkedArray) else [array]:
+            digest.update(f'{chunk.offset} {len(chunk)}'.encode())
+            for buffer in chunk.buffers():
+                digest.update(b'-' if buffer is None else buffer)
+        return
+    array = np.asarray(values)
+    if array.dtype != object:
+        digest.update(np.ascontiguousarray(array).view(np.uint8).data)
+    else:
+        digest.update(hash_pandas_object(pd.Series(array), index=False).values.tobytes())
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Отпечаток таблицы: колонки, типы, индекс и значения. Буферы данных хэшируются напрямую, это в разы быстрее
+    hash_pandas_object для строк Arrow. Одинаковые по значениям таблицы могут дать разные отпечатки (например, срез таблицы
+    и его копия) - это только промах кэша, разные значения одного отпечатка не дают
+
+    :param df: Таблица
+    :return str:
+    """
+    # sha256 с аппаратным ускорением быстрее blake2b на десятках мегабайт данных таблицы
+    digest = hashlib.sha256()
+    digest.update(repr((list(df.columns), [str(dtype) for dtype in df.dtypes], df.shape)).encode())
+    if isinstance(df.index, pd.RangeIndex):
+        digest.update(repr(df.index).encode())
+    else:
+        _update(digest, df.index.array)
+    for _, series in df.items():
+        _update(digest, series.array)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Папка результатов расчета отчета"""
+
+    def __init__(self, directory, max_size: int = RESULT_CACHE_SIZE):
+        """
+        :param directory: Папка кэша
+        :param max_size: Размер папки, МБ
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # Папка, созданная до запуска, могла быть создана другим пользователем
+        check_directory(self.directory)
+        self.max_bytes = max_size * 2 ** 20
+        # Отпечатки таблиц запуска: таблица источника используется несколькими частями отчета
+        self._fingerprints = {}
+
+    def fingerprint(self, df):
+        """
+        Отпечаток таблицы, считается один раз для таблицы за время работы кэша
+
+        :param df: Таблица или None
+        :return str: Отпечаток или None
+        """
+        if df is None:
+            return None
+        if id(df) not in self._fingerprints:
+            # Таблица хранится вместе с отпечатком: id не переиспользуется другой таблицей
+            self._fingerprints[id(df)] = (df, frame_fingerprint(df))
+        return self._fingerprints[id(df)][1]
+
+    @staticmethod
+    def key(name: str, *fields) -> str:
+        """
+        Ключ части результата
+
+        :param name: Имя части
+        :param fields: Отпечатки и ключи запуска, от которых зависит часть
+        :return str:
+        """
+        description = json.dumps([name, PROGRAM_VERSION, code_fingerprint(), *fields], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        Часть результата из кэша
+
+        :param key: Ключ части
+        :return dict: Таблицы и значения части или None, если части нет в кэше
+        """
+        file = Path(self.directory, f'{key}.json')
+        try:
+            description = json.loads(file.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            logger.warning(f'Не удалось прочитать часть результата из кэша {file}: {ex}')
+            self.remove(key)
+            return None
+        try:
+            value = description['values']
+            for name, frame in description['frames'].items():
+                with pa.OSFile(str(Path(self.directory, f'{key}.{name}.arrow')), 'rb') as source:
+                    df = pa.ipc.open_file(source).read_all().to_pandas(types_mapper=FRAME_TYPES.get)
+                if frame['index'] is not None:
+                    df.index = pd.Index(frame['index'], dtype=object)
+                value[name] = df
+            os.utime(file)
+        except (OSError, pa.ArrowException, KeyError, ValueError) as ex:
+            logger.warning(f'Не удалось прочитать часть результата из кэша {file}: {ex}')
+            self.remove(key)
+            return None
+        return value
+
+    def put(self, key: str, value: dict):
+        """
+        Записывает часть результата и удаляет давно не использованные части при превышении размера папки.
+        Часть с таблицами, которые не восстанавливаются из Arrow с теми же значениями, или со значениями не JSON не записывается
+
+        :param key: Ключ части
+        :param value: Таблицы и значения части
+        """
+        description = {'values': {}, 'frames': {}}
+        tables = {}
+        try:
+            for name, item in value.items():
+                if not isinstance(item, pd.DataFrame):
+                    description['values'][name] = item
+                    continue
+                index = None
+                try:
+                    table = pa.Table.from_pandas(item)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # Индекс из чисел и строк (строка итогов листов Соц. соревнования) хранится в описании части
+                    index = item.index.tolist()
+                    table = pa.Table.from_pandas(item, preserve_index=False)
+                if not shareable(item, table):
+                    raise TypeError(f'таблица {name} изменится при записи в Arrow')
+                tables[name] = table
+                description['frames'][name] = {'index': index}
+            text = json.dumps(description, ensure_ascii=False, default=_json_value)
+        except (TypeError, ValueError, pa.ArrowException) as ex:
+            logger.debug(f'Часть результата {key} не записывается в кэш: {ex}')
+            return
+
+        def replace(file: Path, write):
+            temp_file = file.with_name(f'.{file.name}.{uuid.uuid4().hex}.tmp')
+            try:
+                write(temp_file)
+                os.replace(temp_file, file)
+            finally:
+                temp_file.unlink(missing_ok=True)
+
+        def write_table(table):
+            def write(temp_file):
+                with pa.OSFile(str(temp_file), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            return write
+
+        try:
+            for name, table in tables.items():
+                replace(Path(self.directory, f'{key}.{name}.arrow'), write_table(table))
+            # Описание записывается последним: часть без описания не читается
+            replace(Path(self.directory, f'{key}.json'), lambda temp_file: temp_file.write_text(text, encoding='utf-8'))
+        except (OSError, pa.ArrowException) as ex:
+            logger.warning(f'Не удалось записать часть результата в кэш {key}: {ex}')
+            self.remove(key)
+            return
+        self.evict(keep=key)
+
+    def remove(self, key: str):
+        """
+        Удаляет файлы части
+
+        :param key: Ключ части
+        """
+        for file in self.directory.glob(f'{key}.*'):
+            file.unlink(missing_ok=True)
+
+    def evict(self, keep: str = None):
+        """
+        Удаляет давно не использованные части, пока размер папки больше заданного
+
+        :param keep: Ключ части, которая не удаляется (только что записанная часть)
+        """
+        entries = {}
+        for file in self.directory.iterdir():
+            # Временные файлы записываемых частей
+            if file.name.startswith('.'):
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            key = file.name.split('.', 1)[0]
+            used, size = entries.get(key, (0, 0))
+            entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+            logger.debug(f'Из кэша результатов удалена часть {key}')
+
+    def cached(self, name: str, fields: list, compute):
+        """
+        Часть результата из кэша или расчет с записью в кэш
+
+        :param name: Имя части
+        :param fields: Отпечатки и ключи запуска, от которых зависит часть
+        :param compute: Расчет части без аргументов, dict таблиц и значений
+        :return dict:
+        """
+        key = self.key(name, *fields)
+        value = self.get(key)
+        if value is not None:
+            print(f'Результат {Color.GREEN}"{name}"{Color.END} взят из кэша результатов')
+            return value
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def report_frames(self, compute, sources: tuple, context: dict, options: dict) -> dict:
+        """
+        Результат report_frames() по частям: из кэша берутся части, ключ которых совпадает, остальные считаются одним вызовом
+
+        :param compute: Расчет выбранных частей, compute(parts) -> dict как у report_frames()
+        :param sources: Основное строительство, дополнительное строительство, реконструкция (таблицы или None)
+        :param context: Ключи, от которых зависят все части: филиал, год, способ расчета
+        :param options: Ключи запуска, от которых части зависят по REPORT_PARTS: month, new_algorithm, active_year
+        :return dict: metrics, current_month, tz, sending_po, received_po
+        """
+        fingerprints = [self.fingerprint(df) for df in sources]
+        keys = {part: self.key(f'report:{part}', fingerprints, context, {option: options[option] for option in part_options})
+                for part, (_, part_options) in REPORT_PARTS.items()}
+        frames = {}
+        missing = []
+        for part, key in keys.items():
+            value = self.get(key)
+            if value is None:
+                missing.append(part)
+            else:
+                frames.update(value)
+        if len(missing) < len(keys):
+            print(f'Части отчета {Color.GREEN}{", ".join(part for part in keys if part not in missing)}{Color.END} взяты из кэша результатов')
+        if missing:
+            computed = compute(missing)
+            for part in missing:
+                self.put(keys[part], {name: computed[name] for name in REPORT_PARTS[part][0]})
+            frames.update(computed)
+        return {name: frames[name] for names, _ in REPORT_PARTS.values() for name in names}
@@ -0,0 +1,84 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Таблицы для процессов обработки без передачи через pickle.
+
+Таблица записывается один раз в файл Arrow IPC (без сжатия) во временной папке, процессы открывают файл
+через memory map и получают части таблицы (диапазоны строк) без копирования данных файла: память страниц файла
+общая для всех процессов, добавление процессов не умножает ни память, ни время сериализации таблицы.
+
+    path = publish_frame(df, Path(tmp_dir, 'sheet.arrow'))
+    part = open_frame(path, 10000, 20000)  # в процессе обработки
+"""
+from pathlib import Path
+
+import pyarrow as pa
+from pandas import DataFrame, StringDtype
+
+# Строки Arrow - колонки string[pyarrow] без преобразования в объекты Python
+STRING_TYPES = {pa.string(): StringDtype('pyarrow'), pa.large_string(): StringDtype('pyarrow')}
+
+
+def shareable(df: DataFrame, table: pa.Table) -> bool:
+    """
+    Таблица восстанавливается из Arrow с теми же значениями: колонки object - строки, пустые значения - None
+    (строки сериализуются одинаково из object и string[pyarrow]). Колонки object с числами, датами или NaN
+    Arrow преобразует иначе, такая таблица передается процессам как раньше
+
+    :param df: Исходная таблица
+    :param table: Таблица Arrow
+    :return bool:
+    """
+    for index, (_, series) in enumerate(df.items()):
+        if series.dtype != object:
+            continue
+        if table.schema.field(index).type not in (*STRING_TYPES, pa.null()) or any(value is not None for value in series[series.isna()]):
+            return False
+    return True
+
+
+def publish_frame(df: DataFrame, path: Path):
+    """
+    Записывает таблицу в файл Arrow IPC
+
+    :param df: Таблица
+    :param path: Файл
+    :return Path: Файл или None, если таблицу нельзя передать через Arrow без изменения значений
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+    if not shareable(df, table):
+        return None
+    with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Path(path)
+
+
+def open_frame(path: Path, start: int = 0, stop: int = None) -> DataFrame:
+    """
+    Часть таблицы из файла Arrow IPC: строки start:stop. Данные колонок остаются в memory map файла,
+    копируются только колонки, которые pandas хранит иначе (даты и числа с пустыми значениями)
+
+    :param path: Файл publish_frame()
+    :param start: Первая строка
+    :param stop: Строка после последней, None - до конца таблицы
+    :return DataFrame:
+    """
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    stop = table.num_rows if stop is None else stop
+    return table.slice(start, stop - start).to_pandas(split_blocks=True, types_mapper=STRING_TYPES.get)
+
+
+def partitions(rows: int, parts: int) -> list:
+    """
+    Диапазоны строк для деления таблицы на части
+
+    :param rows: Количество строк
+    :param parts: Количество частей
+    :return list: [(start, stop), ...]
+    """
+    parts = max(1, min(parts, rows))
+    bounds = [rows * part // parts for part in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
@@ -0,0 +1,181 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Хранилище снимков данных портала.
+
+Каждый загруженный снимок представления дописывается в папку набора данных в формате Parquet с разбиением по дате:
+    <папка хранилища>/<набор>/date=ГГГГ-ММ-ДД/<ЧЧММССмкс>.parquet
+Записываются только версии строк, которых не было в предыдущем снимке (пара ID + хэш содержимого строки),
+и записи об удалении версий, которые из снимка пропали. История мероприятия — все его версии по времени снимка,
+состояние набора на любой момент восстанавливается из записей до этого момента (snapshot_at).
+
+Текущие пары ID + хэш набора хранятся в _state.parquet, типы колонок — в _schema.json.
+Файлы с префиксом "_" при чтении набора не учитываются.
+"""
+import datetime
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_integer_dtype, is_numeric_dtype
+from pandas.util import hash_pandas_object
+
+SNAPSHOT_DIR = Path('snapshots')
+KEY_COLUMN = 'ID'
+# Служебные колонки: хэш содержимого строки, время снимка, признак удаления версии строки
+HASH_COLUMN = '_row_hash'
+SNAPSHOT_COLUMN = '_snapshot'
+DELETED_COLUMN = '_deleted'
+SERVICE_COLUMNS = [HASH_COLUMN, SNAPSHOT_COLUMN, DELETED_COLUMN]
+STATE_FILE = '_state.parquet'
+SCHEMA_FILE = '_schema.json'
+# Типы колонок набора в типы Arrow
+ARROW_TYPES = {
+    'string': pa.string(),
+    'double': pa.float64(),
+    'int64': pa.int64(),
+    'timestamp': pa.timestamp('ms'),
+}
+
+
+def _column_type(series: pd.Series) -> str:
+    if is_datetime64_any_dtype(series):
+        return 'timestamp'
+    if is_numeric_dtype(series) and not is_bool_dtype(series):
+        return 'int64' if is_integer_dtype(series) else 'double'
+    return 'string'
+
+
+def _merge_types(types: dict, df: pd.DataFrame) -> dict:
+    """
+    Дополняет типы колонок набора колонками снимка. Колонка без значений тип не меняет,
+    целые расширяются до double, остальные несовпадения — до string
+    """
+    types = dict(types)
+    for column in df.columns:
+        column_type = _column_type(df[column])
+        if column not in types:
+            types[column] = column_type
+        elif types[column] != column_type and df[column].notna().any():
+            types[column] = 'double' if {types[column], column_type} == {'int64', 'double'} else 'string'
+    return types
+
+
+def _normalize(df: pd.DataFrame, types: dict) -> pd.DataFrame:
+    """Приводит колонки снимка к типам набора, чтобы хэш строки не зависел от вывода типов pandas"""
+    columns = {}
+    for column in df.columns:
+        if types[column] == 'string':
+            columns[column] = df[column].astype('string')
+        elif types[column] == 'timestamp':
+            columns[column] = pd.to_datetime(df[column], errors='coerce').astype('datetime64[ms]')
+        elif types[column] == 'int64' and df[column].notna().all():
+            columns[column] = df[column].astype('int64')
+        else:
+            columns[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _schema(columns, types: dict) -> pa.Schema:
+    return pa.schema([(column, ARROW_TYPES[types[column]]) for column in columns])
+
+
+def _read_types(path: Path) -> dict:
+    schema_file = Path(path, SCHEMA_FILE)
+    return json.loads(schema_file.read_text(encoding='utf-8')) if schema_file.is_file() else {}
+
+
+def _read_state(path: Path, types: dict) -> pd.DataFrame:
+    state_file = Path(path, STATE_FILE)
+    if state_file.is_file():
+        return pq.read_table(state_file).to_pandas()
+    return _normalize(pd.DataFrame({KEY_COLUMN: []}), types).assign(**{HASH_COLUMN: pd.Series([], dtype='uint64')})
+
+
+def _write_file(table: pa.Table, file_name: Path):
+    # Запись во временный файл с префиксом ".", который не читается как часть набора, затем переименование
+    temp_file = file_name.with_name(f'.{file_name.name}')
+    pq.write_table(table, temp_file, use_dictionary=True, compression='zstd')
+    os.replace(temp_file, file_name)
+
+
+def append_snapshot(df: pd.DataFrame, directory, dataset: str, snapshot_time: datetime.datetime = None) -> tuple:
+    """
+    Дописывает снимок представления в набор хранилища
+
+    :param df: Данные снимка, колонка ID обязательна
+    :param directory: Папка хранилища
+    :param dataset: Имя набора данных (папки в хранилище)
+    :param snapshot_time: Время снимка, по умолчанию текущее
+    :return tuple: Количество новых версий строк и количество удаленных версий
+    """
+    snapshot_time = datetime.datetime.now() if snapshot_time is None else snapshot_time
+    path = Path(directory, dataset)
+    path.mkdir(parents=True, exist_ok=True)
+    types = _merge_types(_read_types(path), df)
+    frame = _normalize(df, types)
+    frame[HASH_COLUMN] = hash_pandas_object(frame, index=False).values
+
+    # Сравнение пар ID + хэш с предыдущим состоянием набора
+    current = frame[[KEY_COLUMN, HASH_COLUMN]].drop_duplicates()
+    state = _read_state(path, types)
+    pairs = pd.MultiIndex.from_frame(state[[KEY_COLUMN, HASH_COLUMN]])
+    added = frame[~pd.MultiIndex.from_frame(frame[[KEY_COLUMN, HASH_COLUMN]]).isin(pairs)].drop_duplicates(subset=[KEY_COLUMN, HASH_COLUMN])
+    removed = state[~pairs.isin(pd.MultiIndex.from_frame(current))]
+
+    if not added.empty or not removed.empty:
+        rows = pd.concat([added.assign(**{DELETED_COLUMN: False}), removed.assign(**{DELETED_COLUMN: True})], ignore_index=True)
+        rows[SNAPSHOT_COLUMN] = pd.Timestamp(snapshot_time).as_unit('ms')
+        schema = _schema(frame.columns.drop(HASH_COLUMN), types).append(pa.field(HASH_COLUMN, pa.uint64())) \
+            .append(pa.field(SNAPSHOT_COLUMN, pa.timestamp('ms'))).append(pa.field(DELETED_COLUMN, pa.bool_()))
+        table = pa.Table.from_pandas(rows, schema=schema, preserve_index=False, safe=False)
+        partition = Path(path, f'date={snapshot_time.date().isoformat()}')
+        partition.mkdir(exist_ok=True)
+        _write_file(table, Path(partition, f'{snapshot_time.strftime("%H%M%S%f")}.parquet'))
+    Path(path, SCHEMA_FILE).write_text(json.dumps(types, ensure_ascii=False, indent=2), encoding='utf-8')
+    _write_file(pa.Table.from_pandas(current, preserve_index=False), Path(path, STATE_FILE))
+    return len(added), len(removed)
+
+
+def read_history(directory, dataset: str, filter_expression: ds.Expression = None, columns: list = None) -> pd.DataFrame:
+    """
+    Читает все версии строк набора, отсортированные по ID и времени снимка
+
+    :param directory: Папка хранилища
+    :param dataset: Имя набора данных
+    :param filter_expression: Условие отбора pyarrow.dataset, например ds.field('ID') == 100001
+    :param columns: Колонки данных, по умолчанию все. Служебные колонки добавляются всегда
+    :return DataFrame:
+    """
+    path = Path(directory, dataset)
+    types = _read_types(path)
+    if not types:
+        raise FileNotFoundError(f'Набор данных "{dataset}" не найден в хранилище "{directory}"')
+    schema = _schema(types, types).append(pa.field(HASH_COLUMN, pa.uint64())).append(pa.field(SNAPSHOT_COLUMN, pa.timestamp('ms'))) \
+        .append(pa.field(DELETED_COLUMN, pa.bool_())).append(pa.field('date', pa.date32()))
+    history = ds.dataset(path, format='parquet', partitioning='hive', schema=schema)
+    columns = None if columns is None else list(dict.fromkeys([KEY_COLUMN] + columns + SERVICE_COLUMNS))
+    df = history.to_table(filter=filter_expression, columns=columns).to_pandas()
+    return df.drop(columns='date', errors='ignore').sort_values([KEY_COLUMN, SNAPSHOT_COLUMN], kind='stable').reset_index(drop=True)
+
+
+def snapshot_at(directory, dataset: str, moment: datetime.datetime = None, before: bool = False) -> pd.DataFrame:
+    """
+    Восстанавливает состояние набора на момент времени
+
+    :param directory: Папка хранилища
+    :param dataset: Имя набора данных
+    :param moment: Момент времени, по умолчанию последнее состояние
+    :param before: Не учитывать снимок, сделанный ровно в момент moment
+    :return DataFrame: Строки набора без служебных колонок
+    """
+    filter_expression = None
+    if moment is not None:
+        moment = pa.scalar(pd.Timestamp(moment).as_unit('ms'), type=pa.timestamp('ms'))
+        filter_expression = ds.field(SNAPSHOT_COLUMN) < moment if before else ds.field(SNAPSHOT_COLUMN) <= moment
+    history = read_history(directory, dataset, filter_expression)
+    history = history.drop_duplicates(subset=[KEY_COLUMN, HASH_COLUMN], keep='last')
+    return history[~history[DELETED_COLUMN]].drop(columns=SERVICE_COLUMNS).reset_index(drop=True)
@@ -0,0 +1,128 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Граф этапов формирования отчета: этап выполняется, когда готовы результаты этапов, от которых он зависит.
+
+Этап описывается функцией и входами - именами этапов, результаты которых передаются в функцию аргументами.
+Порядок без передачи данных задается after: этап ждет перечисленные этапы, только если они выполняются в этом запуске
+(запись листов в книгу Excel идет по одному и в порядке листов отчета).
+Выполняются только этапы, нужные для запрошенных целей, независимые этапы - параллельно в пуле потоков:
+загрузка следующего источника идет одновременно с обработкой предыдущего, рассылка - одновременно с записью листов.
+
+    stages = [Stage('fetch', fetch), Stage('prepare', prepare, inputs=['fetch']), Stage('write', write, inputs=['prepare'])]
+    results = run_stages(stages, ['write'])
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Количество потоков выполнения этапов
+STAGE_WORKERS = 8
+
+
+class Stage:
+    """Этап графа"""
+
+    def __init__(self, name: str, func, inputs=(), after=()):
+        """
+        :param name: Имя этапа
+        :param func: Функция этапа, аргументы - результаты этапов inputs
+        :param inputs: Этапы, результаты которых нужны функции
+        :param after: Этапы, после которых выполняется этап, если они выполняются в этом запуске
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.after = tuple(after)
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, inputs={self.inputs!r})'
+
+
+def required_stages(stages: dict, targets) -> list:
+    """
+    Этапы, нужные для целей, в порядке описания
+
+    :param stages: {имя: Stage}
+    :param targets: Имена этапов - целей
+    :return list: Имена этапов
+    """
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name in required:
+            continue
+        if name not in stages:
+            raise KeyError(f'Нет этапа {name}')
+        required.add(name)
+        pending += stages[name].inputs
+    return [name for name in stages if name in required]
+
+
+def run_stages(stages, targets, workers: int = STAGE_WORKERS) -> dict:
+    """
+    Выполняет этапы, нужные для целей. Ошибка этапа (и sys.exit) не останавливает этапы, которые от него не зависят:
+    не выполняются только этапы, ждущие его (inputs или after), в том числе через другие этапы. Первая ошибка
+    передается вызывающему после окончания остальных этапов
+
+    :param stages: Список Stage
+    :param targets: Имена этапов - целей
+    :param workers: Количество потоков, при 1 этапы выполняются по очереди в текущем потоке
+    :return dict: {имя этапа: результат}
+    """
+    stages = {stage.name: stage for stage in stages}
+    selected = required_stages(stages, targets)
+    waits = {name: set(stages[name].inputs) | {after for after in stages[name].after if after in selected} for name in selected}
+    results = {}
+    # Ошибки этапов, у этапов, пропущенных из-за ошибки другого этапа, - None
+    failed = {}
+
+    def ready():
+        skipped = True
+        while skipped:
+            skipped = [name for name in waits if waits[name] & failed.keys()]
+            for name in skipped:
+                del waits[name]
+                failed[name] = None
+        finished = results.keys() | failed.keys()
+        return [name for name in selected if name in waits and waits[name] <= finished]
+
+    def call(name):
+        return stages[name].func(*(results[source] for source in stages[name].inputs))
+
+    def deadlock():
+        return ValueError(f'Этапы ждут друг друга: {", ".join(waits)}')
+
+    if workers <= 1:
+        while True:
+            names = ready()
+            if not names:
+                break
+            del waits[names[0]]
+            try:
+                results[names[0]] = call(names[0])
+            except (Exception, SystemExit) as ex:
+                failed[names[0]] = ex
+    else:
+        pool = ThreadPoolExecutor(workers, thread_name_prefix='stage')
+        running = {}
+        try:
+            while True:
+                for name in ready():
+                    del waits[name]
+                    running[pool.submit(call, name)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        results[name] = future.result()
+                    else:
+                        failed[name] = future.exception()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    if waits:
+        raise deadlock()
+    errors = [error for error in failed.values() if error is not None]
+    if errors:
+        raise errors[0]
+    return results
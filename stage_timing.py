@@ -0,0 +1,274 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Замеры этапов обработки: время выполнения, процессорное время потока и пиковая память процесса (RSS).
+
+Этап оборачивается в контекстный менеджер span(), этапы внутри другого этапа того же потока связываются с ним:
+    with span('fetch', url=url):
+        ...
+Функция или метод целиком замеряется декоратором timed(), метки этапа берутся из аргументов вызова:
+    @timed('sheet', sheet='save_sheet_name')
+    def excel_format_table(self, df, save_sheet_name, save_table_name):
+Пока запись запуска не начата (start_run), span() и timed() ничего не замеряют.
+Запись запуска сохраняется при завершении процесса, после окончания фоновых потоков рассылки и копирования отчета:
+в JSON и, если задано, в текстовый файл Prometheus для textfile collector node exporter.
+"""
+import atexit
+import datetime
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager, nullcontext
+from pathlib import Path
+
+METRIC_PREFIX = 'gdc_vols'
+# Период опроса памяти процесса во время этапов, с
+SAMPLE_INTERVAL = 0.05
+
+_run = None
+# Обработчики этапов (add_hook)
+_hooks = []
+
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict) -> str:
+    return ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items())
+
+
+class RunRecord:
+    """Запись запуска: этапы с замерами и итог выполнения"""
+
+    def __init__(self, program: str, version: str, json_file=None, prometheus_file=None, process=None):
+        """
+        :param program: Имя программы
+        :param version: Версия программы
+        :param json_file: Файл записи запуска JSON
+        :param prometheus_file: Текстовый файл метрик Prometheus
+        :param process: psutil.Process для замера памяти, при None память не замеряется
+        """
+        self.program = program
+        self.version = version
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.process = process
+        self.started = datetime.datetime.now()
+        self.status = None
+        self.spans = []
+        self._start = time.perf_counter()
+        self._open = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        if self.process is not None:
+            threading.Thread(target=self._sample, name='stage_timing', daemon=True).start()
+
+    def _rss(self):
+        return self.process.memory_info().rss if self.process is not None else None
+
+    def _sample(self):
+        # Пиковая память этапа: максимум RSS за время выполнения всех открытых этапов
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            rss = self._rss()
+            with self._lock:
+                for record in self._open.values():
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+
+    @contextmanager
+    def span(self, name: str, labels: dict):
+        stack = self._local.__dict__.setdefault('stack', [])
+        rss = self._rss()
+        with self._lock:
+            record = {
+                'id': self._next_id,
+                'parent': stack[-1]['id'] if stack else None,
+                'name': name,
+                'labels': {label: str(value) for label, value in labels.items()},
+                'thread': threading.current_thread().name,
+                'start': round(time.perf_counter() - self._start, 6),
+                'rss_start': rss,
+                'peak_rss': rss,
+            }
+            self._next_id += 1
+            self._open[record['id']] = record
+        stack.append(record)
+        # Работа обработчиков не входит во время этапа
+        with ExitStack() as hooks:
+            for hook in _hooks:
+                hooks.enter_context(hook(record))
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                yield record
+            except BaseException as ex:
+                record['error'] = f'{type(ex).__name__}: {ex}'
+                raise
+            finally:
+                record['wall'] = round(time.perf_counter() - wall, 6)
+                record['cpu'] = round(time.thread_time() - cpu, 6)
+                stack.pop()
+                rss = self._rss()
+                with self._lock:
+                    del self._open[record['id']]
+                    record['rss_end'] = rss
+                    if rss is not None:
+                        record['peak_rss'] = max(record['peak_rss'], rss)
+                    self.spans.append(record)
+
+    def summary(self) -> list:
+        """Этапы, сгруппированные по имени и меткам: количество, суммарное время и максимальная пиковая память"""
+        stages = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record['id'])
+        for record in spans:
+            key = (record['name'], tuple(record['labels'].items()))
+            stage = stages.setdefault(key, {'name': record['name'], 'labels': record['labels'], 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': None})
+            stage['count'] += 1
+            stage['wall'] += record['wall']
+            stage['cpu'] += record['cpu']
+            if record['peak_rss'] is not None:
+                stage['peak_rss'] = max(stage['peak_rss'] or 0, record['peak_rss'])
+        return list(stages.values())
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record['id'])
+        return {
+            'program': self.program,
+            'version': self.version,
+            'argv': sys.argv[1:],
+            'started': self.started.isoformat(timespec='seconds'),
+            'duration': round(time.perf_counter() - self._start, 6),
+            'status': self.status,
+            'spans': spans,
+            'stages': self.summary(),
+        }
+
+    def prometheus(self) -> str:
+        """Метрики последнего запуска в текстовом формате Prometheus"""
+        lines = []
+        metrics = {
+            'stage_duration_seconds': ('Время выполнения этапа в последнем запуске', 'wall'),
+            'stage_cpu_seconds': ('Процессорное время потока этапа в последнем запуске', 'cpu'),
+            'stage_peak_rss_bytes': ('Пиковая память процесса во время этапа в последнем запуске', 'peak_rss'),
+            'stage_count': ('Количество выполнений этапа в последнем запуске', 'count'),
+        }
+        summary = self.summary()
+        for metric, (description, field) in metrics.items():
+            lines += [f'# HELP {METRIC_PREFIX}_{metric} {description}', f'# TYPE {METRIC_PREFIX}_{metric} gauge']
+            for stage in summary:
+                if stage[field] is not None:
+                    lines.append(f'{METRIC_PREFIX}_{metric}{{{_labels({"stage": stage["name"], **stage["labels"]})}}} {stage[field]}')
+        lines += [
+            f'# HELP {METRIC_PREFIX}_last_run_timestamp_seconds Время начала последнего запуска',
+            f'# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge',
+            f'{METRIC_PREFIX}_last_run_timestamp_seconds {self.started.timestamp():.0f}',
+            f'# HELP {METRIC_PREFIX}_last_run_duration_seconds Время выполнения последнего запуска',
+            f'# TYPE {METRIC_PREFIX}_last_run_duration_seconds gauge',
+            f'{METRIC_PREFIX}_last_run_duration_seconds {time.perf_counter() - self._start:.6f}',
+            f'# HELP {METRIC_PREFIX}_last_run_exit_code Код завершения последнего запуска',
+            f'# TYPE {METRIC_PREFIX}_last_run_exit_code gauge',
+            f'{METRIC_PREFIX}_last_run_exit_code{{{_labels({"version": self.version})}}} {self.status if self.status is not None else -1}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Сохраняет запись запуска. Файлы пишутся во временный файл и переименовываются, чтобы node exporter не прочитал их частично"""
+        self._stopped.set()
+        for file_name, text in ((self.json_file, lambda: json.dumps(self.to_dict(), ensure_ascii=False, indent=2)), (self.prometheus_file, self.prometheus)):
+            if file_name is None:
+                continue
+            file_name = Path(file_name)
+            temp_file = file_name.with_name(f'.{file_name.name}.tmp')
+            try:
+                file_name.parent.mkdir(parents=True, exist_ok=True)
+                temp_file.write_text(text(), encoding='utf-8')
+                os.replace(temp_file, file_name)
+            except OSError as ex:
+                print(f'Ошибка записи замеров этапов в файл "{file_name}": {ex}', file=sys.stderr)
+
+
+def start_run(program: str, version: str, json_file=None, prometheus_file=None, process=None) -> RunRecord:
+    """
+    Начинает запись запуска. Запись сохраняется при завершении процесса
+
+    :param program: Имя программы
+    :param version: Версия программы
+    :param json_file: Файл записи запуска JSON
+    :param prometheus_file: Текстовый файл метрик Prometheus
+    :param process: psutil.Process для замера памяти
+    :return RunRecord:
+    """
+    global _run
+    _run = RunRecord(program, version, json_file, prometheus_file, process)
+    atexit.register(_run.write)
+    return _run
+
+
+def finish_run(code=None):
+    """
+    Сохраняет и закрывает запись запуска до завершения процесса (несколько запусков в одном процессе, gdc_vols serve)
+
+    :param code: Код завершения запуска
+    """
+    global _run
+    if _run is None:
+        return
+    set_status(code)
+    atexit.unregister(_run.write)
+    _run.write()
+    _run = None
+
+
+def add_hook(hook):
+    """
+    Добавляет обработчик этапов: функция hook(record) возвращает контекстный менеджер, который выполняется вокруг этапа.
+    В запись этапа record обработчик может добавить свои замеры, они сохраняются в записи запуска
+
+    :param hook: Обработчик этапов
+    """
+    _hooks.append(hook)
+
+
+def set_status(code):
+    """Код завершения запуска для записи: 0 — успешно"""
+    if _run is not None:
+        _run.status = code if isinstance(code, int) else (0 if code is None else 1)
+
+
+def span(name: str, **labels):
+    """
+    Замер этапа обработки
+
+    :param name: Имя этапа
+    :param labels: Метки этапа: лист, адрес данных и т.п.
+    """
+    if _run is None:
+        return nullcontext()
+    return _run.span(name, labels)
+
+
+def timed(name: str, **arguments):
+    """
+    Декоратор: замер вызова функции как этапа обработки
+
+    :param name: Имя этапа
+    :param arguments: Метки этапа: метка='имя аргумента функции'
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _run is None:
+                return function(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            with _run.span(name, {label: bound.arguments.get(argument) for label, argument in arguments.items()}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,7 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""Имя и версия программы. Отдельный модуль без зависимостей: импортируется и gdc_vols, и модулями обработки"""
+
+PROGRAM_NAME: str = "gdc_vols"
+# Версия входит в ключ кэша результатов (result_cache): в сборке без исходного и байт-кода модулей (Nuitka)
+# результаты прежней сборки разделяет только она, изменение кода расчета должно сопровождаться сменой версии
+PROGRAM_VERSION: str = "0.7.2"
@@ -0,0 +1,318 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Распределенное формирование отчетов по филиалам и годам на нескольких компьютерах (gdc_vols farm).
+
+Координатор (farm submit) один раз загружает представления портала (JSON API) и дату обновления за каждый год,
+делит мероприятия по филиалам и публикует задания в общей папке очереди (сетевая папка):
+    <очередь>/data/<год> <филиал>/  - данные задания: записанные ответы портала только с мероприятиями филиала (response_store)
+    <очередь>/pending/<задание>.json - задания, ожидающие исполнителя
+    <очередь>/running/<задание>.json - задания в работе, время изменения файла - последний сигнал исполнителя
+    <очередь>/done/<задание>.json    - выполненные задания, failed/<задание>.json - задания, завершившиеся ошибкой
+Исполнители (farm work) на любом количестве компьютеров забирают задания переименованием файла из pending в running
+(задание достается одному исполнителю) и формируют отчет и рассылку вызовом main() с --replay по данным задания,
+как gdc_vols serve: библиотеки загружаются один раз на все задания исполнителя. Результат (код завершения, время, исполнитель)
+записывается в файл задания в done или failed. Задание исполнителя, который перестал подавать сигнал дольше --lease секунд,
+возвращается в очередь другим исполнителем.
+
+gdc_vols farm submit --queue //server/farm -y 2024 2025 --output-dir //server/reports -- -l --soc-report
+gdc_vols farm work --queue //server/farm
+gdc_vols farm status --queue //server/farm
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import socket
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from Colors import Colors as Color
+
+STATES = ('pending', 'running', 'done', 'failed')
+DATA_DIR = 'data'
+# Колонка филиала в представлениях портала, как process_columns['branch'] в gdc_vols
+BRANCH_COLUMN = 'Филиал'
+# Период проверки очереди исполнителем, с
+POLL_INTERVAL = 30
+# Период сигнала исполнителя и время без сигнала, после которого задание возвращается в очередь, с
+HEARTBEAT_INTERVAL = 30
+LEASE_TIMEOUT = 600
+# Количество попыток выполнения задания, после которых задание считается завершившимся ошибкой
+MAX_ATTEMPTS = 3
+# Символы, недопустимые в именах файлов
+INVALID_NAME_CHARACTERS = re.compile(r'[\\/:*?"<>|]')
+# Аргументы формирования отчета, которые задает задание
+ITEM_ARGUMENTS = {'year': '-y', 'report_branch': '-b', 'report_file': '-r', 'record': '--record', 'replay': '--replay'}
+
+
+def _write_json(path: Path, data: dict):
+    temp_file = path.with_name(f'.{path.name}.tmp')
+    temp_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding='utf-8')
+    os.replace(temp_file, path)
+
+
+def item_name(year: int, branch: str) -> str:
+    """Имя задания и папки данных филиала: без символов, недопустимых в именах файлов"""
+    return f'{year} {INVALID_NAME_CHARACTERS.sub("_", branch)}'
+
+
+def partition(content: bytes, branches=None) -> dict:
+    """
+    Делит ответ API портала по филиалам
+
+    :param content: Ответ портала (массив объектов JSON)
+    :param branches: Филиалы, None - все филиалы представления
+    :return dict: {филиал: ответ с мероприятиями филиала}
+    """
+    try:
+        import orjson
+        loads, dumps = orjson.loads, orjson.dumps
+    except ImportError:
+        loads, dumps = json.loads, lambda records: json.dumps(records, ensure_ascii=False).encode('utf-8')
+    records = loads(content)
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get(BRANCH_COLUMN), []).append(record)
+    # Представление без мероприятий филиала: строка без филиала сохраняет колонки, main() отбрасывает ее отбором по филиалу
+    empty = [dict.fromkeys(records[0]) if records else {BRANCH_COLUMN: None}]
+    return {branch: dumps(groups.get(branch) or empty) for branch in (branches if branches is not None else groups) if branch is not None}
+
+
+class FarmQueue:
+    """Папка очереди заданий"""
+
+    def __init__(self, directory):
+        """
+        :param directory: Папка очереди
+        """
+        self.directory = Path(directory)
+        for state in STATES:
+            Path(self.directory, state).mkdir(parents=True, exist_ok=True)
+
+    def path(self, state: str, name: str) -> Path:
+        return Path(self.directory, state, f'{name}.json')
+
+    def items(self, state: str) -> list:
+        """Задания в состоянии state, по порядку публикации"""
+        items = []
+        for path in sorted(Path(self.directory, state).glob('*.json')):
+            try:
+                items.append((path, json.loads(path.read_text(encoding='utf-8'))))
+            except (OSError, ValueError):
+                # Задание забрал другой исполнитель
+                continue
+        return sorted(items, key=lambda item: item[1].get('submitted', ''))
+
+    def publish(self, item: dict):
+        """Публикует задание, прежний результат задания с тем же именем удаляется"""
+        for state in ('done', 'failed'):
+            self.path(state, item['name']).unlink(missing_ok=True)
+        _write_json(self.path('pending', item['name']), item)
+
+    def claim(self, worker: str):
+        """
+        Забирает первое ожидающее задание
+
+        :param worker: Исполнитель
+        :return tuple: Файл задания в running и задание, None - заданий нет
+        """
+        for path, item in self.items('pending'):
+            running = self.path('running', item['name'])
+            try:
+                # Переименование атомарно: задание достается только одному исполнителю
+                os.rename(path, running)
+            except OSError:
+                continue
+            item.update(worker=worker, started=datetime.datetime.now().isoformat(timespec='seconds'), attempts=item.get('attempts', 0) + 1)
+            _write_json(running, item)
+            return running, item
+        return None
+
+    def finish(self, running: Path, item: dict, code: int):
+        """Переносит задание в done (код 0) или failed"""
+        finished = datetime.datetime.now()
+        item.update(code=code, finished=finished.isoformat(timespec='seconds'),
+                    elapsed=round((finished - datetime.datetime.fromisoformat(item['started'])).total_seconds(), 1))
+        state = 'done' if code == 0 else 'failed'
+        _write_json(self.path(state, item['name']), item)
+        running.unlink(missing_ok=True)
+        return state
+
+    def requeue_expired(self, lease: float) -> list:
+        """
+        Возвращает в очередь задания исполнителей без сигнала дольше lease секунд
+
+        :param lease: Время без сигнала, с
+        :return list: Имена возвращенных заданий
+        """
+        requeued = []
+        for path, item in self.items('running'):
+            try:
+                if time.time() - path.stat().st_mtime < lease:
+                    continue
+                state = 'pending' if item.get('attempts', 0) < MAX_ATTEMPTS else 'failed'
+                os.rename(path, self.path(state, item['name']))
+            except OSError:
+                continue
+            logger.warning(f'Исполнитель {item.get("worker")} не подает сигнал, задание "{item["name"]}" перенесено в {state}')
+            requeued.append(item['name'])
+        return requeued
+
+
+def submit(args, report_argv: list, report_args, portal_urls) -> int:
+    """Координатор: загрузка представлений, деление по филиалам и публикация заданий"""
+    from response_store import ResponseStore
+    from vols_functions import http_get
+
+    check_ssl = not report_args.ignore_cert
+    queue = FarmQueue(args.queue)
+    submitted = 0
+    for year in args.year or [datetime.date.today().year]:
+        api_urls, _, _, last_update_url = portal_urls(year)
+        responses = {}
+        try:
+            update = http_get(last_update_url, check_ssl)
+            update.raise_for_status()
+            for sheet, url in api_urls.items():
+                print(f'Получаем данные из: "{url}"')
+                response = http_get(url, check_ssl)
+                response.raise_for_status()
+                responses[url] = partition(response.content, args.branches)
+        except Exception as ex:
+            logger.error(f'Ошибка загрузки данных портала за {year} год: {ex}')
+            return 1
+        branches = sorted({branch for parts in responses.values() for branch in parts})
+        print(f'{year} год, дата обновления {json.loads(update.content)[0]["DATE_LAST_UPDATE"]}: филиалов {Color.GREEN}{len(branches)}{Color.END}')
+        for branch in branches:
+            name = item_name(year, branch)
+            store = ResponseStore(Path(queue.directory, DATA_DIR, name))
+            store.save('UPDATE', last_update_url, update.content, status=update.status_code)
+            for url, parts in responses.items():
+                store.save('JSON', url, parts[branch], partition=branch)
+            argv = ['-y', str(year), '-b', branch, '--replay', str(store.directory)]
+            report_file = str(Path(args.output_dir, str(year), f'{name}.xlsx')) if args.output_dir is not None else None
+            if report_file is not None:
+                argv += ['-r', report_file]
+            queue.publish({'name': name, 'year': year, 'branch': branch, 'report_file': report_file, 'argv': argv + report_argv,
+                           'submitted': datetime.datetime.now().isoformat(timespec='microseconds')})
+            submitted += 1
+    print(f'Опубликовано заданий: {Color.GREEN}{submitted}{Color.END} в очереди {Color.GREEN}"{queue.directory}"{Color.END}')
+    return 0
+
+
+def work(args, main) -> int:
+    """Исполнитель: выполнение заданий очереди"""
+    from vols_serve import run_report
+
+    queue = FarmQueue(args.queue)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    processed = 0
+    code = 0
+    print(f'Исполнитель {Color.GREEN}{worker}{Color.END}, очередь {Color.GREEN}"{queue.directory}"{Color.END}')
+    try:
+        while args.max_items is None or processed < args.max_items:
+            queue.requeue_expired(args.lease)
+            claimed = queue.claim(worker)
+            if claimed is None:
+                if args.once:
+                    break
+                time.sleep(args.interval)
+                continue
+            running, item = claimed
+            print(f'{Color.DARKCYAN}{datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")}:{Color.END} задание {Color.GREEN}"{item["name"]}"{Color.END}')
+            # Сигнал исполнителя: время изменения файла задания
+            stop = threading.Event()
+
+            def heartbeat():
+                while not stop.wait(HEARTBEAT_INTERVAL):
+                    try:
+                        os.utime(running)
+                    except OSError:
+                        return
+
+            threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+            try:
+                if item.get('report_file') is not None:
+                    Path(item['report_file']).parent.mkdir(parents=True, exist_ok=True)
+                item_code, _ = run_report(main, item['argv'])
+            finally:
+                stop.set()
+            state = queue.finish(running, item, item_code)
+            if item_code != 0:
+                logger.error(f'Задание "{item["name"]}" завершилось с кодом {item_code}')
+                code = item_code
+            print(f'Задание {Color.GREEN}"{item["name"]}"{Color.END}: {state}, {item["elapsed"]} с')
+            processed += 1
+    except KeyboardInterrupt:
+        pass
+    print(f'Выполнено заданий: {Color.GREEN}{processed}{Color.END}')
+    return code
+
+
+def status(args) -> int:
+    """Состояние очереди"""
+    queue = FarmQueue(args.queue)
+    items = {state: queue.items(state) for state in STATES}
+    print(', '.join(f'{state}: {len(items[state])}' for state in STATES))
+    now = time.time()
+    for path, item in items['running']:
+        print(f'  running  {item["name"]:<40} {item.get("worker", "")}, сигнал {now - path.stat().st_mtime:.0f} с назад')
+    for _, item in items['failed']:
+        print(f'  {Color.RED}failed{Color.END}   {item["name"]:<40} код {item.get("code")}, {item.get("worker", "")}')
+    done = [item['elapsed'] for _, item in items['done'] if 'elapsed' in item]
+    if done:
+        print(f'  done: {sum(done):.0f} с работы исполнителей, {len({item["worker"] for _, item in items["done"]})} исполнителей')
+    return 1 if items['failed'] else 0
+
+
+def farm_main(argv, main, build_parser, portal_urls) -> int:
+    """
+    Подкоманда gdc_vols farm
+
+    :param argv: Аргументы подкоманды
+    :param main: gdc_vols.main
+    :param build_parser: gdc_vols.build_parser
+    :param portal_urls: gdc_vols.portal_urls
+    """
+    parser = argparse.ArgumentParser(prog='gdc_vols farm', description='Распределенное формирование отчетов по филиалам и годам')
+    commands = parser.add_subparsers(dest='command', required=True)
+    submit_parser = commands.add_parser('submit', help='Загрузить данные портала и опубликовать задания по филиалам',
+                                        epilog='Аргументы формирования отчета gdc_vols указываются после --')
+    submit_parser.add_argument('--queue', required=True, metavar='DIR', help='Папка очереди (общая для координатора и исполнителей)')
+    submit_parser.add_argument('-y', '--year', type=int, nargs='+', help='Годы отчета (по умолчанию текущий)')
+    submit_parser.add_argument('--branches', nargs='+', help='Филиалы (по умолчанию все филиалы представлений)')
+    submit_parser.add_argument('--output-dir', metavar='DIR', help='Папка отчетов: <DIR>/<год>/<задание>.xlsx (по умолчанию папка отчета gdc_vols)')
+    submit_parser.add_argument('report_args', nargs=argparse.REMAINDER, help='Аргументы формирования отчета')
+    work_parser = commands.add_parser('work', help='Выполнять задания очереди')
+    work_parser.add_argument('--queue', required=True, metavar='DIR', help='Папка очереди')
+    work_parser.add_argument('--once', action='store_true', help='Завершиться, когда в очереди не останется заданий')
+    work_parser.add_argument('--max-items', type=int, help='Завершиться после N заданий')
+    work_parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help=f'Период проверки очереди, с (по умолчанию {POLL_INTERVAL})')
+    work_parser.add_argument('--lease', type=float, default=LEASE_TIMEOUT,
+                             help=f'Время без сигнала исполнителя, после которого задание возвращается в очередь, с (по умолчанию {LEASE_TIMEOUT})')
+    status_parser = commands.add_parser('status', help='Состояние очереди')
+    status_parser.add_argument('--queue', required=True, metavar='DIR', help='Папка очереди')
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    try:
+        if args.command == 'submit':
+            report_argv = args.report_args[1:] if args.report_args[:1] == ['--'] else args.report_args
+            report_args = build_parser().parse_args(report_argv)
+            fixed = [option for name, option in ITEM_ARGUMENTS.items() if getattr(report_args, name) not in (None, build_parser().get_default(name))]
+            if fixed:
+                submit_parser.error(f'{", ".join(fixed)} задаются заданием')
+            if report_args.source_type.lower() != 'json':
+                submit_parser.error('задания формируются по данным API портала (-s JSON)')
+            return submit(args, report_argv, report_args, portal_urls)
+        if args.command == 'work':
+            return work(args, main)
+        return status(args)
+    except OSError as ex:
+        logger.error(f'Ошибка папки очереди {args.queue}: {ex}')
+        return 113
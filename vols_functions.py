@@ -2,28 +2,37 @@
 import configparser
 import datetime
 import json
-import string
+import os
+import re
+import shutil
 import sys
+import time
 from io import BytesIO
-from itertools import product
 from pathlib import Path
 from typing import List
 
 import numpy as np
 import pandas as pd
-import requests
 from loguru import logger
-from openpyxl.utils import get_column_letter
 from pandas import DataFrame
-from redmail import EmailSender
-from urllib3.exceptions import InsecureRequestWarning
 import warnings
 
 from Colors import Colors as Color
-from FormattedWorkbook import FormattedWorkbook
-from gdc_vols import PROGRAM_NAME, PROGRAM_VERSION
+from stage_timing import span, timed
+from version import PROGRAM_NAME, PROGRAM_VERSION
 
 config_file = 'gdc_vols.ini'
+# Количество попыток копирования отчета в сетевую папку и пауза перед второй попыткой в секундах (далее удваивается)
+PUBLISH_RETRIES = 5
+PUBLISH_RETRY_DELAY = 30
+# Формат дат в JSON ответах портала
+PORTAL_DATE_FORMAT = '%d.%m.%Y'
+# Части результата report_frames(): таблицы части и ключи запуска, от которых она зависит (кроме исходных данных)
+REPORT_PARTS = {
+    'metrics': (('metrics',), ('month', 'new_algorithm')),
+    'current_month': (('current_month',), ('month', 'new_algorithm', 'active_year')),
+    'funnel': (('tz', 'sending_po', 'received_po'), ()),
+}
 
 
 def email_split(mail_list: str) -> list:
@@ -34,21 +43,19 @@ def email_split(mail_list: str) -> list:
     return email_list
 
 
-def fill_cell_names():
+def http_get(url: str, check_ssl: bool = True):
     """
-    Заполнение словаря для обращения к ячейкам Excel 1:A, 2:B,... 27:AA, 28:AB и так далее до ZZZ
+    GET запрос к порталу. requests загружается при первом обращении к сети, а не при запуске программы
 
-    :return Dictionary:
+    :param url: Адрес
+    :param check_ssl: Проверка сертификата
+    :return requests.Response:
     """
-    _count = 1
-    _cell_names = {}
+    import requests
+    from urllib3.exceptions import InsecureRequestWarning
 
-    for i in range(1, 4):
-        for element in product(string.ascii_uppercase, repeat=i):
-            _cell_names[_count] = ''.join(element)
-            _count += 1
-
-    return _cell_names
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    return requests.get(url, verify=check_ssl)
 
 
 def print_debug(level, message):
@@ -63,27 +70,152 @@ def print_debug(level, message):
     print(f'{Color.RED}DEBUG ({level}): \n{Color.END}{Color.YELLOW}{message}{Color.END}')
 
 
-def read_from_dashboard(url: str, data_type: str = "JSON", check_ssl: bool = True) -> pd.DataFrame:
+def dashboard_response(url: str, data_type: str, check_ssl: bool, store) -> bytes:
+    """
+    Исходный ответ портала (содержимое файла для 'FILE'): из записанных ответов или из сети с записью
+
+    :param url: Местоположения данных
+    :param data_type: Тип получаемых данных 'JSON', 'EXCEL' или 'FILE'
+    :param check_ssl: Проверка сертификата (True или False)
+    :param store: ResponseStore в режиме записи или воспроизведения
+    :return bytes:
+    """
+    with span('fetch', url=url):
+        if store.replay:
+            return store.load(data_type, url)
+        start = time.perf_counter()
+        if data_type.lower() == "file":
+            content = Path(url).read_bytes()
+            metadata = {}
+        else:
+            response = http_get(url, check_ssl)
+            content = response.content
+            metadata = {'status': response.status_code, 'content_type': response.headers.get('Content-Type')}
+        metadata['elapsed'] = round(time.perf_counter() - start, 3)
+    store.save(data_type, url, content, **metadata)
+    return content
+
+
+def dashboard_column_types(_process_columns: dict) -> dict:
+    """
+    Схема колонок ответа API портала по словарю наименований колонок: ключи *_date (и *_date2) - даты, остальные - текст.
+    ID не входит в схему: числовой формат задает convert_int()
+
+    :param _process_columns: Словарь наименований колонок
+    :return dict: колонка: 'date' или 'text'
+    """
+    return {_column: 'date' if re.search(r'_date\d*$', _key) else 'text' for _key, _column in _process_columns.items() if _key != 'id'}
+
+
+def parse_portal_dates(_series):
+    """
+    Разбирает колонку дат формата портала ДД.ММ.ГГГГ векторно (pyarrow), пустая строка - пустая дата, как в pd.to_datetime
+
+    :param _series: Колонка строк
+    :return Series: Колонка datetime64 или None, если не все значения в формате портала (или не строки)
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    try:
+        _values = pa.array(_series, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    _dates = pc.strptime(_values, format=PORTAL_DATE_FORMAT, unit='ns', error_is_null=True)
+    if _dates.null_count != _values.null_count + (pc.sum(pc.equal(_values, '')).as_py() or 0):
+        return None
+    return pd.Series(_dates.to_numpy(zero_copy_only=False), index=_series.index, name=_series.name)
+
+
+def decode_dashboard_json(content: bytes, column_types: dict = None) -> pd.DataFrame:
+    """
+    Декодирует ответ API портала (массив объектов JSON) в DataFrame.
+    JSON декодирует orjson, если пакет установлен. Таблица собирается по колонкам (pyarrow) без промежуточных объектов pandas,
+    колонки схемы (dashboard_column_types) сразу получают свои типы: текст - строки Arrow, даты разбираются векторно
+    по формату портала ДД.ММ.ГГГГ. Колонка дат, в которой хотя бы одно значение не в этом формате, остается строками
+    и разбирается convert_date() как раньше. Остальные колонки преобразуются, как в pd.DataFrame.
+    Ответ с разным набором полей у объектов или со значениями разных типов в одной колонке собирается pd.DataFrame по строкам
+
+    :param content: Ответ портала
+    :param column_types: Схема колонок: колонка: 'date' или 'text'
+    :return DataFrame:
+    """
+    import pyarrow as pa
+
+    try:
+        import orjson
+        _records = orjson.loads(content)
+    except ImportError:
+        _records = json.loads(content)
+    column_types = column_types or {}
+    _string_types = {pa.string(): pd.StringDtype('pyarrow')}
+    _data_frame = None
+    # Pa.Table.from_pylist берет поля из первого объекта: у объектов представления портала набор полей одинаковый
+    if _records and len(set(map(len, _records))) == 1:
+        try:
+            _table = pa.Table.from_pylist(_records)
+            _data_frame = pd.DataFrame({_name: _table.column(_name).to_pandas(types_mapper=_string_types.get if column_types.get(_name) == 'text' else None)
+                                        for _name in _table.column_names})
+            del _table
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            _data_frame = None
+    if _data_frame is None:
+        _data_frame = pd.DataFrame(_records)
+        for _column in _data_frame.columns:
+            # То же правило, что в convert_text: колонки без строк остаются object
+            if column_types.get(_column) == 'text' and pd.api.types.infer_dtype(_data_frame[_column], skipna=True) == 'string':
+                _data_frame[_column] = _data_frame[_column].astype('string[pyarrow]')
+    del _records
+    for _column in _data_frame.columns:
+        if column_types.get(_column) == 'date' and pd.api.types.is_string_dtype(_data_frame[_column].dtype):
+            _dates = parse_portal_dates(_data_frame[_column])
+            if _dates is not None:
+                _data_frame[_column] = _dates
+    return _data_frame
+
+
+def read_from_dashboard(url: str, data_type: str = "JSON", check_ssl: bool = True, store=None, column_types=None, downloads=None) -> pd.DataFrame:
     """
     Читает данные JSON или Excel из url и сохраняет их в DataFrame
 
     :param url: Местоположения данных:
     :param data_type: Тип получаемых данных 'JSON', 'EXCEL' или 'FILE':
     :param check_ssl: Проверка сертификата (True или False):
+    :param store: ResponseStore: запись исходных ответов (--record) или чтение записанных без обращения к сети (--replay)
+    :param column_types: Схема колонок JSON (dashboard_column_types), приводимых к типам при декодировании
+    :param downloads: DownloadCache: выгрузки EXCEL скачиваются потоком в папку кэша с условными запросами и продолжением скачивания
     :return DataFrame:
     """
     print(f'Получаем данные из: "{url}"')
     try:
-        if data_type.lower() == "excel":
-            _dashboard_data = pd.read_excel(url, parse_dates=True)
+        if store is not None:
+            _content = dashboard_response(url, data_type, check_ssl, store)
+            with span('parse', url=url):
+                if data_type.lower() in ("excel", "file"):
+                    _dashboard_data = pd.read_excel(BytesIO(_content), parse_dates=True)
+                    if data_type.lower() == "file":
+                        _dashboard_data = _dashboard_data.replace(to_replace=r'^-$', value=np.nan, regex=True).infer_objects(copy=False)
+                else:
+                    _dashboard_data = decode_dashboard_json(_content, column_types)
+        elif data_type.lower() == "excel" and downloads is not None:
+            with span('fetch', url=url):
+                _file = downloads.fetch(url, check_ssl)
+            with span('parse', url=url):
+                _dashboard_data = pd.read_excel(_file, parse_dates=True)
+        elif data_type.lower() == "excel":
+            with span('fetch', url=url):
+                _dashboard_data = pd.read_excel(url, parse_dates=True)
         elif data_type.lower() == "file":
-            _dashboard_data = pd.read_excel(url, parse_dates=True)
-            _dashboard_data = _dashboard_data.replace(to_replace=r'^-$', value=np.nan, regex=True).infer_objects(copy=False)
+            with span('fetch', url=url):
+                _dashboard_data = pd.read_excel(url, parse_dates=True)
+            with span('parse', url=url):
+                _dashboard_data = _dashboard_data.replace(to_replace=r'^-$', value=np.nan, regex=True).infer_objects(copy=False)
         else:
             # Временно выключаем проверку сертификатов
-            requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-            response = requests.get(url, verify=check_ssl)
-            _dashboard_data = pd.DataFrame(response.json())
+            with span('fetch', url=url):
+                response = http_get(url, check_ssl)
+            with span('parse', url=url):
+                _dashboard_data = decode_dashboard_json(response.content, column_types)
             # Временно выключаем проверку сертификатов
 
         # _dashboard_data = pd.read_json(url, convert_dates=['дата', 'Дата'])
@@ -93,15 +225,20 @@ def read_from_dashboard(url: str, data_type: str = "JSON", check_ssl: bool = Tru
     return _dashboard_data
 
 
-def get_update_date(url: str, check_ssl: bool = True):
-    """Читает дату обновления через API из url и возвращает ее."""
+def get_update_date(url: str, check_ssl: bool = True, store=None):
+    """Читает дату обновления через API из url и возвращает ее. При заданном store (ResponseStore) ответ записывается или берется из записанных"""
 
     print(f'Получаем дату обновления данных из: "{url}"')
     try:
-        # Временно выключаем проверку сертификатов
-        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-        response = requests.get(url, verify=check_ssl)
-        data_json = json.loads(response.content.decode('utf-8'))
+        if store is not None and store.replay:
+            content = store.load('UPDATE', url)
+        else:
+            # Временно выключаем проверку сертификатов
+            response = http_get(url, check_ssl)
+            content = response.content
+            if store is not None:
+                store.save('UPDATE', url, content, status=response.status_code, content_type=response.headers.get('Content-Type'))
+        data_json = json.loads(content.decode('utf-8'))
         # Временно выключаем проверку сертификатов
 
         # response = urllib.request.urlopen(url)
@@ -114,13 +251,15 @@ def get_update_date(url: str, check_ssl: bool = True):
     return data_json[0]['DATE_LAST_UPDATE']
 
 
-def write_dataframe_to_file(_data_frame, _file_name, _sheet):
+def write_dataframe_to_file(_data_frame, _file_name, _sheet, _engine='openpyxl'):
     """
-    Записывает в Excel файл таблицы с данными
+    Записывает в Excel файл таблицы с данными.
+    Дописать лист в существующий файл можно только через openpyxl, новый файл пишется через _engine
 
     :param _data_frame:
     :param _file_name:
     :param _sheet:
+    :param _engine: 'openpyxl' или 'xlsxwriter'
     """
     if Path(_file_name).is_file():
         with pd.ExcelWriter(_file_name, mode='a', if_sheet_exists="replace", datetime_format="DD.MM.YYYY",
@@ -129,12 +268,106 @@ def write_dataframe_to_file(_data_frame, _file_name, _sheet):
                 f'Append "{_sheet}" sheet to exist file: "{_file_name}"')
             _data_frame.to_excel(writer, sheet_name=_sheet, index=False)
     else:
-        with pd.ExcelWriter(_file_name, mode='w', datetime_format="DD.MM.YYYY", engine='openpyxl') as writer:
+        with pd.ExcelWriter(_file_name, mode='w', datetime_format="DD.MM.YYYY", engine=_engine) as writer:
             print(
                 f'Write "{_sheet}" sheet to new file: "{_file_name}"')
             _data_frame.to_excel(writer, sheet_name=_sheet, index=False)
 
 
+def report_marker(_file_name) -> Path:
+    """Возвращает имя файла-маркера готовности отчета: <отчет>.ready рядом с файлом отчета"""
+    return Path(_file_name).with_name(f'{Path(_file_name).name}.ready')
+
+
+@timed('publish')
+def publish_report(_local_file, _target_file, _retries=PUBLISH_RETRIES, _retry_delay=PUBLISH_RETRY_DELAY) -> bool:
+    """
+    Публикует сохраненный на локальном диске отчет в сетевую папку.
+    Файл копируется во временный файл рядом с отчетом и атомарно переименовывается, поэтому в папке всегда
+    лежит целый отчет: прежний или новый. При ошибке (нет доступа к папке, отчет открыт в Excel)
+    попытка повторяется через _retry_delay секунд с удвоением паузы.
+    Результат публикации записывается в файл-маркер готовности рядом с локальным файлом,
+    а при успехе и рядом с отчетом в сетевой папке.
+
+    :param _local_file: Файл отчета на локальном диске
+    :param _target_file: Файл отчета в сетевой папке
+    :param _retries: Количество попыток
+    :param _retry_delay: Пауза перед повторной попыткой в секундах
+    :return bool: Отчет опубликован
+    """
+    _local_file, _target_file = Path(_local_file), Path(_target_file)
+    _temp_file = _target_file.with_name(f'~{_target_file.name}')
+    _marker = {
+        'report': str(_target_file),
+        'size': _local_file.stat().st_size,
+        'status': 'failed',
+        'attempts': 0,
+        'error': None,
+    }
+    for _attempt in range(1, _retries + 1):
+        _marker['attempts'] = _attempt
+        try:
+            shutil.copyfile(_local_file, _temp_file)
+            os.replace(_temp_file, _target_file)
+            _marker['status'] = 'published'
+            _marker['error'] = None
+            break
+        except OSError as e:
+            _marker['error'] = str(e)
+            logger.error(f'Попытка {_attempt} из {_retries} копирования отчета в "{_target_file}" не удалась: {e}')
+            try:
+                _temp_file.unlink(missing_ok=True)
+            except OSError:
+                pass
+            if _attempt < _retries:
+                time.sleep(_retry_delay * 2 ** (_attempt - 1))
+    _marker['time'] = datetime.datetime.now().isoformat(timespec='seconds')
+    _marker_text = json.dumps(_marker, ensure_ascii=False, indent=2)
+    report_marker(_local_file).write_text(_marker_text, encoding='utf-8')
+    if _marker['status'] == 'published':
+        try:
+            report_marker(_target_file).write_text(_marker_text, encoding='utf-8')
+        except OSError as e:
+            logger.error(f'Не удалось записать маркер готовности отчета "{report_marker(_target_file)}": {e}')
+        print(f'Отчет опубликован в {Color.GREEN}"{_target_file}"{Color.END}')
+    else:
+        print(f'{Color.RED}Отчет не опубликован в "{_target_file}", локальная копия: "{_local_file}"{Color.END}')
+    return _marker['status'] == 'published'
+
+
+def report_published(_local_file) -> bool:
+    """Проверяет по маркеру готовности рядом с локальным файлом, что отчет был опубликован"""
+    try:
+        return json.loads(report_marker(_local_file).read_text(encoding='utf-8'))['status'] == 'published'
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def report_memory(_process, _stage: str, _frames: dict = None):
+    """
+    Выводит память процесса (RSS и пиковую) и размер таблиц после этапа обработки.
+    Размер таблицы считается с учетом строк Python, данные, общие для нескольких таблиц при copy-on-write, учитываются в каждой
+
+    :param _process: psutil.Process текущего процесса, при None ничего не выводится
+    :param _stage: Наименование этапа
+    :param _frames: Словарь наименование: DataFrame
+    """
+    if _process is None:
+        return
+    _memory = _process.memory_info()
+    if hasattr(_memory, 'peak_wset'):
+        _peak = _memory.peak_wset
+    else:
+        import resource
+        _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    _peak = max(_peak, _memory.rss)
+    print(f'Память после этапа {Color.GREEN}"{_stage}"{Color.END}: RSS {_memory.rss / 2 ** 20:.1f} МБ, пик {_peak / 2 ** 20:.1f} МБ')
+    for _name, _df in (_frames or {}).items():
+        if _df is not None:
+            print(f'    {_name}: {len(_df)} строк, {_df.memory_usage(deep=True).sum() / 2 ** 20:.1f} МБ')
+    logger.debug(f'{_stage}: rss={_memory.rss} peak={_peak}')
+
+
 def convert_date(_data_frame, _columns):
     """
     Конвертирует поля с датами в формат datetime64.
@@ -148,6 +381,14 @@ def convert_date(_data_frame, _columns):
     for _column_name in _columns_names:
         for _column in _columns:
             if _column.lower() in _column_name.lower():
+                # Колонки, разобранные при декодировании ответа (decode_dashboard_json), уже datetime64
+                if pd.api.types.is_datetime64_any_dtype(_data_frame[_column_name]):
+                    break
+                # Даты формата портала разбираются векторно, остальные - pd.to_datetime
+                _dates = parse_portal_dates(_data_frame[_column_name]) if pd.api.types.is_string_dtype(_data_frame[_column_name].dtype) else None
+                if _dates is not None:
+                    _data_frame[_column_name] = _dates
+                    break
                 # Подавляет FutureWarning для PANDAS при преобразовании типа с игнорированием ошибок
                 with warnings.catch_warnings():
                     warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -176,6 +417,20 @@ def convert_int(_data_frame, _columns):
     return _data_frame
 
 
+def convert_text(_data_frame, _dtype='string[pyarrow]'):
+    """
+    Конвертирует текстовые поля (колонки object, в которых кроме пропусков только строки) в строки Arrow.
+    Возвращает конвертированный DataFrame
+
+    :param _data_frame:
+    :param _dtype: Тип строковых колонок
+    :return DataFrame:
+    """
+    _columns = [_column for _column in _data_frame.columns
+                if _data_frame[_column].dtype == object and pd.api.types.infer_dtype(_data_frame[_column], skipna=True) == 'string']
+    return _data_frame.astype({_column: _dtype for _column in _columns})
+
+
 def last_day_of_month(_date: datetime) -> datetime:
     if _date.month == 12:
         curr_year = _date.year + 1
@@ -189,11 +444,7 @@ def last_day_of_month(_date: datetime) -> datetime:
 
 
 def sum_sort_events(_data_frame, _column, _condition):
-    _sum_sort = 0
-    for _sum_data in _data_frame[_column]:
-        if _sum_data in _condition:
-            _sum_sort += 1
-    return _sum_sort
+    return int(_data_frame[_column].isin(_condition).sum())
 
 
 def sum_done_events(_data_frame, _ks_date, _commissioning_date, _ks_status, _commissioning_status, _condition, _month, _last_days_of_month):
@@ -213,8 +464,191 @@ def sum_sort_month_events(_data_frame, _column, _month, _last_days_of_month):
     return _sum_sort
 
 
+def report_section_metrics(_data_frame, _process_columns, _processes, _last_day, _new_algorithm=False, _suffix=''):
+    """
+    Считает показатели секции отчетной таблицы.
+    Для реконструкции колонки процессов имеют суффикс '2'
+
+    :param _data_frame: Мероприятия секции
+    :param _process_columns: Словарь наименований колонок
+    :param _processes: Ключи колонок статусов процессов в порядке строк отчета
+    :param _last_day: Последний день отчетного месяца
+    :param _new_algorithm: Считать факт по дате ввода в эксплуатацию
+    :param _suffix: Суффикс ключей колонок
+    :return dict:
+    """
+    _plan = _data_frame[_process_columns['plan_date']]
+    _metrics = {
+        'total': _plan.count(),
+        'plan': _plan[(_plan != '') & (_plan <= _last_day)].count(),
+    }
+    if not _new_algorithm:
+        _commissioning = _data_frame[_process_columns[f'commissioning_date{_suffix}']]
+        _ks2 = _data_frame[_process_columns[f'ks2_date{_suffix}']]
+        _metrics['fact'] = _commissioning[(_commissioning != '') & (_commissioning <= _last_day) & (_ks2 != '') & (_ks2 <= _last_day)].count()
+    else:
+        _complete = _data_frame[_process_columns[f'complete_date{_suffix}']]
+        _metrics['fact'] = _complete[(_complete != '') & (_complete <= _last_day)].count()
+    _metrics['delta'] = _metrics['fact'] - _metrics['plan']
+    _metrics['done'] = [sum_sort_events(_data_frame, _process_columns[f'{_process}{_suffix}'], ['Исполнена', 'Не требуется']) for _process in _processes]
+    _metrics['done_delta'] = [_done - _metrics['total'] for _done in _metrics['done']]
+    return _metrics
+
+
+def report_frames(_main_build_df, _ext_build_df, _rec_df, _process_columns, _processes, _last_days_of_month, _month, _columns_for_sort, _columns_for_sort_active,
+                  _business_process, _new_algorithm=False, _active_year=False, _parts=None) -> dict:
+    """
+    Считает показатели отчетной таблицы и таблицы листов рассылки по загруженным данным
+
+    :param _main_build_df: Основное строительство
+    :param _ext_build_df: Дополнительное строительство или None
+    :param _rec_df: Реконструкция или None
+    :param _process_columns: Словарь наименований колонок
+    :param _processes: Ключи колонок статусов процессов в порядке строк отчета
+    :param _last_days_of_month: Словарь месяц: последний день месяца
+    :param _month: Отчетный месяц
+    :param _columns_for_sort: Колонки сортировки листов рассылки
+    :param _columns_for_sort_active: Колонки сортировки листа активных мероприятий
+    :param _business_process: Наименования колонки бизнес-процесса, строительства и реконструкции
+    :param _new_algorithm: Считать факт по дате ввода в эксплуатацию
+    :param _active_year: Активные мероприятия до конца года
+    :param _parts: Считаемые части результата (ключи REPORT_PARTS), None - все
+    :return dict: metrics, current_month, tz, sending_po, received_po (только таблицы выбранных частей)
+    """
+    _parts = REPORT_PARTS if _parts is None else _parts
+    _bp, _bp_build, _bp_recon = _business_process
+    _mail_columns = [_process_columns[_column] for _column in ('id', 'region', 'name', 'plan_date', 'program')]
+    _po_columns = _mail_columns + [_process_columns['po']]
+    _active_columns = [_process_columns[_column] for _column in ('id', 'program_category', 'work_type', 'region', 'name', 'plan_date', 'prognoz_date', 'program', 'po')]
+    _result = {}
+
+    # Анализ строительства ВОЛС. Выборки строк сразу ограничиваются нужными колонками, загруженные таблицы не копируются
+    df = _main_build_df
+    if _ext_build_df is not None and ('current_month' in _parts or 'funnel' in _parts):
+        df = pd.concat([_main_build_df, _ext_build_df], ignore_index=True)
+
+    if 'metrics' in _parts:
+        kpi_build_df = _main_build_df[_main_build_df[_process_columns['program_category']].isin(['Доступ', 'Дискреты_целевые'])]
+
+        # Показатели секций отчетной таблицы. Реконструкция считается по колонкам с суффиксом '2'
+        report_dataframes = {
+            'build': (_main_build_df, ''),
+            'ext': (_ext_build_df, ''),
+            'rec': (_rec_df, '2'),
+            'kpi': (kpi_build_df, ''),
+        }
+        report_metrics = {}
+        for section, (section_df, suffix) in report_dataframes.items():
+            if section_df is not None:
+                report_metrics[section] = report_section_metrics(section_df, _process_columns, _processes, _last_days_of_month[_month], _new_algorithm, suffix)
+        _result['metrics'] = report_metrics
+
+    # Активные мероприятия месяца отчёта (до конца года при _active_year), у строительства и реконструкции колонки статусов и даты ввода различаются
+    def current_month_mask(_df, _suffix):
+        # маска для текущего месяца
+        _month_mask = _df[_process_columns['plan_date']] <= _last_days_of_month[12 if _active_year else _month].strftime('%Y-%m-%d')
+        # маска для не "Исполнена" или не "Не требуется"
+        if not _new_algorithm:
+            _status_mask = (~_df[_process_columns[f'commissioning_status{_suffix}']].str.contains('Исполнена|Не требуется', regex=True)) | (
+                ~_df[_process_columns[f'ks2_status{_suffix}']].str.contains('Исполнена|Не требуется', regex=True))
+        else:
+            _status_mask = (_df[_process_columns[f'complete_date{_suffix}']].isna()) & (_df[_process_columns['plan_date']] <= _last_days_of_month[_month])
+        # Пропуск в строках Arrow дает в маске <NA>: такие мероприятия не выбираются
+        return (_month_mask & _status_mask).fillna(False)
+
+    def not_done(_df, _status):
+        # Пустой статус, как и NaN в колонке object, не равен "Исполнена"
+        return (_df[_process_columns[_status]] != 'Исполнена').fillna(True)
+
+    if 'current_month' in _parts:
+        current_month_dataframe = df.loc[current_month_mask(df, ''), _active_columns].assign(**{_bp: _bp_build})
+        # Анализ реконструкции ВОЛС. Объединяем стройку и реконструкцию
+        if _rec_df is not None:
+            current_month_dataframe = pd.concat([current_month_dataframe, _rec_df.loc[current_month_mask(_rec_df, '2'), _active_columns].assign(**{_bp: _bp_recon})],
+                                                ignore_index=True).sort_values(by=_columns_for_sort_active)
+        _result['current_month'] = current_month_dataframe
+
+    if 'funnel' in _parts:
+        tz_dataframe = df.loc[not_done(df, 'tz_status'), _mail_columns].assign(**{_bp: _bp_build})
+        sending_po_dataframe = df.loc[not_done(df, 'send_tz_status'), _po_columns].assign(**{_bp: _bp_build})
+        received_po_dataframe = df.loc[not_done(df, 'received_tz_status'), _po_columns].assign(**{_bp: _bp_build})
+
+        if _rec_df is not None:
+            tz_dataframe = pd.concat([tz_dataframe, _rec_df.loc[not_done(_rec_df, 'tz_status2'), _mail_columns].assign(**{_bp: _bp_recon})],
+                                     ignore_index=True).sort_values(by=_columns_for_sort)
+            sending_po_dataframe = pd.concat([sending_po_dataframe, _rec_df.loc[not_done(_rec_df, 'send_tz_status2'), _po_columns].assign(**{_bp: _bp_recon})],
+                                             ignore_index=True)
+            received_po_dataframe = pd.concat([received_po_dataframe, _rec_df.loc[not_done(_rec_df, 'received_tz_status2'), _po_columns].assign(**{_bp: _bp_recon})],
+                                              ignore_index=True)
+
+        # Не переданы ТЗ в ПО: убираем мероприятия с не выданными ТЗ
+        sending_po_dataframe = pd.concat([sending_po_dataframe, tz_dataframe], ignore_index=True).drop_duplicates(keep=False).sort_values(by=_columns_for_sort)
+        # ТЗ не принято ПО: убираем мероприятия с не выданными ТЗ и не переданные в ПО
+        received_po_dataframe = pd.concat([received_po_dataframe, sending_po_dataframe, tz_dataframe],
+                                          ignore_index=True).drop_duplicates(keep=False).sort_values(by=_columns_for_sort)
+        _result.update({
+            'tz': tz_dataframe,
+            'sending_po': sending_po_dataframe,
+            'received_po': received_po_dataframe,
+        })
+
+    return _result
+
+
+def snapshot_changes(_previous, _current, _status_columns, _date_columns, _info_columns, _key='ID') -> DataFrame:
+    """
+    Сравнивает два снимка набора данных по ключу мероприятия.
+    Возвращает новые и удаленные мероприятия, смену статусов этапов и переносы дат
+
+    :param _previous: Предыдущий снимок
+    :param _current: Текущий снимок
+    :param _status_columns: Колонки статусов этапов
+    :param _date_columns: Колонки плановой и прогнозной дат
+    :param _info_columns: Колонки для идентификации мероприятия в отчете (регион, название)
+    :param _key: Колонка ключа мероприятия
+    :return DataFrame: ключ, колонки _info_columns, Изменение, Поле, Было, Стало, Сдвиг, дн.
+    """
+    _previous = _previous.drop_duplicates(subset=_key, keep='last').set_index(_key)
+    _current = _current.drop_duplicates(subset=_key, keep='last').set_index(_key)
+    _columns = [_column for _column in list(_status_columns) + list(_date_columns) if _column in _previous.columns and _column in _current.columns]
+    _info_columns = [_column for _column in _info_columns if _column in _previous.columns and _column in _current.columns]
+
+    # Изменения значений у мероприятий, которые есть в обоих снимках
+    _common = _current.index.intersection(_previous.index)
+    _before = _previous.loc[_common, _columns]
+    _after = _current.loc[_common, _columns]
+    _changed = (_before.to_numpy() != _after.to_numpy()) & ~(_before.isna().to_numpy() & _after.isna().to_numpy())
+    _rows, _cols = np.nonzero(_changed)
+    _changes = pd.DataFrame({
+        _key: _common[_rows],
+        'Изменение': np.where(np.isin(np.array(_columns, dtype=object)[_cols], list(_date_columns)), 'Перенос даты', 'Смена статуса'),
+        'Поле': np.array(_columns, dtype=object)[_cols],
+        'Было': _before.to_numpy()[_rows, _cols],
+        'Стало': _after.to_numpy()[_rows, _cols],
+    })
+    _dates = _changes['Изменение'] == 'Перенос даты'
+    _changes['Сдвиг, дн.'] = (pd.to_datetime(_changes.loc[_dates, 'Стало'], errors='coerce') - pd.to_datetime(_changes.loc[_dates, 'Было'], errors='coerce')).dt.days
+    for _column in ('Было', 'Стало'):
+        _changes.loc[_dates, _column] = pd.to_datetime(_changes.loc[_dates, _column], errors='coerce').dt.strftime('%d.%m.%Y')
+
+    _added = pd.DataFrame({_key: _current.index.difference(_previous.index), 'Изменение': 'Новое мероприятие'})
+    _removed = pd.DataFrame({_key: _previous.index.difference(_current.index), 'Изменение': 'Мероприятие удалено'})
+    _changes = pd.concat([_added, _removed, _changes], ignore_index=True)
+    _info = pd.concat([_current[_info_columns], _previous.loc[_previous.index.difference(_current.index), _info_columns]])
+    _changes = _changes.join(_info, on=_key)
+    _changes = _changes[[_key] + _info_columns + ['Изменение', 'Поле', 'Было', 'Стало', 'Сдвиг, дн.']]
+    return _changes.sort_values(by=_info_columns[:1] + [_key], kind='stable').reset_index(drop=True)
+
+
+def changed_events(_data_frame, _changes, _key='ID') -> DataFrame:
+    """Оставляет в таблице только мероприятия, попавшие в таблицу изменений"""
+    return _data_frame[_data_frame[_key].isin(_changes[_key])]
+
+
 def adjust_columns_width(_dataframe):
     # Форматирование ширины полей отчётной таблицы
+    from openpyxl.utils import get_column_letter
+
     for _col in _dataframe.columns:
         _max_length = 0
         _column = get_column_letter(_col[0].column)  # Get the column name
@@ -246,7 +680,12 @@ def megafon_send_email(data_frame: DataFrame, tag: str, template_directory: str,
     @param email_password: Пароль для почтового сервера
     @param data_date: Дата обновления данных с портала
     """
-    report_email = EmailSender(host='mail.megafon.ru', port=25, username=email_address, password=email_password, use_starttls=True)
+    # redmail (и jinja2) загружается только для рассылки
+    from redmail import EmailSender
+
+    # Почтовый сервер переопределяется переменными окружения SMTP_HOST, SMTP_PORT, SMTP_STARTTLS=0 (тестовый стенд)
+    report_email = EmailSender(host=os.getenv('SMTP_HOST', 'mail.megafon.ru'), port=int(os.getenv('SMTP_PORT', '25')), username=email_address,
+                               password=email_password, use_starttls=os.getenv('SMTP_STARTTLS', '1') != '0')
     report_email.set_template_paths(html=Path(template_directory, 'html'))
     report_email.sender = email_address
     report_email.receivers = to_address
@@ -270,7 +709,10 @@ def megafon_send_email(data_frame: DataFrame, tag: str, template_directory: str,
     )
 
 
+@timed('mail')
 def call_send_email(dfs: DataFrame, email_list: list, no_debug: bool, email_address: str, email_password: str, last_update: str = None) -> None:
+    from FormattedWorkbook import FormattedWorkbook
+
     my_email = email_address
 
     config = configparser.ConfigParser()
@@ -310,7 +752,8 @@ def call_send_email(dfs: DataFrame, email_list: list, no_debug: bool, email_addr
         mail_wb.save(fp)
         temp_excel_file = fp.getvalue()
 
-    megafon_send_email(mail_dfs, tag, template_dir, template, to, cc, temp_excel_file, email_address, email_password, last_update)
+    with span('smtp', report=tag):
+        megafon_send_email(mail_dfs, tag, template_dir, template, to, cc, temp_excel_file, email_address, email_password, last_update)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+HTTP сервис данных отчета для резидентного режима (gdc_vols serve --watch --http [HOST:]PORT).
+
+Показатели листа "Отчетная таблица", активные мероприятия и списки воронки отдаются в JSON или CSV
+без открытия файла отчета:
+    /                      - список адресов и дата обновления данных портала
+    /metrics               - показатели отчетной таблицы по секциям
+    /active                - активные мероприятия
+    /tz, /sending_po, /received_po - списки мероприятий воронки
+
+Параметры запроса:
+    format=json|csv        - формат ответа (по умолчанию json)
+    region, category, contractor - отбор по региону, категории программы и подрядчику,
+                             несколько значений через запятую или повтором параметра
+
+Ответы строятся из таблиц последнего запуска формирования отчета и хранятся в памяти.
+Кэш сбрасывается после формирования отчета по новым данным портала (новая DATE_LAST_UPDATE).
+
+curl "http://localhost:8080/metrics?region=Москва"
+curl "http://localhost:8080/tz?format=csv&category=Доступ,Дискреты_целевые"
+"""
+import json
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+from loguru import logger
+
+from report_layout import REPORT_PROCESSES, REPORT_SECTIONS
+
+# Параметры отбора и колонки исходных таблиц
+FILTERS = {
+    'region': 'Регион/Зона мероприятия',
+    'category': 'Категория программы',
+    'contractor': 'Подрядчик по Строительству / Продаже ВОЛС',
+}
+# Адреса списков мероприятий и таблицы расчета отчета
+LISTS = {
+    'active': 'current_month',
+    'tz': 'tz',
+    'sending_po': 'sending_po',
+    'received_po': 'received_po',
+}
+FORMATS = {
+    'json': 'application/json; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+# Количество хранимых ответов и расчетов отчета по выборкам
+CACHE_SIZE = 256
+
+
+def _int(value):
+    # Значения показателей - числа numpy
+    return int(value) if value is not None else None
+
+
+def select(df: pd.DataFrame, filters: tuple):
+    """
+    Отбор мероприятий исходной таблицы
+
+    :param df: Исходная таблица
+    :param filters: ((параметр, (значения, ...)), ...)
+    :return DataFrame:
+    """
+    if df is None or not filters:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for name, values in filters:
+        if FILTERS[name] in df.columns:
+            mask &= df[FILTERS[name]].isin(values)
+    return df[mask]
+
+
+def metrics_rows(metrics: dict) -> list:
+    """
+    Показатели отчетной таблицы строками: секция, показатель, значение, отклонение
+
+    :param metrics: Показатели секций report_frames()['metrics']
+    :return list:
+    """
+    rows = []
+    for section, values in metrics.items():
+        title = REPORT_SECTIONS[section][2]
+        rows += [
+            (title, 'Всего мероприятий', _int(values['total']), None),
+            (title, 'План', _int(values['plan']), None),
+            (title, 'Факт', _int(values['fact']), _int(values['delta'])),
+        ]
+        rows += [(title, name, _int(done), _int(delta)) for name, done, delta in zip(REPORT_PROCESSES.values(), values['done'], values['done_delta'])]
+    return rows
+
+
+class ReportCache:
+    """Данные последнего отчета и ответы HTTP сервиса в памяти"""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        """
+        :param size: Количество хранимых ответов и расчетов отчета по выборкам
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._state = None
+
+    @property
+    def update_date(self):
+        state = self._state
+        return state['report']['update_date'] if state is not None else None
+
+    def update(self, report: dict):
+        """
+        Заменяет данные отчета и сбрасывает кэш
+
+        :param report: Результат gdc_vols.main()
+        """
+        state = {'report': report, 'frames': OrderedDict(), 'responses': OrderedDict()}
+        if report.get('frames') is not None:
+            state['frames'][()] = report['frames']
+        self._state = state
+        logger.info(f'Данные HTTP сервиса обновлены, дата обновления портала {report["update_date"]}')
+
+    def _cached(self, cache: OrderedDict, key, build):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value
+        value = build()
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.size:
+                cache.popitem(last=False)
+        return value
+
+    def response(self, endpoint: str, filters: tuple, output_format: str) -> bytes:
+        """
+        Тело ответа из кэша, при отсутствии - расчет по выборке мероприятий
+
+        :param endpoint: metrics или адрес списка LISTS
+        :param filters: ((параметр, (значения, ...)), ...)
+        :param output_format: json или csv
+        :return bytes:
+        """
+        # Состояние берется один раз: обновление данных во время ответа не смешивает старые и новые таблицы
+        state = self._state
+        if state is None:
+            raise LookupError('Отчет еще не сформирован')
+        report = state['report']
+
+        def frames():
+            sources = {name: select(df, filters) for name, df in report['sources'].items()}
+            return report['report_frames'](sources['build'], sources['ext'], sources['rec'])
+
+        def build():
+            result = self._cached(state['frames'], filters, frames)
+            header = {'update_date': str(report['update_date']) if report['update_date'] is not None else None, 'period': report['period'],
+                      'filters': {name: list(values) for name, values in filters}}
+            if endpoint == 'metrics':
+                rows = metrics_rows(result['metrics'])
+                if output_format == 'csv':
+                    return pd.DataFrame(rows, columns=['Секция', 'Показатель', 'Значение', 'Отклонение']).to_csv(index=False).encode('utf-8')
+                sections = OrderedDict()
+                for section, name, value, delta in rows:
+                    sections.setdefault(section, []).append({'Показатель': name, 'Значение': value, 'Отклонение': delta})
+                return json.dumps({**header, 'sections': sections}, ensure_ascii=False).encode('utf-8')
+            df = result[LISTS[endpoint]]
+            if output_format == 'csv':
+                return df.to_csv(index=False, date_format='%d.%m.%Y').encode('utf-8')
+            # Строки таблицы сериализует pandas, без промежуточных словарей
+            header = json.dumps({**header, 'count': len(df)}, ensure_ascii=False)
+            return f'{header[:-1]}, "rows": {df.to_json(orient="records", force_ascii=False, date_format="iso")}}}'.encode('utf-8')
+
+        return self._cached(state['responses'], (endpoint, filters, output_format), build)
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'gdc_vols'
+    cache: ReportCache = None
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: HTTPStatus, message: str):
+        self._send(status, json.dumps({'error': message}, ensure_ascii=False).encode('utf-8'), FORMATS['json'])
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        endpoint = url.path.strip('/')
+        query = parse_qs(url.query)
+        if endpoint == '':
+            index = {'update_date': str(self.cache.update_date) if self.cache.update_date is not None else None,
+                     'endpoints': ['/metrics', *(f'/{name}' for name in LISTS)], 'filters': list(FILTERS), 'formats': list(FORMATS)}
+            return self._send(HTTPStatus.OK, json.dumps(index, ensure_ascii=False).encode('utf-8'), FORMATS['json'])
+        if endpoint != 'metrics' and endpoint not in LISTS:
+            return self._error(HTTPStatus.NOT_FOUND, f'Неизвестный адрес /{endpoint}')
+        output_format = query.get('format', ['json'])[-1].lower()
+        if output_format not in FORMATS:
+            return self._error(HTTPStatus.BAD_REQUEST, f'Неизвестный формат {output_format}')
+        unknown = set(query) - set(FILTERS) - {'format'}
+        if unknown:
+            return self._error(HTTPStatus.BAD_REQUEST, f'Неизвестные параметры: {", ".join(sorted(unknown))}')
+        # Порядок параметров и значений не влияет на ключ кэша
+        filters = tuple((name, tuple(sorted({value.strip() for values in query[name] for value in values.split(',') if value.strip()})))
+                        for name in FILTERS if name in query)
+        try:
+            body = self.cache.response(endpoint, filters, output_format)
+        except LookupError as ex:
+            return self._error(HTTPStatus.SERVICE_UNAVAILABLE, str(ex))
+        except Exception as ex:
+            logger.exception(f'Ошибка ответа {self.path}: {ex}')
+            return self._error(HTTPStatus.INTERNAL_SERVER_ERROR, str(ex))
+        self._send(HTTPStatus.OK, body, FORMATS[output_format])
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} {format % args}')
+
+
+def start_http(address: str, cache: ReportCache) -> ThreadingHTTPServer:
+    """
+    Запускает HTTP сервис в фоновом потоке
+
+    :param address: [HOST:]PORT, без HOST - все адреса
+    :param cache: Данные отчета
+    :return ThreadingHTTPServer:
+    """
+    host, _, port = address.rpartition(':')
+    handler = type('Handler', (ReportRequestHandler,), {'cache': cache})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='http', daemon=True).start()
+    return server
@@ -0,0 +1,130 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+SQL запросы к загруженным данным портала через встроенный движок DuckDB.
+
+Для каждого набора хранилища снимков (см. snapshot_store) создаются представления:
+    "<набор>"          — текущее состояние набора,
+    history."<набор>"  — все версии строк со служебными колонками _row_hash, _snapshot, _deleted.
+Запрос выполняется прямо по файлам Parquet, данные в pandas не загружаются (кроме вывода в Excel).
+
+gdc_vols query --list
+gdc_vols query "SELECT \"Регион/Зона мероприятия\", count(*) FROM \"Расш. стр. гор.ВОЛС 2024\" GROUP BY 1"
+gdc_vols query -f stuck_tu.sql --format xlsx -o stuck_tu.xlsx
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import duckdb
+import pyarrow.csv
+from loguru import logger
+
+from Colors import Colors as Color
+from snapshot_store import DELETED_COLUMN, HASH_COLUMN, KEY_COLUMN, SERVICE_COLUMNS, SNAPSHOT_COLUMN, SNAPSHOT_DIR, STATE_FILE
+
+HISTORY_SCHEMA = 'history'
+QUERY_SHEET = 'Запрос'
+QUERY_TABLE = 'query'
+
+
+def _identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def register_snapshots(connection: duckdb.DuckDBPyConnection, directory) -> list:
+    """
+    Создает представления наборов хранилища снимков
+
+    :param connection: Соединение DuckDB
+    :param directory: Папка хранилища
+    :return list: Имена наборов
+    """
+    datasets = []
+    if not Path(directory).is_dir():
+        return datasets
+    connection.execute(f'CREATE SCHEMA IF NOT EXISTS {HISTORY_SCHEMA}')
+    for path in sorted(Path(directory).iterdir()):
+        if not Path(path, STATE_FILE).is_file() or not any(path.glob('date=*/*.parquet')):
+            continue
+        files = Path(path, 'date=*', '*.parquet').as_posix().replace("'", "''")
+        name = _identifier(path.name)
+        connection.execute(f"CREATE VIEW {HISTORY_SCHEMA}.{name} AS SELECT * EXCLUDE (date) "
+                           f"FROM read_parquet('{files}', hive_partitioning = true, union_by_name = true)")
+        # Текущее состояние: последняя запись каждой версии строки, если это не запись об удалении
+        connection.execute(f'CREATE VIEW {name} AS SELECT * EXCLUDE ({", ".join(SERVICE_COLUMNS)}) FROM {HISTORY_SCHEMA}.{name} '
+                           f'QUALIFY row_number() OVER (PARTITION BY {_identifier(KEY_COLUMN)}, {HASH_COLUMN} ORDER BY {SNAPSHOT_COLUMN} DESC) = 1 '
+                           f'AND NOT {DELETED_COLUMN}')
+        datasets.append(path.name)
+    return datasets
+
+
+def write_result(relation: duckdb.DuckDBPyRelation, output_format: str, output_file=None, max_rows: int = 100):
+    """
+    Выводит результат запроса в консоль, CSV или лист Excel
+
+    :param relation: Результат запроса
+    :param output_format: 'table', 'csv' или 'xlsx'
+    :param output_file: Имя файла для csv и xlsx, для csv без имени вывод в консоль
+    :param max_rows: Количество строк при выводе в консоль
+    """
+    if output_format == 'xlsx':
+        # openpyxl и pandas нужны только для вывода в Excel
+        from FormattedWorkbook import FormattedWorkbook
+
+        wb = FormattedWorkbook()
+        ws_first = wb.active
+        wb.excel_format_table(relation.df(), QUERY_SHEET, QUERY_TABLE)
+        wb.remove(ws_first)
+        wb.save(output_file)
+        print(f'Результат запроса сохранен в файл {Color.GREEN}"{output_file}"{Color.END}')
+    elif output_format == 'csv' and output_file is not None:
+        relation.write_csv(str(output_file))
+        print(f'Результат запроса сохранен в файл {Color.GREEN}"{output_file}"{Color.END}')
+    elif output_format == 'csv':
+        sys.stdout.flush()
+        pyarrow.csv.write_csv(relation.fetch_arrow_table(), sys.stdout.buffer)
+    else:
+        relation.show(max_rows=max_rows, max_width=1000)
+
+
+def query_main(argv=None) -> int:
+    """Подкоманда gdc_vols query"""
+    parser = argparse.ArgumentParser(prog='gdc_vols query', description='SQL запрос к загруженным данным портала (DuckDB)')
+    parser.add_argument('sql', nargs='?', help='Текст запроса')
+    parser.add_argument('-f', '--sql-file', help='Файл с текстом запроса')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help=f'Папка хранилища снимков (по умолчанию {SNAPSHOT_DIR})')
+    parser.add_argument('--format', choices=['table', 'csv', 'xlsx'], default='table', help='Формат вывода результата')
+    parser.add_argument('-o', '--output', help='Файл результата для форматов csv и xlsx')
+    parser.add_argument('--max-rows', type=int, default=100, help='Количество строк при выводе в консоль')
+    parser.add_argument('--list', action='store_true', help='Показать доступные таблицы')
+    args = parser.parse_args(argv)
+
+    connection = duckdb.connect()
+    datasets = register_snapshots(connection, args.snapshot_dir)
+    if args.list:
+        for dataset in datasets:
+            print(f'{Color.GREEN}{_identifier(dataset)}{Color.END}, {HISTORY_SCHEMA}.{_identifier(dataset)}')
+        return 0
+
+    if args.sql_file is not None:
+        sql = Path(args.sql_file).read_text(encoding='utf-8')
+    elif args.sql is not None:
+        sql = args.sql
+    else:
+        parser.error('не задан текст запроса')
+    if args.format == 'xlsx' and args.output is None:
+        parser.error('для формата xlsx требуется имя файла (-o)')
+
+    try:
+        relation = connection.sql(sql)
+    except duckdb.Error as ex:
+        logger.error(f'Ошибка выполнения запроса: {ex}')
+        return 1
+    if relation is None:
+        return 0
+    write_result(relation, args.format, args.output, args.max_rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(query_main())
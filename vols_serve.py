@@ -0,0 +1,155 @@
+#  Copyright (c) 2022. Tikhon Ostapenko
+"""
+Резидентный режим: процесс остается запущенным и формирует отчет и рассылку только при обновлении данных портала.
+
+Интерпретатор, загруженные библиотеки и кэши остаются в памяти между запусками, каждый запуск - вызов main() с теми же аргументами.
+Обновление проверяется каждые --interval секунд:
+    JSON и EXCEL - дата обновления DATE_LAST_UPDATE функции портала fn_<год>_FOCL_Plan_Build_City(),
+    FILE - изменение содержимого исходных файлов (хэш считается, только если изменились размер или время изменения файла).
+Данные старше 48 часов обрабатываются по --stale-data без вопросов: skip - отчет не формируется до следующего обновления,
+run - отчет формируется.
+
+gdc_vols serve --watch --interval 600 -- -l --soc-report
+gdc_vols serve --watch -- -s FILE
+
+С --http [HOST:]PORT показатели и списки последнего отчета отдаются HTTP сервисом (vols_http) из памяти:
+gdc_vols serve --watch --http 8080 -- -l
+"""
+import argparse
+import datetime
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from loguru import logger
+
+import stage_timing
+from Colors import Colors as Color
+
+# Период проверки обновления данных портала, с
+POLL_INTERVAL = 300
+# Код завершения main() при устаревших данных портала
+STALE_DATA_EXIT_CODE = 12
+
+
+class FileVersions:
+    """Версии исходных файлов режима FILE: хэш содержимого пересчитывается только при изменении размера или времени изменения"""
+
+    def __init__(self):
+        self._stats = {}
+
+    def version(self, paths) -> tuple:
+        versions = []
+        for path in paths:
+            try:
+                stat = Path(path).stat()
+            except OSError:
+                versions.append((str(path), None))
+                continue
+            cached = self._stats.get(str(path))
+            if cached is None or cached[0] != (stat.st_size, stat.st_mtime_ns):
+                digest = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+                cached = self._stats[str(path)] = ((stat.st_size, stat.st_mtime_ns), digest)
+            versions.append((str(path), cached[1]))
+        return tuple(versions)
+
+
+def run_report(main, argv: list) -> tuple:
+    """
+    Один запуск формирования отчета. Ожидает окончания фоновых потоков рассылки и копирования отчета
+
+    :param main: gdc_vols.main
+    :param argv: Аргументы формирования отчета
+    :return tuple: Код завершения, данные отчета (результат main() или None)
+    """
+    report = None
+    try:
+        report = main(argv)
+        code = 0
+    except SystemExit as ex:
+        code = ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+    except Exception as ex:
+        logger.exception(f'Ошибка формирования отчета: {ex}')
+        code = 1
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+    stage_timing.finish_run(code)
+    return code, report
+
+
+def serve_main(argv, main, build_parser, portal_urls) -> int:
+    """
+    Подкоманда gdc_vols serve
+
+    :param argv: Аргументы подкоманды и после них аргументы формирования отчета
+    :param main: gdc_vols.main
+    :param build_parser: gdc_vols.build_parser
+    :param portal_urls: gdc_vols.portal_urls
+    """
+    parser = argparse.ArgumentParser(prog='gdc_vols serve', description='Формирование отчета при обновлении данных портала',
+                                     epilog='Аргументы формирования отчета gdc_vols указываются после --')
+    parser.add_argument('--watch', action='store_true', help='Оставаться запущенным и проверять обновление данных портала (иначе одна проверка)')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help=f'Период проверки обновления, с (по умолчанию {POLL_INTERVAL})')
+    parser.add_argument('--stale-data', choices=['skip', 'run'], default='skip',
+                        help='Данные портала обновлялись более 48 часов назад: skip - не формировать отчет, run - формировать')
+    parser.add_argument('--http', metavar='[HOST:]PORT', help='HTTP сервис показателей и списков последнего отчета (только с --watch)')
+    parser.add_argument('report_args', nargs=argparse.REMAINDER, help='Аргументы формирования отчета')
+    args = parser.parse_args(argv)
+    report_argv = args.report_args[1:] if args.report_args[:1] == ['--'] else args.report_args
+    report_args = build_parser().parse_args(report_argv)
+    if report_args.stale_data != 'ask':
+        parser.error('политика устаревших данных задается аргументом serve --stale-data')
+    if report_args.profile is not None:
+        parser.error('--profile не поддерживается в режиме serve')
+    if args.http is not None and not args.watch:
+        parser.error('--http используется только с --watch')
+    report_argv = report_argv + ['--stale-data', args.stale_data]
+
+    from vols_functions import get_update_date
+
+    load_dotenv()
+    cache = None
+    if args.http is not None:
+        from vols_http import ReportCache, start_http
+
+        cache = ReportCache()
+        try:
+            server = start_http(args.http, cache)
+        except (OSError, ValueError) as ex:
+            logger.error(f'Ошибка запуска HTTP сервиса {args.http}: {ex}')
+            return 110
+        print(f'HTTP сервис данных отчета: {Color.GREEN}http://{server.server_address[0]}:{server.server_address[1]}/{Color.END}')
+    files = FileVersions()
+    processed = None
+    code = 0
+    try:
+        while True:
+            process_year = report_args.year if report_args.year is not None else datetime.date.today().year
+            _, _, file_urls, last_update_url = portal_urls(process_year)
+            if report_args.source_type.lower() == 'file':
+                version = files.version(file_urls.values())
+                if all(digest is None for _, digest in version):
+                    version = None
+            else:
+                version = get_update_date(last_update_url, check_ssl=not report_args.ignore_cert)
+            if version is None:
+                logger.error('Не удалось получить версию данных портала, отчет не формируется')
+            elif version == processed:
+                print(f'{Color.DARKCYAN}{datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")}:{Color.END} данные портала не изменились')
+            else:
+                code, report = run_report(main, report_argv)
+                if cache is not None and report is not None:
+                    cache.update(report)
+                if code in (0, STALE_DATA_EXIT_CODE):
+                    # Устаревшие данные не обрабатываются повторно до следующего обновления
+                    processed = version
+                else:
+                    logger.error(f'Формирование отчета завершилось с кодом {code}, повтор при следующей проверке')
+            if not args.watch:
+                return code
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0